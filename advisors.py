@@ -0,0 +1,138 @@
+# advisors.py
+
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from tokens import count_tokens
+
+# Добавляется к каждому system_prompt
+FORMAT_INSTR = (
+    '\n\nПожалуйста, форматируй ответ, используя эмодзи, отступы и '
+    'маркированные списки для лучшей читаемости.'
+)
+
+
+@dataclass(frozen=True)
+class Advisor:
+    """Советник из advisors/*.json с уже собранным системным промптом."""
+    name:          str
+    path:          str
+    mtime:         float
+    data:          dict
+    system_prompt: str
+    prompt_tokens: int
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+
+def load_advisor(path: str) -> Advisor:
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    # промпт собирается один раз и не меняется между запросами —
+    # одинаковый префикс кэшируется на стороне OpenAI
+    system_prompt = data.get('system_prompt', '') + FORMAT_INSTR
+    return Advisor(
+        name=data['name'],
+        path=path,
+        mtime=mtime,
+        data=data,
+        system_prompt=system_prompt,
+        prompt_tokens=count_tokens(system_prompt),
+    )
+
+
+class AdvisorRegistry:
+    """Советники с горячей перезагрузкой изменённых файлов по mtime.
+
+    Перезагрузка собирает новый словарь и подменяет его целиком, поэтому
+    запросы, уже получившие своего Advisor, продолжают работать со старой версией.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 5.0):
+        self.path            = path
+        self.reload_interval = reload_interval
+        self._by_path: dict[str, Advisor] = {}
+        self._advisors: dict[str, Advisor] = {}
+        self._broken: dict[str, float] = {}
+        self._checked = 0.0
+        self.refresh()
+
+    def refresh(self) -> list[Advisor]:
+        """Перечитывает новые и изменённые файлы; возвращает обновлённых советников."""
+        self._checked = time.monotonic()
+        by_path, changed = {}, []
+        for fname in sorted(os.listdir(self.path)):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(self.path, fname)
+            old  = self._by_path.get(path)
+            mtime = None
+            try:
+                mtime = os.stat(path).st_mtime
+                if old and mtime == old.mtime or self._broken.get(path) == mtime:
+                    if old:
+                        by_path[path] = old
+                    continue
+                by_path[path] = load_advisor(path)
+                changed.append(by_path[path])
+                self._broken.pop(path, None)
+            except (OSError, ValueError, KeyError) as e:
+                # битый файл не роняет бота — остаётся прежняя версия
+                logging.error('Не удалось загрузить советника %s: %s', fname, e)
+                self._broken[path] = mtime
+                if old:
+                    by_path[path] = old
+
+        if changed or by_path.keys() != self._by_path.keys():
+            self._by_path  = by_path
+            self._advisors = {a.name: a for a in by_path.values()}
+            for a in changed:
+                logging.info('Советник %s загружен (%s токенов)', a.name, a.prompt_tokens)
+        return changed
+
+    def maybe_refresh(self) -> None:
+        if time.monotonic() - self._checked >= self.reload_interval:
+            self.refresh()
+
+    def __contains__(self, name: str) -> bool:
+        self.maybe_refresh()
+        return name in self._advisors
+
+    def get(self, name: str) -> Advisor | None:
+        self.maybe_refresh()
+        return self._advisors.get(name)
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        self.maybe_refresh()
+        return tuple(self._advisors)
+
+    # ————— заранее собранные клавиатуры —————
+    def start_keyboard(self) -> ReplyKeyboardMarkup:
+        return _start_keyboard(self.names)
+
+    def advisors_keyboard(self, selected) -> InlineKeyboardMarkup:
+        return _advisors_keyboard(self.names, frozenset(selected))
+
+
+@lru_cache(maxsize=8)
+def _start_keyboard(names: tuple[str, ...]) -> ReplyKeyboardMarkup:
+    keyboard = [list(names[i:i + 2]) for i in range(0, len(names), 2)]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+@lru_cache(maxsize=512)
+def _advisors_keyboard(names: tuple[str, ...], selected: frozenset) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(f"{'✅ ' if name in selected else ''}{name}", callback_data=f"adv|{name}")
+        for name in names
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 4] for i in range(0, len(buttons), 4)])
@@ -0,0 +1,46 @@
+"""tariff expires at
+
+Revision ID: 5d21a8c4f0e3
+Revises: b0cf64c260c7
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d21a8c4f0e3'
+down_revision: Union[str, None] = 'b0cf64c260c7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# длительность тарифов — как в User.tariff_expires() до этой ревизии
+DURATIONS = {'БМ': 1, 'РМ': 1, 'БГ': 12, 'РГ': 12}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('tariff_expires_at', sa.DateTime(), nullable=True))
+    op.add_column('users', sa.Column('expiry_notified', sa.Boolean(), server_default=sa.text('false'), nullable=False))
+    op.create_index(op.f('ix_users_tariff_expires_at'), 'users', ['tariff_expires_at'], unique=False)
+
+    # заполняем срок для уже оплаченных тарифов: first_request + длительность
+    bind = op.get_bind()
+    for code, months in DURATIONS.items():
+        if bind.dialect.name == 'sqlite':
+            expires = f"datetime(first_request, '+{months} months')"
+        else:
+            expires = f"first_request + interval '{months} months'"
+        op.execute(sa.text(
+            f'UPDATE users SET tariff_expires_at = {expires} WHERE tariff_paid AND tariff = :code'
+        ).bindparams(code=code))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_users_tariff_expires_at'), table_name='users')
+    op.drop_column('users', 'expiry_notified')
+    op.drop_column('users', 'tariff_expires_at')
@@ -0,0 +1,41 @@
+"""update journal
+
+Revision ID: c3e91d7a5b40
+Revises: 8a4f6e2b9c17
+Create Date: 2026-10-18 14:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e91d7a5b40'
+down_revision: Union[str, None] = '8a4f6e2b9c17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('update_journal',
+    sa.Column('update_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('received_at', sa.DateTime(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('done_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('update_id')
+    )
+    op.create_index(op.f('ix_update_journal_done_at'), 'update_journal', ['done_at'], unique=False)
+    # частичный индекс: дренажу нужны только необработанные апдейты
+    op.create_index('ix_update_journal_pending', 'update_journal', ['update_id'], unique=False,
+                    postgresql_where=sa.text('done_at IS NULL'), sqlite_where=sa.text('done_at IS NULL'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_update_journal_pending', table_name='update_journal')
+    op.drop_index(op.f('ix_update_journal_done_at'), table_name='update_journal')
+    op.drop_table('update_journal')
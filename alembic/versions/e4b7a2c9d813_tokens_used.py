@@ -0,0 +1,37 @@
+"""tokens used
+
+Revision ID: e4b7a2c9d813
+Revises: c3e91d7a5b40
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b7a2c9d813'
+down_revision: Union[str, None] = 'c3e91d7a5b40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# тестовый доступ до этой ревизии: 35 запросов; квота в токенах — TRIAL_TOKENS
+TRIAL_REQUESTS = 35
+TRIAL_TOKENS   = 100000
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('tokens_used', sa.BigInteger(), server_default=sa.text('0'), nullable=False))
+    # пробный доступ: переносим израсходованную долю запросов в токены,
+    # чтобы исчерпавшие 35 запросов не получили квоту заново
+    op.execute(sa.text(
+        'UPDATE users SET tokens_used = usage_count * :per_request WHERE tariff = :trial AND NOT is_admin'
+    ).bindparams(per_request=-(-TRIAL_TOKENS // TRIAL_REQUESTS), trial=''))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('users', 'tokens_used')
@@ -0,0 +1,149 @@
+# answer_cache.py
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from cache import TTLCache
+from models import CachedAnswer, AsyncSessionLocal, dialect_insert
+
+_PUNCT = re.compile(r'[^\w\s]+')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_question(text: str) -> str:
+    """Вопрос без регистра, пунктуации и лишних пробелов — «одинаковые» совпадут."""
+    text = text.lower().replace('ё', 'е')
+    text = _PUNCT.sub(' ', text)
+    return _SPACE.sub(' ', text).strip()
+
+
+def cache_key(advisor: str, question: str, variant: str = '') -> str:
+    """variant — всё, от чего ещё зависит ответ: модель, версия промпта советника."""
+    raw = f'{advisor}\0{variant}\0{normalize_question(question)}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """Кэш ответов советников: LRU в памяти и (по желанию) таблица answer_cache.
+
+    Одинаковые вопросы, пришедшие пока ответ ещё генерируется,
+    ждут уже идущий запрос вместо нового вызова модели.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, persistent: bool = False, db_max: int = 50000):
+        self.ttl        = ttl
+        self.persistent = persistent
+        self.db_max     = db_max
+        self._memory    = TTLCache(maxsize, ttl)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._writes    = 0
+        self.db_hits    = 0
+        self.coalesced  = 0
+        self.computed   = 0
+
+    async def get_or_compute(self, advisor: str, question: str, compute, variant: str = '') -> tuple[str, bool]:
+        """Возвращает (ответ, взят_ли_из_кэша); compute — корутина-функция без аргументов."""
+        key = cache_key(advisor, question, variant)
+
+        answer = self._memory.get(key)
+        if answer is not None:
+            return answer, True
+
+        waiting = self._inflight.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            return await asyncio.shield(waiting), True
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            answer = await self._load(key)
+            if answer is not None:
+                self.db_hits += 1
+                self._memory.put(key, answer)
+                fut.set_result(answer)
+                return answer, True
+
+            self.computed += 1
+            answer = await compute()
+            self._memory.put(key, answer)
+            fut.set_result(answer)
+            await self._store(key, advisor, answer)
+            return answer, False
+        except BaseException as e:
+            if not fut.done():
+                fut.set_exception(e)
+                # ожидающие получат ту же ошибку; сами мы её уже видим
+                fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _load(self, key: str) -> str | None:
+        if not self.persistent:
+            return None
+        since = datetime.utcnow() - timedelta(seconds=self.ttl)
+        async with AsyncSessionLocal() as db:
+            return (await db.scalars(
+                select(CachedAnswer.answer)
+                .where(CachedAnswer.key == key, CachedAnswer.created_at >= since)
+            )).first()
+
+    async def _store(self, key: str, advisor: str, answer: str) -> None:
+        if not self.persistent:
+            return
+        now  = datetime.utcnow()
+        stmt = dialect_insert(CachedAnswer).values(key=key, advisor=advisor, answer=answer, created_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={'answer': answer, 'created_at': now},
+        )
+        try:
+            async with AsyncSessionLocal.begin() as db:
+                await db.execute(stmt)
+                self._writes += 1
+                if self._writes % 100 == 0:
+                    await self._prune(db, now)
+        except Exception:
+            # кэш — не повод ронять ответ пользователю
+            logging.exception('Не удалось сохранить ответ в кэш')
+
+    async def _prune(self, db, now: datetime) -> None:
+        # просроченные записи и всё сверх db_max самых свежих
+        await db.execute(
+            delete(CachedAnswer).where(CachedAnswer.created_at < now - timedelta(seconds=self.ttl))
+        )
+        keep = select(CachedAnswer.key).order_by(CachedAnswer.created_at.desc()).limit(self.db_max)
+        await db.execute(delete(CachedAnswer).where(CachedAnswer.key.not_in(keep)))
+
+    def stats(self) -> dict:
+        memory = self._memory.stats()
+        hits   = memory['hits'] + self.db_hits + self.coalesced
+        total  = hits + self.computed
+        return {
+            'memory_size': memory['size'],
+            'memory_hits': memory['hits'],
+            'db_hits':     self.db_hits,
+            'coalesced':   self.coalesced,
+            'computed':    self.computed,
+            'evictions':   memory['evictions'],
+            'hit_rate':    hits / total if total else 0.0,
+        }
+
+
+def make_answer_cache() -> AnswerCache | None:
+    """Кэш по ANSWER_CACHE (1 — включён), ANSWER_CACHE_DB — постоянный уровень."""
+    if os.environ.get('ANSWER_CACHE', '1') != '1':
+        return None
+    return AnswerCache(
+        maxsize=int(os.environ.get('ANSWER_CACHE_SIZE', 2000)),
+        ttl=float(os.environ.get('ANSWER_CACHE_TTL', 24 * 3600)),
+        persistent=os.environ.get('ANSWER_CACHE_DB', '0') == '1',
+        db_max=int(os.environ.get('ANSWER_CACHE_DB_MAX', 50000)),
+    )
@@ -0,0 +1,639 @@
+# application.py
+
+import os
+import json
+import html
+import logging
+from datetime import datetime
+from openai import AsyncOpenAI
+from telegram import Update, ReplyKeyboardMarkup
+# импорт для inline-клавиатур
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (
+    Application,
+    ApplicationHandlerStop,
+    CommandHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    ContextTypes,
+    filters,
+)
+from sqlalchemy import select
+from models import User, AsyncSessionLocal
+from entitlements import (
+    activate_tariff,
+    check_entitlement,
+    entitlement_cache,
+    load_entitlement,
+    snapshot,
+    usage_writer,
+    reconcile_tokens,
+    Entitlement,
+    TRIAL_TOKENS,
+    TRIAL_HOURS,
+    TRIAL_EXHAUSTED,
+    QUOTA_EXHAUSTED,
+    NO_TARIFF,
+    EXPIRED,
+)
+from advisors import AdvisorRegistry
+from retrieval import make_retrieval_prompts
+from answer_cache import make_answer_cache
+from chat_state import make_chat_state_store
+from memory import make_conversation_memory
+from ratelimit import RateLimiter
+from streaming import StreamingReply, reply_html
+from tg_html import markdown_to_html
+from tokens import count_message_tokens, count_tokens, truncate_tokens
+from gateway import CircuitOpen, RETRYABLE, make_gateway
+from metrics import Trace, registry
+from expiry import schedule_expiry_sweeper
+from ledger import make_usage_ledger, schedule_rollup
+from dispatch import make_update_processor
+from outbound import make_outbound_limiter
+from journal import make_update_journal
+from profiling import PROFILE_USAGE, make_profiler, parse_profile_args
+from scheduler import (
+    RequestScheduler,
+    SchedulerBusy,
+    PRIORITY_ADMIN,
+    PRIORITY_EXTENDED,
+    PRIORITY_BASIC,
+    PRIORITY_TRIAL,
+    PRIORITY_BACKGROUND,
+)
+
+# ————— Конфигурация тарифов —————
+TARIFFS = {
+    'БМ': ('Базовый на месяц',     50),
+    'БГ': ('Базовый на год',      350),
+    'РМ': ('Расширенный на месяц',300),
+    'РГ': ('Расширенный на год',  2200),
+}
+
+# Лимиты частоты сообщений по тарифу: (сообщений в минуту, запас подряд);
+# '' — тестовый доступ. Переопределяются JSON-ом в RATE_LIMITS
+RATE_LIMITS = {
+    '':   (4,  3),
+    'БМ': (6,  4),
+    'БГ': (6,  4),
+    'РМ': (12, 6),
+    'РГ': (12, 6),
+}
+
+# Настройка логирования
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# Переменные окружения
+TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
+OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
+DATABASE_URL    = os.environ['DATABASE_URL']      
+WEBHOOK_URL     = os.environ['WEBHOOK_URL']       
+PORT            = int(os.environ.get('PORT', 8443))
+# Маршрут Prometheus-метрик рядом с вебхуком; пустое значение — выключить
+METRICS_PATH    = os.environ.get('METRICS_PATH', '/metrics')
+# Сбрасывать ли апдейты, накопившиеся у Telegram, при старте (раньше — всегда)
+DROP_PENDING_UPDATES = os.environ.get('DROP_PENDING_UPDATES', '0') == '1'
+
+# Администрирование (ID с безлимитным доступом)
+ADMIN_IDS = {825403443}
+
+# Инициализация OpenAI
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Общий планировщик запросов к OpenAI: лимит параллельных вызовов,
+# ограниченная очередь ожидания и приоритет платных тарифов
+openai_scheduler = RequestScheduler(
+    max_concurrency=int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8)),
+    max_queue=int(os.environ.get('OPENAI_QUEUE_SIZE', 100)),
+    queue_timeout=float(os.environ.get('OPENAI_QUEUE_TIMEOUT', 30)),
+)
+
+# Все вызовы OpenAI — через шлюз: дедлайны, повторы, предохранитель,
+# хедж медленных запросов и выбор модели (OPENAI_MODEL, OPENAI_FAST_MODEL…)
+gateway = make_gateway(openai_client, openai_scheduler)
+
+# Ограничение частоты: на пользователя (по тарифу), на чат и общее — под квоту OpenAI.
+# При очереди к OpenAI длиннее SHED_QUEUE_DEPTH сразу отвечаем «занято»
+RATE_LIMITS.update({k: tuple(v) for k, v in json.loads(os.environ.get('RATE_LIMITS', '{}')).items()})
+rate_limiter = RateLimiter(
+    RATE_LIMITS,
+    chat_limit=(float(os.environ.get('CHAT_RATE_PER_MIN', 20)), float(os.environ.get('CHAT_RATE_BURST', 8))),
+    global_limit=(float(os.environ.get('OPENAI_RPM', 500)), float(os.environ.get('OPENAI_RPM_BURST', 50))),
+)
+SHED_QUEUE_DEPTH = int(os.environ.get('SHED_QUEUE_DEPTH', 50))
+
+# Потоковая выдача ответа: правки сообщения не чаще раза в STREAM_EDIT_INTERVAL с
+STREAM_REPLIES       = os.environ.get('STREAM_REPLIES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', 1.0))
+
+# Квоты в токенах: вопрос длиннее MAX_INPUT_TOKENS отклоняется
+# (INPUT_OVERSIZE=truncate — обрезается); до ответа резервируется оценка
+# (вопрос + промпт советника + REPLY_RESERVE_TOKENS), после — фактический расход
+MAX_INPUT_TOKENS     = int(os.environ.get('MAX_INPUT_TOKENS', 1000))
+INPUT_OVERSIZE       = os.environ.get('INPUT_OVERSIZE', 'reject')
+REPLY_RESERVE_TOKENS = int(os.environ.get('REPLY_RESERVE_TOKENS', 800))
+
+# Загрузка конфигураций советников из папки advisors
+# (изменённые файлы подхватываются без перезапуска)
+BASE_DIR = os.path.dirname(__file__)
+ADVISORS_PATH = os.path.join(BASE_DIR, 'advisors')
+advisor_registry = AdvisorRegistry(
+    ADVISORS_PATH,
+    reload_interval=float(os.environ.get('ADVISORS_RELOAD_INTERVAL', 5)),
+)
+
+# Сокращённые промпты: ядро советника плюс разделы, подходящие к вопросу
+# ("prompt_mode": "retrieval" в JSON советника или PROMPT_MODE для всех)
+retrieval_prompts = make_retrieval_prompts()
+retrieval_prompts.build(advisor_registry.get(name) for name in advisor_registry.names)
+
+# Кэш ответов советников (отключается ключом "cache": false в JSON советника)
+answer_cache = make_answer_cache()
+
+# Журнал расходов: строка на каждый ответ, в базу — пакетами вне пути запроса
+usage_ledger = make_usage_ledger()
+
+# Сжатие старой части диалога — в фоне, дешёвой моделью и с низшим приоритетом
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', 'gpt-4o-mini')
+
+async def summarize_dialog(summary: str, turns: list[tuple[str, str]]) -> str:
+    dialog = '\n'.join(f'Пользователь: {q}\nСоветник: {a}' for q, a in turns)
+    result = await gateway.complete(
+        [
+            {'role': 'system', 'content': (
+                'Сожми разговор пользователя с советником в краткую сводку: '
+                'ключевые факты о ситуации пользователя, его вопросы и данные ответы. '
+                'Не больше 150 слов.'
+            )},
+            {'role': 'user', 'content': f'Прежняя сводка:\n{summary or "—"}\n\nНовые реплики:\n{dialog}'},
+        ],
+        model=SUMMARY_MODEL,
+        priority=PRIORITY_BACKGROUND,
+    )
+    if usage_ledger:
+        usage_ledger.record(None, '_summary', result.model, result.prompt_tokens,
+                            result.completion_tokens, result.latency)
+    return result.text
+
+conversation_memory = make_conversation_memory(summarize_dialog)
+
+# Хранение текущего советника для каждого чата (память процесса или БД)
+chat_states = make_chat_state_store()
+
+# Число процессов-воркеров; апдейты раздаются по chat_id. С журналом апдейтов
+# необработанный за WORKER_ACK_TIMEOUT с апдейт берётся из журнала снова
+WORKERS            = int(os.environ.get('WORKERS', 1))
+WORKER_ACK_TIMEOUT = float(os.environ.get('WORKER_ACK_TIMEOUT', 600))
+
+# Журнал входящих апдейтов (UPDATE_JOURNAL=1): вебхук отвечает сразу после
+# записи в базу, обработка — из журнала, с повтором после перезапуска
+update_journal = make_update_journal()
+
+# Профилирование по команде /profile: в обычной работе хэндлеры не обёрнуты
+profiler = make_profiler()
+
+# ————— Метрики: значения читаются только при запросе /metrics —————
+registry.gauge('openai_active', lambda: openai_scheduler.active, 'Запросов к OpenAI в работе')
+registry.gauge('openai_queue_depth', lambda: openai_scheduler.queue_depth, 'Запросов в очереди к OpenAI')
+registry.gauge('openai_hedge_wins_total', lambda: gateway.hedge_wins,
+               'Хеджирующий запрос ответил первым', kind='counter')
+registry.gauge('openai_breaker_trips_total',
+               lambda: {(('model', m),): b.trips for m, b in gateway._breakers.items()},
+               'Срабатывания предохранителя по моделям', kind='counter')
+registry.gauge('rate_limited_total',
+               lambda: {(('reason', r),): n for r, n in rate_limiter.rejected.items()},
+               'Сообщений отклонено ограничителем частоты', kind='counter')
+registry.gauge('entitlement_cache_hits_total', lambda: entitlement_cache.hits,
+               'Попадания в кэш прав', kind='counter')
+registry.gauge('entitlement_cache_misses_total', lambda: entitlement_cache.misses,
+               'Промахи кэша прав', kind='counter')
+if answer_cache:
+    registry.gauge('answer_cache_total',
+                   lambda: {(('result', k),): v for k, v in answer_cache.stats().items()
+                            if k in ('memory_hits', 'db_hits', 'coalesced', 'computed')},
+                   'Ответы из кэша (memory_hits, db_hits, coalesced) и вычисленные', kind='counter')
+if update_journal:
+    registry.gauge('journal_in_flight', lambda: update_journal.in_flight, 'Апдейтов из журнала в обработке')
+if conversation_memory:
+    registry.gauge('memory_chats', lambda: len(conversation_memory), 'Диалогов в памяти')
+
+# Лимиты и оплата
+
+def request_priority(user: Entitlement) -> int:
+    """Приоритет запроса к OpenAI по тарифу пользователя."""
+    if user.is_admin:
+        return PRIORITY_ADMIN
+    if user.tariff in ('РМ', 'РГ'):
+        return PRIORITY_EXTENDED
+    if user.tariff in ('БМ', 'БГ'):
+        return PRIORITY_BASIC
+    return PRIORITY_TRIAL
+
+async def prompt_payment(update: Update) -> None:
+    text = (
+        f'⚠️ Тестовый доступ истёк: израсходовано {TRIAL_TOKENS // 1000} тыс. токенов или прошло {TRIAL_HOURS} часов.\n'
+        'Пожалуйста, выберите тариф для продолжения:'
+    )
+    keyboard = [['7 дней — 300₽', '30 дней — 800₽']]
+    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await update.message.reply_text(text, reply_markup=markup)
+
+def usage_footer(ent: Entitlement, delta: int = 0, truncated: bool = False) -> str:
+    """Остаток под ответом: токены квоты и срок (тестовый доступ — часы, тариф — дата)."""
+    if ent.is_admin:
+        return ''
+    left   = f'{max(0, ent.tokens_left - delta):,}'.replace(',', ' ')
+    footer = f"\n\n🔎 Осталось токенов: {left}"
+    if not ent.tariff:
+        elapsed = datetime.utcnow() - ent.first_request
+        footer += f"  ⏳ Осталось времени: {TRIAL_HOURS - elapsed.total_seconds() / 3600:.1f} ч"
+    elif ent.expires:
+        footer += f"  ⏳ Тариф до {ent.expires:%d.%m.%Y}"
+    if truncated:
+        footer += f"\n✂️ Вопрос сокращён до {MAX_INPUT_TOKENS} токенов"
+    return footer
+
+# Команда /start
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    welcome_text = (
+        "Приветствую тебя, живая Душа!\n"
+        "Мы — Ваши верные Советники и всегда готовы помочь в решении жизненных задач."
+        " Наша миссия — предоставить знания и ответы на любые твои вопросы,"
+        " касающиеся различных сфер жизни: Авторское право, Банк, Буквица, Вексель, Транспорт, ЖКХ,"
+        " Каноны, КОБ и ДОТУ, Община / Родовые Союзы, Познай-Я, Почта, РодОМ, Суверенитет, Суд, ЗАГС, Траст.\n\n"
+        "Чтобы задать свой вопрос, выбери Советника по Имени, соответствующему его знаниям в этой сфере."
+        " Советник предоставит ответ в соответствии с его Базой знаний и всегда руководствуется принципами справедливости и этической нравственности.\n\n"
+        f"Сейчас у тебя бесплатный тестовый доступ: {TRIAL_TOKENS // 1000} тыс. токенов или 168 часов (7 дней)."
+        " После окончания тестового периода ты сможешь перейти на расширенный режим.\n\n"
+        "Приятного и продуктивного общения!"
+    )
+    markup = advisor_registry.start_keyboard()
+    await update.message.reply_text(welcome_text, reply_markup=markup)
+
+# Защита от флуда — выполняется до handle_message (группа -1)
+async def rate_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    # тариф — из последнего известного снимка, без похода в базу и без учёта в метриках кэша;
+    # снимка нет — лимит пользователя остаётся прежним
+    ent     = entitlement_cache.peek(user_id, stale=True)
+    if user_id in ADMIN_IDS or ent and ent.is_admin:
+        return
+    # смена советника не идёт в OpenAI — общий лимит и очередь её не касаются
+    costly = update.message.text.strip() not in advisor_registry
+
+    if costly and openai_scheduler.queue_depth >= SHED_QUEUE_DEPTH:
+        await update.message.reply_text('⏳ Сейчас очень много запросов. Пожалуйста, повторите через минуту.')
+        raise ApplicationHandlerStop
+
+    if rate_limiter.check(user_id, update.effective_chat.id, ent.tariff if ent else None, costly):
+        if rate_limiter.should_notify(user_id):
+            await update.message.reply_text('🐢 Слишком много сообщений подряд. Подождите немного и повторите вопрос.')
+        raise ApplicationHandlerStop
+
+# Обработка текстовых сообщений
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    text = update.message.text.strip()
+    trace = Trace(chat_id=chat_id)
+
+    # Смена Советника — не считаем за запрос
+    with trace.span('chat_state'):
+        current = await chat_states.get(chat_id)
+    switching = text in advisor_registry and current != text
+
+    # Если советник не выбран
+    if not switching and current is None:
+        await update.message.reply_text('Пожалуйста, сначала выберите Советника через /start')
+        return
+
+    reserve   = 0
+    truncated = False
+    if not switching:
+        advisor = advisor_registry.get(current)
+        if advisor is None:
+            # файл советника удалён — просим выбрать заново
+            await chat_states.delete(chat_id)
+            await update.message.reply_text('Пожалуйста, сначала выберите Советника через /start')
+            return
+        # ————— длинный вопрос не доходит до модели целиком —————
+        input_tokens = count_tokens(text)
+        if input_tokens > MAX_INPUT_TOKENS:
+            if INPUT_OVERSIZE != 'truncate':
+                return await update.message.reply_text(
+                    f'✂️ Вопрос слишком длинный ({input_tokens} токенов, можно до {MAX_INPUT_TOKENS}).'
+                    ' Пожалуйста, сократите его или разбейте на части.'
+                )
+            text, input_tokens, truncated = truncate_tokens(text, MAX_INPUT_TOKENS), MAX_INPUT_TOKENS, True
+        # запрос собираем до проверки доступа и резервируем его настоящий размер — с историей
+        # и сводкой диалога и разделами промпта; после ответа поправим на фактический расход
+        with trace.span('prompt'):
+            system_prompt = retrieval_prompts.system_prompt(advisor, text)
+            history  = conversation_memory.history(chat_id, current) if conversation_memory else []
+            messages = [
+                {'role': 'system', 'content': system_prompt},
+                *history,
+                {'role': 'user',   'content': text}
+            ]
+            system_tokens = (advisor.prompt_tokens if system_prompt is advisor.system_prompt
+                             else count_tokens(system_prompt))
+            reserve = system_tokens + count_message_tokens(history) + input_tokens + REPLY_RESERVE_TOKENS
+
+    # ————— одна атомарная проверка: квота, оплата, срок, счётчик —————
+    with trace.span('entitlement'):
+        ent = await check_entitlement(user_id, admin=(user_id in ADMIN_IDS), billable=not switching,
+                                      tokens=reserve)
+    if ent.status == TRIAL_EXHAUSTED:
+        # бесплатный лимит упёрся — просим оплатить
+        await prompt_payment(update)
+        return
+    if ent.status == QUOTA_EXHAUSTED:
+        return await update.message.reply_text(
+            "Квота токенов по вашему тарифу исчерпана. Продлить тариф можно через /tariff"
+        )
+    if ent.status == NO_TARIFF:
+        return await update.message.reply_text(
+            "У вас нет активного тарифа. Выберите /tariff и дождитесь подтверждения оплаты."
+        )
+    if ent.status == EXPIRED:
+        return await update.message.reply_text("Срок вашего тарифа истёк. Повторите выбор /tariff")
+    # —————————————————————————————————————
+
+    if switching:
+        # ————— для «базового» тарифа проверяем список выбранных советников —————
+        if ent.tariff in ('БМ','БГ') and text not in ent.advisors:
+            return await update.message.reply_text(
+                "Этот советник не входит в ваш пакет. Сначала выберите /advisors"
+            )
+        # ———————————————————————————————————————————————————————————————
+        await chat_states.set(chat_id, text)
+        # подтверждение и приветствие из JSON — одним сообщением
+        reply = f'👋 Теперь вы общаетесь с Советником: <b>{html.escape(text)}</b>'
+        welcome_msg = advisor_registry.get(text).get('welcome')
+        if welcome_msg:
+            reply += '\n\n' + html.escape(welcome_msg)
+        await reply_html(update.message, reply)
+        return
+
+    # Основная логика: запрос к OpenAI
+    stream_reply = None
+    model    = gateway.route(advisor, ent.tariff, text)
+    priority = request_priority(ent)
+    reserved = 0 if ent.is_admin else reserve
+    spent    = 0
+
+    def account(result) -> None:
+        nonlocal spent
+        spent += result.prompt_tokens + result.completion_tokens
+        trace.record('openai_queue', result.queue_wait)
+        trace.record('openai_first_token', result.first_token)
+        trace.record('openai_total', result.latency)
+        for kind, n in (('prompt', result.prompt_tokens), ('completion', result.completion_tokens)):
+            registry.inc('openai_tokens_total', n, 'Токены OpenAI по советникам',
+                         advisor=current, model=result.model, kind=kind)
+        if usage_ledger:
+            usage_ledger.record(user_id, current, result.model, result.prompt_tokens,
+                                result.completion_tokens, result.latency)
+
+    async def ask_openai() -> str:
+        nonlocal stream_reply
+        if not STREAM_REPLIES:
+            result = await gateway.complete(messages, model, priority)
+            account(result)
+            return result.text
+
+        # показываем ответ по мере генерации; заглушка видна и пока запрос в очереди
+        stream_reply = StreamingReply(update.message, STREAM_EDIT_INTERVAL)
+        await stream_reply.start()
+        stream = gateway.stream(messages, model, priority)
+        async for delta in stream:
+            await stream_reply.feed(delta)
+        account(stream.result)
+        return stream.result.text
+
+    async def report(error: str) -> None:
+        if stream_reply:
+            await stream_reply.fail(error)
+        else:
+            await update.message.reply_text(error)
+
+    try:
+        # одинаковые вопросы к одному советнику — из кэша или из уже идущего запроса;
+        # продолжение разговора зависит от истории, его не кэшируем
+        if answer_cache and advisor.get('cache', True) and not history:
+            # ответ другой модели или прежней версии промпта не подходит
+            variant = f'{model}\0{advisor.mtime}\0{retrieval_prompts.mode(advisor)}'
+            reply, from_cache = await answer_cache.get_or_compute(current, text, ask_openai, variant)
+            if from_cache and usage_ledger:
+                usage_ledger.record(user_id, current, model, cached=True)
+        else:
+            reply = await ask_openai()
+        if conversation_memory:
+            conversation_memory.append(chat_id, current, text, reply)
+        # остаток квоты — по снимку из проверки с поправкой на фактический расход
+        footer = usage_footer(ent, spent - reserved, truncated)
+
+        # отправляем ответ + footer
+        if stream_reply:
+            await stream_reply.finish(footer)
+            trace.record('telegram_send', stream_reply.send_seconds)
+        else:
+            # Markdown модели — в HTML Telegram; длинный ответ режем по лимиту
+            with trace.span('telegram_send'):
+                await reply_html(update.message, markdown_to_html(reply) + footer)
+        trace.finish()
+    except SchedulerBusy:
+        trace.finish('busy')
+        await report('⏳ Сейчас очень много запросов. Пожалуйста, повторите через минуту.')
+    except CircuitOpen:
+        trace.finish('circuit_open')
+        await report('🛠 Советник временно недоступен. Пожалуйста, повторите вопрос через пару минут.')
+    except RETRYABLE as e:
+        trace.finish('error')
+        registry.inc('errors_total', help='Ошибки по типам', type=type(e).__name__)
+        logging.warning('OpenAI не ответил после повторов (чат %s)', chat_id)
+        await report('⏳ Советник не успел ответить. Пожалуйста, повторите вопрос.')
+    except Exception as e:
+        trace.finish('error')
+        registry.inc('errors_total', help='Ошибки по типам', type=type(e).__name__)
+        logging.exception('Ошибка при запросе к OpenAI')
+        await report('❌ Не удалось получить ответ. Пожалуйста, повторите вопрос позже.')
+    finally:
+        # ответ из кэша и ошибки возвращают резерв целиком
+        if reserved:
+            await reconcile_tokens(user_id, spent - reserved)
+
+
+# ————— Новый хэндлер выбора тарифа —————
+# Клавиатура тарифов не меняется — собираем один раз
+TARIFF_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton(f"{name} — {price}₽", callback_data=f"tariff|{code}")
+        for code,(name,price) in list(TARIFFS.items())[i:i + 2]
+    ]
+    for i in range(0, len(TARIFFS), 2)
+])
+
+async def cmd_tariff(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+     await update.message.reply_text("Выберите тариф:", reply_markup=TARIFF_KEYBOARD)
+
+async def on_tariff_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+     cq   = update.callback_query
+     code = cq.data.split('|',1)[1]
+     async with AsyncSessionLocal.begin() as db:
+         user = (await db.scalars(select(User).filter_by(user_id=cq.from_user.id))).first()
+         if not user:
+             return await cq.answer("Сначала отправьте /start.", show_alert=True)
+         user.tariff      = code
+         user.tariff_paid = False
+         user.advisors    = []
+         # срок появится при подтверждении оплаты (/activate)
+         user.tariff_expires_at = None
+         user.expiry_notified   = False
+     # сразу обновляем кэш прав — следующий запрос увидит новый тариф
+     snapshot(user)
+     await cq.answer(f"Выбран тариф «{TARIFFS[code][0]}». Ожидайте подтверждения оплаты.")
+# —————————————————————————————————————
+
+# Подтверждение оплаты администратором: /activate <user_id> <код тарифа>
+async def cmd_activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+     if update.effective_user.id not in ADMIN_IDS:
+         return
+     try:
+         user_id, code = int(context.args[0]), context.args[1]
+     except (IndexError, ValueError):
+         return await update.message.reply_text("Использование: /activate <user_id> <БМ|БГ|РМ|РГ>")
+     if code not in TARIFFS:
+         return await update.message.reply_text(f"Неизвестный тариф: {code}")
+     ent = await activate_tariff(user_id, code)
+     if ent is None:
+         return await update.message.reply_text("Пользователь не найден.")
+     until = f"{ent.expires:%d.%m.%Y %H:%M}"
+     await update.message.reply_text(f"Тариф «{TARIFFS[code][0]}» для {user_id} активен до {until} (UTC).")
+     try:
+         await context.bot.send_message(user_id, f"✅ Оплата подтверждена. Тариф «{TARIFFS[code][0]}» действует до {until} (UTC).")
+     except Exception:
+         logging.warning('Не удалось уведомить пользователя %s об активации', user_id)
+
+# Профилирование по запросу администратора: /profile [N | Ns] [sample=…] [top=…] [nocpu] | status | stop
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    action = context.args[0].lower() if context.args else ''
+    if action == 'status':
+        return await update.message.reply_text(profiler.status())
+    if action == 'stop':
+        # отчёт придёт отдельными сообщениями
+        if not await profiler.stop():
+            await update.message.reply_text(profiler.status())
+        return
+    try:
+        options = parse_profile_args(context.args)
+    except ValueError:
+        return await update.message.reply_text(PROFILE_USAGE)
+    if not profiler.start(context.application, update.effective_chat.id, exclude=(cmd_profile,), **options):
+        return await update.message.reply_text("Профилирование уже идёт: /profile status или /profile stop.")
+    await update.message.reply_text(f"{profiler.status()}. Отчёт придёт по окончании.")
+
+async def cmd_advisors(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+     user = await load_entitlement(update.effective_user.id)
+     if not user or user.tariff not in ('БМ','БГ'):
+         return await update.message.reply_text("У вас расширенный пакет — доступны все советники.")
+     kb = advisor_registry.advisors_keyboard(user.advisors)
+     await update.message.reply_text("Выберите до двух советников:", reply_markup=kb)
+
+async def on_adv_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+     cq   = update.callback_query
+     name = cq.data.split('|',1)[1]
+     async with AsyncSessionLocal.begin() as db:
+         user = (await db.scalars(
+             select(User).filter_by(user_id=cq.from_user.id).with_for_update()
+         )).first()
+         if not user:
+             return await cq.answer("Сначала отправьте /start.", show_alert=True)
+         # JSON-колонку присваиваем заново, иначе изменение списка не сохранится
+         advisors = list(user.advisors)
+         if name in advisors:
+             advisors.remove(name)
+         else:
+             if len(advisors) >= 2:
+                 return await cq.answer("Нельзя выбрать более двух.", show_alert=True)
+             advisors.append(name)
+         user.advisors = advisors
+     snapshot(user)
+     await cq.answer(f"Текущий выбор: {', '.join(user.advisors) or '—'}")
+# —————————————————————————————————————
+
+# Обработчик ошибок
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    registry.inc('errors_total', help='Ошибки по типам', type=type(context.error).__name__)
+    logging.error('Ошибка при обработке запроса', exc_info=context.error)
+
+# Фоновые задачи процесса: запуск и остановка вместе с приложением
+async def start_background(app: Application) -> None:
+    if usage_writer:
+        await usage_writer.start()
+    if usage_ledger:
+        await usage_ledger.start()
+
+async def stop_background(app: Application) -> None:
+    # при остановке дописываем накопленные счётчики и журнал
+    if usage_writer:
+        await usage_writer.stop()
+    if usage_ledger:
+        await usage_ledger.stop()
+
+# Удаление старого вебхука при старте; накопленные апдейты не теряем
+async def on_front_startup(app: Application) -> None:
+    await app.bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+    # проверка сроков тарифов — в одном процессе (приёмнике вебхука)
+    schedule_expiry_sweeper(app)
+    schedule_rollup(app)
+
+# Один процесс: он же и обрабатывает сообщения — запускаем и фоновую запись
+async def on_startup(app: Application) -> None:
+    await on_front_startup(app)
+    await start_background(app)
+
+# Сборка приложения со всеми хэндлерами
+def build_application(webhook: bool = True, request=None) -> Application:
+    builder = Application.builder().token(TELEGRAM_TOKEN).post_shutdown(stop_background)
+    if request is not None:
+        # свой транспорт к Bot API (нагрузочные прогоны в bench/)
+        builder = builder.request(request).get_updates_request(request)
+    if webhook:
+        builder = builder.post_init(on_startup)
+    else:
+        # воркер получает апдейты от процесса-приёмника
+        builder = builder.updater(None).post_init(start_background)
+    # исходящие — под лимиты Telegram: общий, на чат, с учётом retry_after
+    outbound = make_outbound_limiter()
+    if outbound:
+        builder = builder.rate_limiter(outbound)
+        registry.gauge('telegram_queue_depth', lambda: outbound.queue_depth,
+                       'Исходящих запросов в очереди')
+    # разные чаты — параллельно, внутри чата — по порядку; кнопки и команды — без очереди
+    processor = make_update_processor()
+    if processor:
+        builder = builder.concurrent_updates(processor)
+        registry.gauge('updates_in_progress', lambda: processor.running,
+                       'Апдейтов в обработке')
+        registry.gauge('chats_in_progress', lambda: processor.waiting_chats,
+                       'Чатов с апдейтами в обработке или в очереди')
+    app = builder.build()
+
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, rate_guard), group=-1)
+    app.add_handler(CommandHandler('start', start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_error_handler(error_handler)
+    # Регистрация новых хэндлеров
+    app.add_handler(CommandHandler('tariff', cmd_tariff))
+    # ловим колбэк от inline-кнопки «tariff|…»
+    app.add_handler(CallbackQueryHandler(on_tariff_chosen, pattern=r'^tariff\|'))
+    app.add_handler(CommandHandler('advisors', cmd_advisors))
+    app.add_handler(CommandHandler('activate', cmd_activate))
+    app.add_handler(CommandHandler('profile', cmd_profile))
+    # ловим колбэк от inline-кнопки «adv|…»
+    app.add_handler(CallbackQueryHandler(on_adv_choice,   pattern=r'^adv\|'))
+    return app
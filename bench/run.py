@@ -0,0 +1,321 @@
+# bench/run.py
+#
+# Сквозной нагрузочный прогон: синтетические апдейты Telegram идут через
+# настоящие хэндлеры application.build_application(), Bot API подменён локальным
+# транспортом, OpenAI — заглушкой bench/stub_openai.py, база — SQLite
+# (или локальный Postgres через --database-url).
+#
+#   python bench/run.py --users 200 --questions 5 --concurrency 50 --output bench.json
+#
+# Итог — JSON: пропускная способность, p50/p95/p99 по типам апдейтов,
+# обращения к БД на сообщение, пиковая память.
+#
+# Апдейты подаются прямо в Application.process_update: очередь апдейтов,
+# процессор с порядком по чатам (dispatch.py), вебхук и журнал апдейтов
+# в замер не входят.
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=5, help='вопросов на пользователя')
+    parser.add_argument('--concurrency', type=int, default=50, help='одновременно обрабатываемых апдейтов')
+    parser.add_argument('--repeat-share', type=float, default=0.2, help='доля повторяющихся вопросов')
+    parser.add_argument('--database-url', default=None, help='по умолчанию — временный SQLite')
+    parser.add_argument('--openai-url', default=None, help='внешняя заглушка; по умолчанию поднимается в процессе')
+    parser.add_argument('--openai-latency', type=float, default=0.2)
+    parser.add_argument('--openai-chunks', type=int, default=40)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--stub-port', type=int, default=8999)
+    parser.add_argument('--tracemalloc', action='store_true', help='пик памяти Python (медленнее)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='-', help='файл для JSON, «-» — stdout')
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+BENCH_DB = None
+if not ARGS.database_url:
+    BENCH_DB = os.path.join(tempfile.mkdtemp(prefix='djanis-bench-'), 'bench.db')
+
+# окружение — до импорта бота: он читает настройки при импорте
+os.environ.update({
+    'TELEGRAM_TOKEN': '123456:BENCH',
+    'OPENAI_API_KEY': 'bench',
+    'WEBHOOK_URL':    'https://bench.invalid',
+    'DATABASE_URL':   ARGS.database_url or f'sqlite:///{BENCH_DB}',
+    'OPENAI_BASE_URL': ARGS.openai_url or f'http://127.0.0.1:{ARGS.stub_port}/v1',
+})
+# лимиты частоты не должны обрезать синтетическую нагрузку
+for key, value in {
+    'RATE_LIMITS':       json.dumps({'': [1e6, 1e6]}),
+    'CHAT_RATE_PER_MIN': '1000000',
+    'CHAT_RATE_BURST':   '1000000',
+    'OPENAI_RPM':        '1000000',
+    'OPENAI_RPM_BURST':  '1000000',
+    'SHED_QUEUE_DEPTH':  '1000000',
+    'OPENAI_QUEUE_SIZE': '1000000',
+}.items():
+    os.environ.setdefault(key, value)
+
+from sqlalchemy import event  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import application  # noqa: E402
+import models  # noqa: E402
+from metrics import registry  # noqa: E402
+from stub_openai import StubConfig, make_app  # noqa: E402
+
+current_kind = contextvars.ContextVar('current_kind', default='background')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeBotAPI(BaseRequest):
+    """Транспорт Bot API без сети: отвечает правдоподобными JSON и считает вызовы."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency    = latency
+        self.calls      = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        name   = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name == 'getMe':
+            result = BOT_USER
+        elif name in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            result = {
+                'message_id': params.get('message_id') or self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+# ————— синтетические апдейты —————
+class UpdateFactory:
+    def __init__(self):
+        self._update_id  = 0
+        self._message_id = 0
+
+    def _next(self) -> tuple[int, int]:
+        self._update_id  += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id, message_id = self._next()
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id, message_id = self._next()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'Выберите тариф:',
+            },
+        }}
+
+
+QUESTIONS = (
+    'Как правильно составить заявление?',
+    'Что делать, если пришёл штраф?',
+    'Какие документы нужны для обращения?',
+    'Как оспорить начисление?',
+)
+
+
+def scenario(user_id: int, factory: UpdateFactory, advisors: list[str], rnd: random.Random) -> list[tuple[str, dict]]:
+    """Путь одного пользователя: /start, выбор советника, вопросы, тариф, выбор советников."""
+    advisor = rnd.choice(advisors)
+    steps = [
+        ('start', factory.message(user_id, '/start')),
+        ('advisor', factory.message(user_id, advisor)),
+    ]
+    for i in range(ARGS.questions):
+        if rnd.random() < ARGS.repeat_share:
+            question = rnd.choice(QUESTIONS)
+        else:
+            question = f'Вопрос {i} пользователя {user_id}: как решить мою ситуацию?'
+        steps.append(('question', factory.message(user_id, question)))
+    steps.append(('tariff', factory.callback(user_id, 'tariff|БМ')))
+    steps.append(('adv', factory.callback(user_id, f'adv|{advisor}')))
+    return steps
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values: list[float]) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(max(values, default=0) * 1000, 2),
+    }
+
+
+async def main() -> dict:
+    rnd = random.Random(ARGS.seed)
+    models.engine.echo = False
+    models.Base.metadata.create_all(models.engine)
+
+    # обращения к БД: и асинхронный движок бота, и синхронный
+    # тип апдейта — через contextvar: коммит сессии SQLAlchemy идёт в отдельной задаче
+    db_calls = Counter()
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        db_calls[current_kind.get()] += 1
+
+    for eng in (models.engine, models.async_engine.sync_engine):
+        event.listen(eng, 'before_cursor_execute', count_query)
+
+    stub = None
+    if not ARGS.openai_url:
+        stub_config = StubConfig(latency=ARGS.openai_latency, jitter=ARGS.openai_latency / 4,
+                                 chunks=ARGS.openai_chunks, error_rate=ARGS.openai_error_rate)
+        stub = make_app(stub_config).listen(ARGS.stub_port, '127.0.0.1')
+
+    api = FakeBotAPI(ARGS.telegram_latency)
+    app = application.build_application(webhook=False, request=api)
+    await app.initialize()
+    await application.start_background(app)
+
+    factory  = UpdateFactory()
+    advisors = list(application.advisor_registry.names)
+    queues   = [scenario(1000 + n, factory, advisors, rnd) for n in range(ARGS.users)]
+    latency: dict[str, list[float]] = defaultdict(list)
+    errors   = Counter()
+    sem      = asyncio.Semaphore(ARGS.concurrency)
+
+    # апдейты одного пользователя — по порядку, пользователи — параллельно
+    async def run_user(steps):
+        for kind, raw in steps:
+            async with sem:
+                update = Update.de_json(raw, app.bot)
+                current_kind.set(kind)
+                started = time.perf_counter()
+                try:
+                    await app.process_update(update)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                latency[kind].append(time.perf_counter() - started)
+
+    # ошибки хэндлеров process_update не пробрасывает — их считают хэндлеры и error_handler бота
+    errors_before   = registry.counter('errors_total')
+    outcomes_before = registry.snapshot('message_seconds')
+    if ARGS.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(steps) for steps in queues))
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if ARGS.tracemalloc else None
+    if ARGS.tracemalloc:
+        tracemalloc.stop()
+
+    for key, n in registry.counter('errors_total').items():
+        if n > errors_before.get(key, 0):
+            errors[dict(key).get('type', '?')] += int(n - errors_before.get(key, 0))
+    # чем закончились вопросы: ok, busy, circuit_open, error
+    outcomes = Counter()
+    for key, (count, *_) in registry.snapshot('message_seconds').items():
+        outcomes[dict(key).get('outcome', '?')] += count - outcomes_before.get(key, (0,))[0]
+
+    await application.stop_background(app)
+    await app.shutdown()
+    if stub is not None:
+        stub.stop()
+
+    total    = sum(len(v) for v in latency.values())
+    rss_kb   = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'config': {k: v for k, v in vars(ARGS).items() if k != 'output'},
+        'path': 'Application.process_update directly: no update processor, webhook or journal',
+        'database': models.async_engine.dialect.name,
+        'updates': total,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_ups': round(total / elapsed, 2) if elapsed else 0.0,
+        'latency': {'all': summary([x for v in latency.values() for x in v]),
+                    **{k: summary(v) for k, v in latency.items()}},
+        'db_queries': dict(db_calls),
+        'db_queries_per_update': round(sum(db_calls.values()) / total, 3) if total else 0.0,
+        'db_queries_per_question': round(db_calls['question'] / len(latency['question']), 3)
+                                   if latency['question'] else 0.0,
+        'telegram_calls': dict(api.calls),
+        'openai_requests': stub_config.requests if stub is not None else None,
+        'errors': dict(errors),
+        'outcomes': {k: v for k, v in outcomes.items() if v},
+        'peak_rss_mb': round(rss_kb / 1024, 1),
+        'peak_traced_mb': round(traced_peak / 2 ** 20, 1) if traced_peak is not None else None,
+    }
+
+
+if __name__ == '__main__':
+    report = json.dumps(asyncio.run(main()), ensure_ascii=False, indent=2)
+    if ARGS.output == '-':
+        print(report)
+    else:
+        with open(ARGS.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
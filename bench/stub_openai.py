@@ -0,0 +1,114 @@
+# bench/stub_openai.py
+#
+# Локальная заглушка OpenAI Chat Completions для нагрузочных прогонов и
+# проверки шлюза: задержка первого токена, скорость выдачи, доля ошибок.
+#
+#   python bench/stub_openai.py --port 8999 --latency 0.5 --error-rate 0.05
+#   OPENAI_BASE_URL=http://127.0.0.1:8999/v1 python bot.py
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import tornado.web
+
+
+class StubConfig:
+    def __init__(self, latency=0.3, jitter=0.1, chunks=40, chunk_delay=0.01,
+                 error_rate=0.0, slow_rate=0.0, slow_latency=5.0):
+        self.latency      = latency
+        self.jitter       = jitter
+        self.chunks       = chunks
+        self.chunk_delay  = chunk_delay
+        self.error_rate   = error_rate
+        self.slow_rate    = slow_rate
+        self.slow_latency = slow_latency
+        self.requests     = 0
+        self.errors       = 0
+
+
+ANSWER_WORDS = (
+    'Советник', 'отвечает', 'на', 'ваш', 'вопрос', '—', 'это', 'тестовый', 'ответ',
+    'заглушки', 'с', '**выделением**', 'и', 'списком:', '\n•', 'пункт', 'первый', '\n•', 'пункт', 'второй',
+)
+
+
+class CompletionsHandler(tornado.web.RequestHandler):
+    def initialize(self, config: StubConfig):
+        self.config = config
+
+    async def post(self):
+        cfg  = self.config
+        body = json.loads(self.request.body or b'{}')
+        cfg.requests += 1
+
+        delay = cfg.slow_latency if random.random() < cfg.slow_rate else cfg.latency
+        await asyncio.sleep(max(0.0, delay + random.uniform(-cfg.jitter, cfg.jitter)))
+        if random.random() < cfg.error_rate:
+            cfg.errors += 1
+            self.set_status(503)
+            self.write({'error': {'message': 'stub overloaded', 'type': 'server_error'}})
+            return
+
+        model  = body.get('model', 'gpt-4o')
+        prompt = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 3
+        words  = [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(cfg.chunks)]
+        cid    = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+        usage  = {'prompt_tokens': prompt, 'completion_tokens': len(words), 'total_tokens': prompt + len(words)}
+
+        if not body.get('stream'):
+            self.write({
+                'id': cid, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                'usage': usage,
+            })
+            return
+
+        self.set_header('Content-Type', 'text/event-stream')
+        for i, word in enumerate(words):
+            chunk = {
+                'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            }
+            self.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            await self.flush()
+            if cfg.chunk_delay:
+                await asyncio.sleep(cfg.chunk_delay)
+        if (body.get('stream_options') or {}).get('include_usage'):
+            tail = {'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': model, 'choices': [], 'usage': usage}
+            self.write(f'data: {json.dumps(tail)}\n\n')
+        self.write('data: [DONE]\n\n')
+
+
+def make_app(config: StubConfig) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r'/v1/chat/completions', CompletionsHandler, {'config': config}),
+    ])
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Заглушка OpenAI Chat Completions')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--latency', type=float, default=0.3, help='задержка до первого токена, с')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--chunks', type=int, default=40, help='фрагментов в ответе')
+    parser.add_argument('--chunk-delay', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='доля медленных ответов')
+    parser.add_argument('--slow-latency', type=float, default=5.0)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.jitter, args.chunks, args.chunk_delay,
+                        args.error_rate, args.slow_rate, args.slow_latency)
+    make_app(config).listen(args.port, '127.0.0.1')
+    print(f'Заглушка OpenAI: http://127.0.0.1:{args.port}/v1')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+# chat_state.py
+
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import delete, select
+
+from models import ChatState, AsyncSessionLocal, dialect_insert
+
+
+class ChatStateStore(ABC):
+    """Где хранится выбранный советник каждого чата."""
+
+    @abstractmethod
+    async def get(self, chat_id: int) -> str | None:
+        ...
+
+    @abstractmethod
+    async def set(self, chat_id: int, advisor: str) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, chat_id: int) -> None:
+        ...
+
+
+class MemoryChatStateStore(ChatStateStore):
+    """В памяти процесса: LRU с ограничением размера и вытеснением простаивающих чатов."""
+
+    def __init__(self, maxsize: int = 50000, idle_ttl: float = 7 * 24 * 3600):
+        self.maxsize  = maxsize
+        self.idle_ttl = idle_ttl
+        # порядок — от давно не активных к свежим
+        self._data: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    async def get(self, chat_id: int) -> str | None:
+        item = self._data.get(chat_id)
+        if item is None:
+            return None
+        advisor, seen = item
+        now = time.monotonic()
+        if now - seen > self.idle_ttl:
+            del self._data[chat_id]
+            return None
+        self._data[chat_id] = (advisor, now)
+        self._data.move_to_end(chat_id)
+        return advisor
+
+    async def set(self, chat_id: int, advisor: str) -> None:
+        now = time.monotonic()
+        self._data[chat_id] = (advisor, now)
+        self._data.move_to_end(chat_id)
+        self._evict(now)
+
+    async def delete(self, chat_id: int) -> None:
+        self._data.pop(chat_id, None)
+
+    def _evict(self, now: float) -> None:
+        while self._data:
+            chat_id, (_, seen) = next(iter(self._data.items()))
+            if len(self._data) <= self.maxsize and now - seen <= self.idle_ttl:
+                break
+            del self._data[chat_id]
+
+
+class DatabaseChatStateStore(ChatStateStore):
+    """В таблице chat_states — переживает рестарт и видна всем процессам."""
+
+    async def get(self, chat_id: int) -> str | None:
+        async with AsyncSessionLocal() as db:
+            return (await db.scalars(
+                select(ChatState.advisor).where(ChatState.chat_id == chat_id)
+            )).first()
+
+    async def set(self, chat_id: int, advisor: str) -> None:
+        now = datetime.utcnow()
+        stmt = dialect_insert(ChatState).values(chat_id=chat_id, advisor=advisor, updated_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['chat_id'],
+            set_={'advisor': advisor, 'updated_at': now},
+        )
+        async with AsyncSessionLocal.begin() as db:
+            await db.execute(stmt)
+
+    async def delete(self, chat_id: int) -> None:
+        async with AsyncSessionLocal.begin() as db:
+            await db.execute(delete(ChatState).where(ChatState.chat_id == chat_id))
+
+
+def make_chat_state_store() -> ChatStateStore:
+    """Хранилище по CHAT_STATE_BACKEND: memory (по умолчанию) или database."""
+    backend = os.environ.get('CHAT_STATE_BACKEND', 'memory')
+    if backend == 'database':
+        return DatabaseChatStateStore()
+    if backend == 'memory':
+        return MemoryChatStateStore(
+            maxsize=int(os.environ.get('CHAT_STATE_MAX', 50000)),
+            idle_ttl=float(os.environ.get('CHAT_STATE_IDLE', 7 * 24 * 3600)),
+        )
+    raise ValueError(f'Неизвестный CHAT_STATE_BACKEND: {backend}')
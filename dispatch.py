@@ -0,0 +1,115 @@
+# dispatch.py
+
+import asyncio
+import os
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def is_fast(update: object) -> bool:
+    """Быстрые апдейты: нажатия кнопок и команды — они не ходят в OpenAI."""
+    if not isinstance(update, Update):
+        return True
+    if update.callback_query is not None:
+        return True
+    message = update.message
+    return bool(message and message.text and message.text.startswith('/'))
+
+
+def chat_key(update: object) -> int | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных чатов с порядком внутри чата.
+
+    Обычные сообщения одного чата выстраиваются в цепочку: следующее
+    начинается только после предыдущего, поэтому смену советника не
+    обгонит вопрос, отправленный за ней. Слот из workers занимается уже
+    после ожидания своей очереди — флуд одного чата не забирает слоты
+    у остальных. Команды и нажатия кнопок идут по отдельной быстрой
+    полосе (fast_lane слотов) мимо длинных запросов.
+
+    Семафор PTB (max_concurrent_updates = backlog) ограничивает только
+    число принятых апдейтов, включая ждущих в цепочках.
+    """
+
+    __slots__ = ('_fast', '_slots', '_tails', 'running')
+
+    def __init__(self, workers: int, fast_lane: int = 8, backlog: int = 1024):
+        super().__init__(max(backlog, workers + fast_lane))
+        self._fast  = asyncio.BoundedSemaphore(fast_lane)
+        self._slots = asyncio.BoundedSemaphore(workers)
+        self._tails: dict[int, asyncio.Future] = {}
+        self.running = 0                       # апдейтов, уже занявших слот
+
+    @property
+    def waiting_chats(self) -> int:
+        return len(self._tails)
+
+    async def _run(self, semaphore: asyncio.BoundedSemaphore, coroutine: Awaitable[Any]) -> None:
+        try:
+            await semaphore.acquire()
+        except asyncio.CancelledError:
+            # отменены до начала — корутина так и не будет запущена
+            coroutine.close()
+            raise
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            semaphore.release()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = chat_key(update)
+        if key is None or is_fast(update):
+            await self._run(self._fast, coroutine)
+            return
+
+        # до первого await — очередь чата пополняется строго в порядке поступления
+        prev = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda f: self._tails.get(key) is f and self._tails.pop(key))
+        self._tails[key] = done
+        try:
+            if prev is not None:
+                try:
+                    await asyncio.shield(prev)
+                except asyncio.CancelledError:
+                    coroutine.close()
+                    raise
+            await self._run(self._slots, coroutine)
+        finally:
+            if prev is not None and not prev.done():
+                # нас отменили в ожидании — следующий всё равно ждёт предыдущего
+                prev.add_done_callback(lambda _: done.done() or done.set_result(None))
+            elif not done.done():
+                done.set_result(None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def make_update_processor() -> ChatOrderedUpdateProcessor | None:
+    """UPDATE_CONCURRENCY апдейтов одновременно (1 — строго по очереди, как раньше);
+    UPDATE_BACKLOG — сколько апдейтов принимается в обработку вместе с ждущими."""
+    workers = int(os.environ.get('UPDATE_CONCURRENCY', 32))
+    if workers <= 1:
+        return None
+    return ChatOrderedUpdateProcessor(
+        workers,
+        fast_lane=int(os.environ.get('UPDATE_FAST_LANE', 8)),
+        backlog=int(os.environ.get('UPDATE_BACKLOG', 1024)),
+    )
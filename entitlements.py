@@ -0,0 +1,336 @@
+# entitlements.py
+
+import logging
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, or_, select, update
+
+from cache import TTLCache
+from usage_writer import make_usage_writer
+from models import User, AsyncSessionLocal, dialect_insert, TARIFF_DURATIONS
+
+# Тестовый доступ: TRIAL_TOKENS токенов или 168 часов
+TRIAL_TOKENS = int(os.environ.get('TRIAL_TOKENS', 100000))
+TRIAL_HOURS  = 168
+
+
+def _parse_quotas(spec: str) -> dict[str, int]:
+    # «БМ=1000000,РМ=3000000» — переопределение квот из окружения
+    return {code.strip(): int(n) for code, n in (item.split('=') for item in spec.split(',') if item.strip())}
+
+
+# Квоты токенов (запрос + ответ) на срок тарифа; пустой код — тестовый доступ
+TOKEN_QUOTAS = {
+    '':   TRIAL_TOKENS,
+    'БМ': 1000000,
+    'БГ': 12000000,
+    'РМ': 3000000,
+    'РГ': 36000000,
+    **_parse_quotas(os.environ.get('TOKEN_QUOTAS', '')),
+}
+
+# Итог проверки доступа
+OK              = 'ok'
+TRIAL_EXHAUSTED = 'trial_exhausted'
+QUOTA_EXHAUSTED = 'quota_exhausted'
+NO_TARIFF       = 'no_tariff'
+EXPIRED         = 'expired'
+
+
+@dataclass
+class Entitlement:
+    """Снимок прав пользователя после проверки — всё, что нужно хэндлеру и футеру."""
+    status:        str
+    is_admin:      bool = False
+    tariff:        str = ''
+    tariff_paid:   bool = False
+    advisors:      list = field(default_factory=list)
+    usage_count:   int = 0
+    tokens_used:   int = 0
+    first_request: datetime | None = None
+    last_request:  datetime | None = None
+    expires:       datetime | None = None
+
+    @property
+    def allowed(self) -> bool:
+        return self.status == OK
+
+    @property
+    def quota(self) -> int:
+        return token_quota(self.tariff)
+
+    @property
+    def tokens_left(self) -> int:
+        return max(0, self.quota - self.tokens_used)
+
+
+def token_quota(tariff: str) -> int:
+    return TOKEN_QUOTAS.get(tariff or '', TRIAL_TOKENS)
+
+
+# Снимки прав по user_id: тариф и советники меняются редко,
+# колбэки и проверка срока обновляют кэш сразу (write-through)
+entitlement_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60)),
+)
+
+# Отложенная запись счётчиков (USAGE_WRITE_BEHIND=1): записанные пачкой
+# пользователи выбрасываются из кэша, чтобы снимок не учёл дельту дважды
+usage_writer = make_usage_writer()
+if usage_writer:
+    usage_writer.on_flush = lambda uids: [entitlement_cache.invalidate(uid) for uid in uids]
+
+# Без отложенной записи небольшая поправка резерва (до RECONCILE_SLACK токенов)
+# не пишется отдельным UPDATE: копится в памяти процесса и уходит в базу
+# вместе со следующим резервом этого пользователя
+RECONCILE_SLACK = int(os.environ.get('RECONCILE_SLACK', 1000))
+_carry: dict[int, int] = {}
+
+
+def snapshot(user: User, status: str = OK) -> Entitlement:
+    """Снимок записи пользователя; заодно кладёт его в кэш."""
+    ent = Entitlement(
+        status=status,
+        is_admin=user.is_admin,
+        tariff=user.tariff,
+        tariff_paid=user.tariff_paid,
+        advisors=list(user.advisors or []),
+        usage_count=user.usage_count,
+        tokens_used=user.tokens_used,
+        first_request=user.first_request,
+        last_request=user.last_request,
+        expires=user.tariff_expires(),
+    )
+    entitlement_cache.put(user.user_id, ent)
+    return ent
+
+
+def evaluate(ent: Entitlement, now: datetime) -> str:
+    """Статус доступа по снимку, без обращения к базе."""
+    if not ent.tariff_paid:
+        return NO_TARIFF
+    if not ent.is_admin and ent.tokens_used >= ent.quota:
+        return QUOTA_EXHAUSTED if ent.tariff else TRIAL_EXHAUSTED
+    if not ent.is_admin and not ent.tariff and now - ent.last_request >= timedelta(hours=TRIAL_HOURS):
+        return TRIAL_EXHAUSTED
+    if ent.expires and ent.expires < now:
+        return EXPIRED
+    return OK
+
+
+def _quota_open(now: datetime):
+    # квота токенов по тарифу, у тестового доступа — ещё и срок; админам без ограничений
+    return or_(
+        User.is_admin,
+        and_(
+            User.tokens_used < case(TOKEN_QUOTAS, value=User.tariff, else_=TRIAL_TOKENS),
+            or_(User.tariff != '', User.last_request >= now - timedelta(hours=TRIAL_HOURS)),
+        ),
+    )
+
+
+async def _consume(db, user_id: int, now: datetime, tokens: int) -> User | None:
+    # списываем запрос и резервируем токены, только если квота ещё не исчерпана
+    return (await db.scalars(
+        update(User)
+        .where(User.user_id == user_id, User.tariff_paid, _quota_open(now))
+        .values(
+            usage_count=User.usage_count + case((User.is_admin, 0), else_=1),
+            tokens_used=case(
+                (User.is_admin, User.tokens_used),
+                # с возвратом из отложенной поправки сумма может уйти в минус
+                (User.tokens_used + tokens < 0, 0),
+                else_=User.tokens_used + tokens,
+            ),
+            # сброс таймера при первом запросе после оплаты
+            first_request=case(
+                (User.last_request < User.first_request, now),
+                else_=User.first_request,
+            ),
+            last_request=now,
+        )
+        .returning(User)
+    )).first()
+
+
+async def check_entitlement(user_id: int, admin: bool = False, billable: bool = True,
+                            tokens: int = 0) -> Entitlement:
+    """Одна транзакция на сообщение: квота, тариф, срок действия и счётчик.
+
+    Для платного запроса счётчик увеличивается, а tokens (оценка расхода)
+    резервируются условным UPDATE … RETURNING, поэтому одновременные
+    сообщения одного пользователя не обходят квоту. После ответа резерв
+    поправляется на фактический расход (reconcile_tokens; небольшая
+    поправка уходит со следующим резервом). Отказы и бесплатные действия
+    решаются по кэшу без похода в базу.
+    """
+    now = datetime.utcnow()
+    if usage_writer and billable:
+        return await _check_write_behind(user_id, admin, now, tokens)
+
+    cached = entitlement_cache.get(user_id)
+    if cached is not None:
+        status = evaluate(cached, now)
+        # истечение срока нужно записать в базу, поэтому идёт дальше
+        if status in (NO_TARIFF, TRIAL_EXHAUSTED, QUOTA_EXHAUSTED) or (status == OK and not billable):
+            return replace(cached, status=status)
+
+    # отложенная поправка резерва уходит тем же UPDATE; не списали — вернём её
+    carry = _carry.pop(user_id, 0) if billable else 0
+    try:
+        async with AsyncSessionLocal.begin() as db:
+            user = await _consume(db, user_id, now, tokens + carry) if billable else None
+            if user is not None:
+                carry = 0
+
+            if user is None:
+                # новый пользователь — создаём запись, если её ещё нет
+                user = (await db.scalars(
+                    dialect_insert(User)
+                    .values(
+                        user_id=user_id,
+                        usage_count=1 if billable else 0,
+                        tokens_used=tokens if billable and not admin else 0,
+                        first_request=now,
+                        last_request=now,
+                        is_admin=admin,
+                        tariff_paid=True,
+                    )
+                    .on_conflict_do_nothing(index_elements=['user_id'])
+                    .returning(User)
+                )).first()
+                if user is not None:
+                    return snapshot(user)
+
+                # запись уже есть (или её только что создал параллельный запрос)
+                if billable:
+                    user = await _consume(db, user_id, now, tokens + carry)
+                    if user is not None:
+                        carry = 0
+                if user is None:
+                    user = (await db.scalars(select(User).filter_by(user_id=user_id))).first()
+                    if not user.tariff_paid:
+                        return snapshot(user, NO_TARIFF)
+                    status = evaluate(snapshot(user), now)
+                    if status in (TRIAL_EXHAUSTED, QUOTA_EXHAUSTED):
+                        return snapshot(user, status)
+                    if billable:
+                        return snapshot(user, TRIAL_EXHAUSTED)
+
+            # ————— проверяем срок действия —————
+            expires = user.tariff_expires()
+            if expires and expires < now:
+                await db.execute(
+                    update(User).where(User.user_id == user_id).values(tariff_paid=False)
+                )
+                user.tariff_paid = False
+                return snapshot(user, EXPIRED)
+
+            return snapshot(user)
+    finally:
+        if carry:
+            _carry[user_id] = _carry.get(user_id, 0) + carry
+
+
+async def _check_write_behind(user_id: int, admin: bool, now: datetime, tokens: int) -> Entitlement:
+    # снимок из кэша или базы; если за время чтения записалась пачка —
+    # снимок мог уже включить дельты, читаем заново
+    while True:
+        epoch = usage_writer.epoch
+        ent = entitlement_cache.get(user_id)
+        if ent is None:
+            ent = await check_entitlement(user_id, admin, billable=False)
+        if epoch == usage_writer.epoch:
+            break
+
+    inc, last, spent = usage_writer.pending(user_id)
+    ent = replace(
+        ent,
+        usage_count=ent.usage_count + inc,
+        tokens_used=max(0, ent.tokens_used + spent),
+        last_request=max(ent.last_request, last) if last else ent.last_request,
+    )
+    ent.status = evaluate(ent, now)
+    if ent.status == EXPIRED:
+        # срок вышел — записываем сразу, это редкий путь
+        return await check_entitlement(user_id, admin, billable=False)
+    if ent.status == OK and not ent.is_admin:
+        # между проверкой и записью дельты нет await — параллельные
+        # сообщения этого процесса не проскочат лимит
+        usage_writer.add(user_id, now, tokens=tokens)
+        ent.usage_count += 1
+        ent.tokens_used += tokens
+    return ent
+
+
+async def reconcile_tokens(user_id: int, delta: int) -> None:
+    """Поправка резерва на фактический расход после ответа (delta < 0 — возврат)."""
+    if not delta:
+        return
+    if usage_writer:
+        usage_writer.add(user_id, datetime.utcnow(), inc=0, tokens=delta)
+        return
+    delta += _carry.pop(user_id, 0)
+    if abs(delta) <= RECONCILE_SLACK:
+        # отдельный UPDATE не нужен — допишется следующим резервом
+        _carry[user_id] = delta
+        return
+    used = User.tokens_used + delta
+    try:
+        async with AsyncSessionLocal.begin() as db:
+            user = (await db.scalars(
+                update(User)
+                .where(User.user_id == user_id)
+                # тариф могли активировать между резервом и ответом — ниже нуля не уходим
+                .values(tokens_used=case((used < 0, 0), else_=used))
+                .returning(User)
+            )).first()
+    except Exception:
+        # расход останется по резерву — это оценка сверху
+        logging.exception('Не удалось поправить расход токенов пользователя %s', user_id)
+        return
+    if user is not None:
+        snapshot(user)
+
+
+async def activate_tariff(user_id: int, code: str, now: datetime | None = None) -> Entitlement | None:
+    """Оплата подтверждена: тариф включается, срок записывается в tariff_expires_at."""
+    now = now or datetime.utcnow()
+    # пока идёт сброс квоты, пачки счётчиков не пишутся: уже отправленная
+    # дописывается до него, несписанный расход прошлого срока забывается
+    async with usage_writer.paused() if usage_writer else nullcontext():
+        async with AsyncSessionLocal.begin() as db:
+            user = (await db.scalars(
+                update(User)
+                .where(User.user_id == user_id)
+                .values(
+                    tariff=code,
+                    tariff_paid=True,
+                    # отсчёт срока — с момента активации, как раньше от first_request
+                    first_request=now,
+                    tariff_expires_at=now + TARIFF_DURATIONS[code],
+                    expiry_notified=False,
+                    # квота токенов — на новый срок
+                    tokens_used=0,
+                )
+                .returning(User)
+            )).first()
+        if usage_writer:
+            usage_writer.discard_tokens(user_id)
+    # поправки резерва прошлого срока к новой квоте не относятся
+    _carry.pop(user_id, None)
+    return snapshot(user) if user else None
+
+
+async def load_entitlement(user_id: int) -> Entitlement | None:
+    """Снимок прав для команд и колбэков: из кэша, иначе одно чтение из базы."""
+    cached = entitlement_cache.get(user_id)
+    if cached is not None:
+        return cached
+    async with AsyncSessionLocal() as db:
+        user = (await db.scalars(select(User).filter_by(user_id=user_id))).first()
+    return snapshot(user) if user else None
@@ -0,0 +1,143 @@
+# expiry.py
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from telegram import Bot
+from telegram.error import Forbidden, BadRequest, RetryAfter
+from telegram.ext import Application, ContextTypes
+
+from entitlements import entitlement_cache
+from metrics import registry
+from outbound import BULK, rate_limit_kwargs
+from models import User, AsyncSessionLocal, tariff_expires_expr, tariff_expires_within
+from streaming import retry_delay
+
+EXPIRED_TEXT  = 'Срок вашего тарифа истёк. Чтобы продолжить, выберите /tariff'
+EXPIRING_TEXT = '⏳ Ваш тариф действует до {date:%d.%m.%Y %H:%M} (UTC). Продлить можно через /tariff'
+
+
+class ExpirySweeper:
+    """Фоновая проверка сроков тарифов по индексу users.tariff_expires_at.
+
+    Тарифы, выставленные прямо в базе (tariff_expires_at пуст), истекают
+    по first_request + длительность, как до появления срока в таблице.
+
+    Истёкшие тарифы отключаются пачками UPDATE … RETURNING (по batch_size
+    строк на транзакцию), тем, у кого срок кончается в ближайшие
+    notice_before, один раз отправляется предупреждение. Уведомления
+    уходят не быстрее send_rate сообщений в секунду.
+    """
+
+    def __init__(self, batch_size: int = 500, notice_before: timedelta | None = timedelta(days=3),
+                 send_rate: int = 25):
+        self.batch_size    = batch_size
+        self.notice_before = notice_before
+        self.send_rate     = send_rate
+
+    async def _claim(self, where, values: dict) -> list[tuple[int, datetime]]:
+        # строки выбираем по индексу и обновляем одним запросом;
+        # RETURNING отдаёт только те, что изменили именно мы
+        ids = select(User.id).where(*where).order_by(tariff_expires_expr()).limit(self.batch_size)
+        async with AsyncSessionLocal.begin() as db:
+            rows = await db.execute(
+                update(User)
+                .where(User.id.in_(ids.scalar_subquery()))
+                .values(**values)
+                .returning(User.user_id, tariff_expires_expr())
+                .execution_options(synchronize_session=False)
+            )
+            return [tuple(row) for row in rows]
+
+    async def expire(self, now: datetime) -> list[int]:
+        expired = []
+        while True:
+            rows = await self._claim(
+                (User.tariff_paid, tariff_expires_within(now)),
+                {'tariff_paid': False},
+            )
+            expired += [uid for uid, _ in rows]
+            if len(rows) < self.batch_size:
+                return expired
+
+    async def expiring(self, now: datetime) -> list[tuple[int, datetime]]:
+        if not self.notice_before:
+            return []
+        soon = []
+        while True:
+            rows = await self._claim(
+                (
+                    User.tariff_paid,
+                    ~User.expiry_notified,
+                    tariff_expires_within(now + self.notice_before, since=now),
+                ),
+                {'expiry_notified': True},
+            )
+            soon += rows
+            if len(rows) < self.batch_size:
+                return soon
+
+    async def sweep(self, bot: Bot, now: datetime | None = None) -> tuple[int, int]:
+        now     = now or datetime.utcnow()
+        expired = await self.expire(now)
+        for uid in expired:
+            entitlement_cache.invalidate(uid)
+        soon = await self.expiring(now)
+
+        await self.notify(bot, [(uid, EXPIRED_TEXT) for uid in expired])
+        await self.notify(bot, [(uid, EXPIRING_TEXT.format(date=date)) for uid, date in soon])
+        registry.inc('tariffs_expired_total', len(expired), 'Тарифы, отключённые фоновой проверкой')
+        registry.inc('expiry_notices_total', len(soon), 'Предупреждения о скором окончании тарифа')
+        if expired or soon:
+            logging.info('Сроки тарифов: отключено %s, предупреждено %s', len(expired), len(soon))
+        return len(expired), len(soon)
+
+    async def notify(self, bot: Bot, messages: list[tuple[int, str]]) -> None:
+        # пачками по send_rate в секунду — под лимит рассылки Telegram
+        for i in range(0, len(messages), self.send_rate):
+            started = asyncio.get_running_loop().time()
+            await asyncio.gather(*(self._send(bot, uid, text) for uid, text in messages[i:i + self.send_rate]))
+            if i + self.send_rate < len(messages):
+                await asyncio.sleep(max(0.0, 1.0 - (asyncio.get_running_loop().time() - started)))
+
+    async def _send(self, bot: Bot, chat_id: int, text: str) -> None:
+        for _ in range(3):
+            try:
+                # рассылка уступает очередь ответам пользователям
+                await bot.send_message(chat_id, text, **rate_limit_kwargs(bot, BULK))
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(retry_delay(e))
+            except (Forbidden, BadRequest):
+                # пользователь заблокировал бота или чата больше нет
+                return
+            except Exception:
+                logging.exception('Не удалось отправить уведомление о тарифе %s', chat_id)
+                return
+
+    async def job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            await self.sweep(context.bot)
+        except Exception:
+            logging.exception('Фоновая проверка сроков тарифов не удалась')
+
+
+def schedule_expiry_sweeper(app: Application) -> ExpirySweeper | None:
+    """Регистрирует проверку в JobQueue: раз в EXPIRY_SWEEP_INTERVAL секунд (0 — выключена)."""
+    interval = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', 300))
+    if not interval:
+        return None
+    if app.job_queue is None:
+        logging.warning('JobQueue недоступна (нужен python-telegram-bot[job-queue]) — сроки тарифов проверяются только при сообщениях')
+        return None
+    notice_hours = float(os.environ.get('EXPIRY_NOTICE_HOURS', 72))
+    sweeper = ExpirySweeper(
+        batch_size=int(os.environ.get('EXPIRY_BATCH', 500)),
+        notice_before=timedelta(hours=notice_hours) if notice_hours else None,
+        send_rate=int(os.environ.get('EXPIRY_SEND_RATE', 25)),
+    )
+    app.job_queue.run_repeating(sweeper.job, interval=interval, first=10, name='expiry_sweeper')
+    return sweeper
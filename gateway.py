@@ -0,0 +1,363 @@
+# gateway.py
+
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+
+import openai
+
+from scheduler import RequestScheduler, PRIORITY_TRIAL
+
+# Ошибки, после которых имеет смысл повторить запрос
+RETRYABLE = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpen(Exception):
+    """Модель временно отключена предохранителем — запрос не отправлялся."""
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии ошибок или медленных ответов модель
+    отключается на cooldown секунд, затем пропускается один пробный запрос."""
+
+    def __init__(self, failures: int = 5, slow_seconds: float = 30.0, slow_calls: int = 5,
+                 cooldown: float = 30.0):
+        self.failures     = failures
+        self.slow_seconds = slow_seconds
+        self.slow_calls   = slow_calls
+        self.cooldown     = cooldown
+        self._errors      = 0
+        self._slow        = 0
+        self._opened_at: float | None = None
+        self._probing     = False
+        self._probe_at    = 0.0
+        self.trips        = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        # пробный запрос, не вернувший ни успеха, ни сбоя, не блокирует навсегда
+        if state == 'half_open' and (not self._probing or time.monotonic() - self._probe_at >= self.cooldown):
+            self._probing, self._probe_at = True, time.monotonic()
+            return True
+        return False
+
+    def success(self, latency: float, started: float) -> None:
+        """started — момент отправки запроса (time.monotonic())."""
+        self._errors = 0
+        self._slow   = self._slow + 1 if latency >= self.slow_seconds else 0
+        if self._slow >= self.slow_calls:
+            self._trip()
+        # замыкает только пробный запрос: запоздалый успех начатого до срабатывания не в счёт
+        elif self._probing and started >= self._probe_at:
+            self._opened_at, self._probing = None, False
+
+    def failure(self) -> None:
+        self._errors += 1
+        if self._errors >= self.failures or self._probing:
+            self._trip()
+
+    def _trip(self) -> None:
+        if self._opened_at is None or self._probing:
+            self.trips += 1
+            logging.warning('Предохранитель OpenAI сработал')
+        self._opened_at = time.monotonic()
+        self._probing   = False
+        self._errors = self._slow = 0
+
+
+@dataclass
+class Completion:
+    """Итог вызова модели: текст, модель, токены и задержки."""
+    text:               str = ''
+    model:              str = ''
+    prompt_tokens:      int = 0
+    completion_tokens:  int = 0
+    latency:            float = 0.0
+    first_token:        float = 0.0
+    queue_wait:         float = 0.0
+    retries:            int = 0
+
+
+def _delta(chunk) -> str:
+    if chunk.choices and chunk.choices[0].delta.content:
+        return chunk.choices[0].delta.content
+    return ''
+
+
+class CompletionGateway:
+    """Единая точка вызова OpenAI.
+
+    Очередь и приоритеты — через RequestScheduler; на каждый вызов дедлайн,
+    повторы с экспоненциальной задержкой и джиттером, предохранитель на
+    модель, необязательный хедж (второй запрос, если первый долго молчит)
+    и выбор модели по советнику, тарифу и длине вопроса.
+    """
+
+    def __init__(self, client, scheduler: RequestScheduler, model: str = 'gpt-4o',
+                 fast_model: str | None = None, trial_model: str | None = None,
+                 fallback_model: str | None = None, short_question: int = 0,
+                 deadline: float = 120.0, first_token_timeout: float = 30.0,
+                 retries: int = 2, backoff: float = 0.5, backoff_max: float = 8.0,
+                 hedge_delay: float = 0.0, breaker: dict | None = None):
+        self.client              = client
+        self.scheduler           = scheduler
+        self.model               = model
+        self.fast_model          = fast_model
+        self.trial_model         = trial_model
+        self.fallback_model      = fallback_model
+        self.short_question      = short_question
+        self.deadline            = deadline
+        self.first_token_timeout = first_token_timeout
+        self.retries             = retries
+        self.backoff             = backoff
+        self.backoff_max         = backoff_max
+        self.hedge_delay         = hedge_delay
+        self._breaker_opts       = breaker or {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self.hedge_wins          = 0
+
+    # ————— выбор модели —————
+    def route(self, advisor=None, tariff: str = '', question: str = '') -> str:
+        if advisor is not None and advisor.get('model'):
+            return advisor.get('model')
+        if self.fast_model and self.short_question and len(question) <= self.short_question:
+            return self.fast_model
+        if self.trial_model and tariff == '':
+            return self.trial_model
+        return self.model
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(**self._breaker_opts)
+        return self._breakers[model]
+
+    def _pick(self, model: str) -> str:
+        # основная модель отключена — идём в запасную, если она задана
+        if self.breaker(model).allow():
+            return model
+        if self.fallback_model and self.fallback_model != model and self.breaker(self.fallback_model).allow():
+            return self.fallback_model
+        raise CircuitOpen(model)
+
+    def _delay(self, attempt: int) -> float:
+        # «полный джиттер»: случайная пауза до экспоненциальной границы
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    # ————— обычный вызов —————
+    async def complete(self, messages: list[dict], model: str | None = None,
+                       priority: int = PRIORITY_TRIAL) -> Completion:
+        model = model or self.model
+        for attempt in range(self.retries + 1):
+            current = self._pick(model)
+            queued  = time.monotonic()
+            try:
+                async with self.scheduler.slot(priority):
+                    started = time.monotonic()
+                    result  = await self._hedged(lambda: self._call(current, messages))
+            except RETRYABLE as e:
+                self.breaker(current).failure()
+                if attempt >= self.retries:
+                    raise
+                logging.warning('OpenAI: %s, повтор %s', type(e).__name__, attempt + 1)
+                await asyncio.sleep(self._delay(attempt))
+                continue
+            result.latency = result.first_token = time.monotonic() - started
+            result.queue_wait = started - queued
+            result.retries = attempt
+            self.breaker(current).success(result.latency, started)
+            return result
+
+    async def _call(self, model: str, messages: list[dict]) -> Completion:
+        response = await asyncio.wait_for(
+            self.client.chat.completions.create(model=model, messages=messages),
+            self.deadline,
+        )
+        usage = response.usage
+        return Completion(
+            text=response.choices[0].message.content or '',
+            model=model,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+        )
+
+    async def _hedged(self, make):
+        """Если первый запрос не ответил за hedge_delay — запускаем второй, берём первый успешный."""
+        primary = asyncio.ensure_future(make())
+        if not self.hedge_delay:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+        if done or not self.scheduler.try_acquire():
+            return await primary
+
+        hedge = asyncio.ensure_future(make())
+        tasks, winner = (primary, hedge), None
+        try:
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if not t.exception()), None)
+            if winner is None:
+                return primary.result()
+            if winner is hedge:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            self.scheduler.release()
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and not task.exception():
+                    # проигравший успел открыть поток — закрываем соединение
+                    result = task.result()
+                    if isinstance(result, tuple):
+                        await result[0].close()
+
+    # ————— потоковый вызов —————
+    def stream(self, messages: list[dict], model: str | None = None,
+               priority: int = PRIORITY_TRIAL) -> 'CompletionStream':
+        return CompletionStream(self, messages, model or self.model, priority)
+
+    async def _open_stream(self, model: str, messages: list[dict]):
+        """Открывает поток и дожидается первого непустого фрагмента."""
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={'include_usage': True},
+            timeout=self.deadline,
+        )
+        it, head = stream.__aiter__(), []
+        try:
+            while True:
+                chunk = await asyncio.wait_for(it.__anext__(), self.first_token_timeout)
+                head.append(chunk)
+                if _delta(chunk):
+                    return stream, it, head
+        except StopAsyncIteration:
+            return stream, it, head
+        except BaseException:
+            await stream.close()
+            raise
+
+
+class CompletionStream:
+    """Асинхронный поток фрагментов ответа; после обхода заполнен .result.
+
+    Повторы и хедж работают только до первого фрагмента — начатый
+    у пользователя ответ не переигрывается.
+    """
+
+    def __init__(self, gateway: CompletionGateway, messages: list[dict], model: str, priority: int):
+        self._gw       = gateway
+        self._messages = messages
+        self._model    = model
+        self._priority = priority
+        self.result    = Completion(model=model)
+
+    async def __aiter__(self):
+        gw, result = self._gw, self.result
+        # слот планировщика — на каждую попытку, пауза перед повтором его не держит;
+        # после открытия потока слот занят до конца ответа
+        for attempt in range(gw.retries + 1):
+            current = gw._pick(self._model)
+            queued  = time.monotonic()
+            await gw.scheduler.acquire(self._priority)
+            started = time.monotonic()
+            try:
+                stream, it, head = await gw._hedged(
+                    lambda: gw._open_stream(current, self._messages)
+                )
+                break
+            except RETRYABLE as e:
+                gw.scheduler.release()
+                gw.breaker(current).failure()
+                if attempt >= gw.retries:
+                    raise
+                logging.warning('OpenAI: %s, повтор %s', type(e).__name__, attempt + 1)
+                await asyncio.sleep(gw._delay(attempt))
+            except BaseException:
+                gw.scheduler.release()
+                raise
+        try:
+            # время в очереди планировщика — отдельно от времени OpenAI
+            result.queue_wait = started - queued
+            result.model, result.retries = current, attempt
+            result.first_token = time.monotonic() - started
+
+            parts = []
+            try:
+                async def chunks():
+                    for chunk in head:
+                        yield chunk
+                    # дедлайн — на весь вызов: медленно капающий поток тоже упрётся в него
+                    deadline = started + gw.deadline
+                    while True:
+                        try:
+                            yield await asyncio.wait_for(it.__anext__(), max(0.0, deadline - time.monotonic()))
+                        except StopAsyncIteration:
+                            return
+                async for chunk in chunks():
+                    if chunk.usage:
+                        result.prompt_tokens     = chunk.usage.prompt_tokens
+                        result.completion_tokens = chunk.usage.completion_tokens
+                    delta = _delta(chunk)
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+            except RETRYABLE:
+                gw.breaker(current).failure()
+                raise
+            finally:
+                await stream.close()
+            result.text    = ''.join(parts)
+            result.latency = time.monotonic() - started
+            gw.breaker(current).success(result.first_token, started)
+        finally:
+            gw.scheduler.release()
+
+
+def make_gateway(client, scheduler: RequestScheduler) -> CompletionGateway:
+    """Шлюз с настройками из окружения (OPENAI_MODEL, OPENAI_RETRIES, OPENAI_HEDGE_DELAY…)."""
+    env = os.environ.get
+    return CompletionGateway(
+        client,
+        scheduler,
+        model=env('OPENAI_MODEL', 'gpt-4o'),
+        fast_model=env('OPENAI_FAST_MODEL') or None,
+        trial_model=env('OPENAI_TRIAL_MODEL') or None,
+        fallback_model=env('OPENAI_FALLBACK_MODEL') or None,
+        short_question=int(env('OPENAI_SHORT_QUESTION_CHARS', 0)),
+        deadline=float(env('OPENAI_DEADLINE', 120)),
+        first_token_timeout=float(env('OPENAI_FIRST_TOKEN_TIMEOUT', 30)),
+        retries=int(env('OPENAI_RETRIES', 2)),
+        backoff=float(env('OPENAI_BACKOFF', 0.5)),
+        backoff_max=float(env('OPENAI_BACKOFF_MAX', 8)),
+        hedge_delay=float(env('OPENAI_HEDGE_DELAY', 0)),
+        breaker=dict(
+            failures=int(env('OPENAI_BREAKER_FAILURES', 5)),
+            slow_seconds=float(env('OPENAI_BREAKER_SLOW_SECONDS', 30)),
+            slow_calls=int(env('OPENAI_BREAKER_SLOW_CALLS', 5)),
+            cooldown=float(env('OPENAI_BREAKER_COOLDOWN', 30)),
+        ),
+    )
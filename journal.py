@@ -0,0 +1,223 @@
+# journal.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, or_, select, update
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import registry
+from models import JournaledUpdate, async_engine, dialect_insert
+
+_journal = JournaledUpdate.__table__
+
+
+class UpdateJournal:
+    """Журнал входящих апдейтов в базе.
+
+    Вебхук только дописывает апдейт (append) и сразу отвечает Telegram;
+    записи одновременных запросов уходят одним INSERT. Повтор с тем же
+    update_id отбрасывается по первичному ключу. Дренаж читает
+    необработанные апдейты по порядку update_id, отдаёт их процессору
+    апдейтов приложения (не больше max_in_flight одновременно) и после
+    обработки отмечает done_at. Всё, что не отмечено к перезапуску,
+    обрабатывается заново; апдейт, на котором процесс падал max_attempts
+    раз, больше не берётся.
+    """
+
+    def __init__(self, batch_size: int = 100, max_in_flight: int = 256, max_attempts: int = 3,
+                 retention: timedelta = timedelta(days=1), poll_interval: float = 5.0,
+                 stop_timeout: float = 10.0):
+        self.batch_size    = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_attempts  = max_attempts
+        self.retention     = retention
+        self.poll_interval = poll_interval
+        self.stop_timeout  = stop_timeout
+        self._queue: list[tuple[int, str, asyncio.Future]] = []
+        self._writer: asyncio.Task | None = None
+        self._wake     = asyncio.Event()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._done: list[int] = []
+        self._retry: set[int] = set()
+        self._app: Application | None = None
+        self._task: asyncio.Task | None = None
+        self._pruned_at = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    # ————— запись —————
+    async def append(self, update_id: int, payload: str) -> bool:
+        """Записывает апдейт; False — такой update_id уже есть. Ошибка базы — исключение."""
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((update_id, payload, fut))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write())
+        return await fut
+
+    async def _write(self) -> None:
+        # пока идёт один INSERT, новые апдейты копятся и уходят следующим
+        while self._queue:
+            batch, self._queue = self._queue, []
+            now  = datetime.utcnow()
+            rows = {}
+            for update_id, payload, _ in batch:
+                rows.setdefault(update_id, {'update_id': update_id, 'payload': payload,
+                                            'received_at': now, 'attempts': 0})
+            try:
+                async with async_engine.begin() as conn:
+                    result = await conn.execute(
+                        dialect_insert(JournaledUpdate)
+                        .on_conflict_do_nothing(index_elements=['update_id'])
+                        .returning(JournaledUpdate.update_id),
+                        list(rows.values()),
+                    )
+                    new = set(result.scalars())
+            except Exception as e:
+                for *_, fut in batch:
+                    fut.done() or fut.set_exception(e)
+                continue
+            seen = set()
+            for update_id, _, fut in batch:
+                # дубль внутри пачки — тоже дубль
+                fut.done() or fut.set_result(update_id in new and update_id not in seen)
+                seen.add(update_id)
+            registry.inc('journal_appended_total', len(new), 'Апдейтов записано в журнал')
+            registry.inc('journal_duplicates_total', len(batch) - len(new), 'Повторных апдейтов отброшено')
+            if new:
+                self._wake.set()
+
+    # ————— дренаж —————
+    def retry(self, update_id: int) -> None:
+        """Апдейт не обработан (воркер упал или не ответил) — не отмечать, дренаж возьмёт его снова."""
+        self._retry.add(update_id)
+
+    async def start(self, app: Application) -> None:
+        self._app  = app
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._inflight:
+            # незавершённые за stop_timeout отменяем — после перезапуска они повторятся
+            _, pending = await asyncio.wait(list(self._inflight.values()), timeout=self.stop_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._mark_done()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._mark_done()
+                claimed = await self._claim()
+                await self._prune()
+            except Exception:
+                logging.exception('Журнал апдейтов: ошибка базы')
+                claimed = 0
+            if claimed < self.batch_size or self.in_flight >= self.max_in_flight:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                self._wake.clear()
+
+    async def _claim(self) -> int:
+        limit = min(self.batch_size, self.max_in_flight - self.in_flight)
+        if limit <= 0:
+            return 0
+        query = (
+            select(_journal.c.update_id, _journal.c.payload, _journal.c.attempts)
+            .where(_journal.c.done_at.is_(None), _journal.c.attempts < self.max_attempts)
+            .order_by(_journal.c.update_id)
+            .limit(limit)
+        )
+        if self._inflight:
+            query = query.where(_journal.c.update_id.not_in(list(self._inflight)))
+        async with async_engine.begin() as conn:
+            rows = (await conn.execute(query)).all()
+            if rows:
+                # попытка засчитывается до обработки: если процесс упадёт на апдейте, это будет видно
+                await conn.execute(
+                    update(_journal)
+                    .where(_journal.c.update_id.in_([row.update_id for row in rows]))
+                    .values(attempts=_journal.c.attempts + 1)
+                )
+        for update_id, payload, attempts in rows:
+            if attempts:
+                registry.inc('journal_replayed_total', help='Апдейтов обработано повторно после перезапуска')
+                if attempts + 1 >= self.max_attempts:
+                    logging.warning('Апдейт %s: последняя попытка обработки', update_id)
+            # задачи создаются по порядку update_id — процессор сохранит порядок внутри чата
+            self._inflight[update_id] = asyncio.create_task(self._dispatch(update_id, payload))
+        return len(rows)
+
+    async def _dispatch(self, update_id: int, payload: str) -> None:
+        try:
+            tg_update = Update.de_json(json.loads(payload), self._app.bot)
+            await self._app.update_processor.process_update(tg_update, self._app.process_update(tg_update))
+        except asyncio.CancelledError:
+            self._inflight.pop(update_id, None)
+            raise
+        except Exception:
+            # ошибки хэндлеров ловит приложение; сюда попадает только битый апдейт
+            logging.exception('Не удалось обработать апдейт %s из журнала', update_id)
+        if update_id in self._retry:
+            # попытка уже засчитана в _claim — после max_attempts апдейт больше не возьмётся
+            self._retry.discard(update_id)
+            self._inflight.pop(update_id, None)
+        else:
+            self._done.append(update_id)
+        self._wake.set()
+
+    async def _mark_done(self) -> None:
+        if not self._done:
+            return
+        ids, self._done = self._done, []
+        try:
+            async with async_engine.begin() as conn:
+                await conn.execute(
+                    update(_journal).where(_journal.c.update_id.in_(ids)).values(done_at=datetime.utcnow())
+                )
+        except BaseException:
+            self._done[:0] = ids
+            raise
+        for update_id in ids:
+            self._inflight.pop(update_id, None)
+
+    async def _prune(self) -> None:
+        # обработанные держим retention — столько Telegram может прислать повтор
+        now = time.monotonic()
+        if now - self._pruned_at < 600:
+            return
+        self._pruned_at = now
+        cutoff = datetime.utcnow() - self.retention
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                delete(_journal).where(or_(
+                    _journal.c.done_at < cutoff,
+                    (_journal.c.attempts >= self.max_attempts) & (_journal.c.received_at < cutoff),
+                ))
+            )
+
+
+def make_update_journal() -> UpdateJournal | None:
+    """Журнал по UPDATE_JOURNAL (1 — включён); без него апдейты идут сразу в очередь приложения."""
+    if os.environ.get('UPDATE_JOURNAL', '0') != '1':
+        return None
+    return UpdateJournal(
+        batch_size=int(os.environ.get('JOURNAL_BATCH', 100)),
+        max_in_flight=int(os.environ.get('JOURNAL_MAX_IN_FLIGHT', 256)),
+        max_attempts=int(os.environ.get('JOURNAL_MAX_ATTEMPTS', 3)),
+        retention=timedelta(hours=float(os.environ.get('JOURNAL_RETENTION_HOURS', 24))),
+    )
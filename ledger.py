@@ -0,0 +1,204 @@
+# ledger.py
+#
+# Журнал расходов OpenAI и суточные итоги.
+#
+#   python ledger.py rollup --days 2                  # пересчитать итоги за вчера и сегодня
+#   python ledger.py rollup --date 2026-10-01
+#   python ledger.py report --from 2026-10-01 --by advisor
+
+import argparse
+import asyncio
+import logging
+import os
+from contextlib import suppress
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import Integer, case, cast, delete, func, insert, select
+from telegram.ext import Application, ContextTypes
+
+from models import UsageEvent, UsageDaily, async_engine
+
+_ledger = UsageEvent.__table__
+_daily  = UsageDaily.__table__
+
+
+class UsageLedger:
+    """Буфер записей журнала расходов.
+
+    record() только добавляет строку в память; в базу строки уходят одним
+    пакетным INSERT раз в flush_interval секунд или при max_buffer строках.
+    Если база недоступна, строки остаются в буфере (не больше max_buffer * 10).
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_buffer: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_buffer     = max_buffer
+        self._buffer: list[dict] = []
+        self._lock    = asyncio.Lock()
+        self._wake    = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self.written  = 0
+        self.dropped  = 0
+
+    def record(self, user_id: int | None, advisor: str, model: str, prompt_tokens: int = 0,
+               completion_tokens: int = 0, latency: float = 0.0, cached: bool = False) -> None:
+        self._buffer.append({
+            'created_at':        datetime.utcnow(),
+            'user_id':           user_id,
+            'advisor':           advisor,
+            'model':             model,
+            'prompt_tokens':     prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'latency_ms':        int(latency * 1000),
+            'cached':            cached,
+        })
+        if len(self._buffer) >= self.max_buffer:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._buffer:
+                return 0
+            rows, self._buffer = self._buffer, []
+            try:
+                async with async_engine.begin() as conn:
+                    await conn.execute(insert(_ledger), rows)
+            except BaseException as e:
+                self._buffer[:0] = rows
+                overflow = len(self._buffer) - self.max_buffer * 10
+                if overflow > 0:
+                    # база лежит долго — старые записи не держим бесконечно
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+                if not isinstance(e, Exception):
+                    raise
+                logging.exception('Не удалось записать журнал расходов')
+                return 0
+            self.written += len(rows)
+            return len(rows)
+
+    async def start(self) -> None:
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            # не отменяем: отмена после коммита вернула бы строки в буфер — и дубли в журнале
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            if self._stopping:
+                return
+            self._wake.clear()
+            await asyncio.shield(self.flush())
+
+
+def make_usage_ledger() -> UsageLedger | None:
+    """Журнал по USAGE_LEDGER (1 — включён) с настройками пакетной записи."""
+    if os.environ.get('USAGE_LEDGER', '1') != '1':
+        return None
+    return UsageLedger(
+        flush_interval=float(os.environ.get('USAGE_LEDGER_FLUSH_INTERVAL', 5)),
+        max_buffer=int(os.environ.get('USAGE_LEDGER_MAX_BUFFER', 1000)),
+    )
+
+
+# ————— суточные итоги —————
+async def rollup(day: date) -> int:
+    """Пересчитывает итоги за сутки (UTC); читает только строки этих суток по индексу."""
+    start = datetime.combine(day, time.min)
+    user  = func.coalesce(_ledger.c.user_id, 0)
+    query = (
+        select(
+            user.label('user_id'),
+            _ledger.c.advisor,
+            _ledger.c.model,
+            func.count().label('requests'),
+            func.sum(case((_ledger.c.cached, 1), else_=0)).label('cached'),
+            func.sum(_ledger.c.prompt_tokens).label('prompt_tokens'),
+            func.sum(_ledger.c.completion_tokens).label('completion_tokens'),
+            func.sum(_ledger.c.latency_ms).label('latency_ms'),
+        )
+        .where(_ledger.c.created_at >= start, _ledger.c.created_at < start + timedelta(days=1))
+        .group_by(user, _ledger.c.advisor, _ledger.c.model)
+    )
+    async with async_engine.begin() as conn:
+        rows = [{**row._mapping, 'day': day} for row in await conn.execute(query)]
+        # пересчёт идемпотентен: итоги суток заменяются целиком
+        await conn.execute(delete(_daily).where(_daily.c.day == day))
+        if rows:
+            await conn.execute(insert(_daily), rows)
+    return len(rows)
+
+
+async def report(since: date, until: date, by: str = 'advisor') -> list[dict]:
+    key = _daily.c[{'advisor': 'advisor', 'user': 'user_id', 'model': 'model', 'day': 'day'}[by]]
+    query = (
+        select(
+            key.label(by),
+            func.sum(_daily.c.requests).label('requests'),
+            func.sum(_daily.c.cached).label('cached'),
+            func.sum(_daily.c.prompt_tokens).label('prompt_tokens'),
+            func.sum(_daily.c.completion_tokens).label('completion_tokens'),
+            cast(func.sum(_daily.c.latency_ms) / func.sum(_daily.c.requests), Integer).label('avg_latency_ms'),
+        )
+        .where(_daily.c.day >= since, _daily.c.day <= until)
+        .group_by(key)
+        .order_by(func.sum(_daily.c.prompt_tokens + _daily.c.completion_tokens).desc())
+    )
+    async with async_engine.connect() as conn:
+        return [dict(row._mapping) for row in await conn.execute(query)]
+
+
+async def rollup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    today = datetime.utcnow().date()
+    try:
+        for day in (today - timedelta(days=1), today):
+            await rollup(day)
+    except Exception:
+        logging.exception('Не удалось пересчитать суточные итоги расходов')
+
+
+def schedule_rollup(app: Application) -> None:
+    """Пересчёт итогов за вчера и сегодня раз в USAGE_ROLLUP_INTERVAL секунд (0 — выключен)."""
+    interval = float(os.environ.get('USAGE_ROLLUP_INTERVAL', 3600))
+    if interval and app.job_queue is not None:
+        app.job_queue.run_repeating(rollup_job, interval=interval, first=60, name='usage_rollup')
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description='Журнал расходов OpenAI')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_roll = sub.add_parser('rollup', help='пересчитать суточные итоги')
+    p_roll.add_argument('--date', type=date.fromisoformat, help='сутки (UTC), по умолчанию — сегодня')
+    p_roll.add_argument('--days', type=int, default=1, help='сколько суток до --date включительно')
+    p_rep = sub.add_parser('report', help='итоги за период')
+    p_rep.add_argument('--from', dest='since', type=date.fromisoformat, required=True)
+    p_rep.add_argument('--to', dest='until', type=date.fromisoformat, default=None)
+    p_rep.add_argument('--by', choices=('advisor', 'user', 'model', 'day'), default='advisor')
+    args = parser.parse_args()
+
+    if args.command == 'rollup':
+        last = args.date or datetime.utcnow().date()
+        for i in range(args.days - 1, -1, -1):
+            day = last - timedelta(days=i)
+            print(f'{day}: {await rollup(day)} строк')
+    else:
+        rows = await report(args.since, args.until or datetime.utcnow().date(), args.by)
+        columns = (args.by, 'requests', 'cached', 'prompt_tokens', 'completion_tokens', 'avg_latency_ms')
+        print('\t'.join(columns))
+        for row in rows:
+            print('\t'.join(str(row[c]) for c in columns))
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
@@ -0,0 +1,143 @@
+# memory.py
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from tokens import count_tokens
+
+
+class Conversation:
+    """История одного чата с одним советником: свежие обмены + сводка старых."""
+    __slots__ = ('turns', 'tokens', 'summary', 'pending', 'pending_tokens', 'summarizing', 'seen')
+
+    def __init__(self):
+        # обмен = (вопрос, ответ, токены обоих)
+        self.turns: deque[tuple[str, str, int]] = deque()
+        self.tokens         = 0
+        self.summary        = ''
+        self.pending: list[tuple[str, str, int]] = []
+        self.pending_tokens = 0
+        self.summarizing    = False
+        self.seen           = time.monotonic()
+
+
+class ConversationMemory:
+    """Память диалогов с бюджетом токенов и фоновой сводкой.
+
+    В промпт идут последние реплики, влезающие в window_tokens; всё, что
+    старше, уходит в сводку, которую summarize(сводка, реплики) собирает
+    вне пути запроса. max_chat_tokens — жёсткий потолок на чат, max_chats
+    и idle_ttl ограничивают число чатов в памяти.
+    """
+
+    def __init__(self, summarize=None, window_tokens: int = 1500, max_chat_tokens: int = 4000,
+                 summary_tokens: int = 400, max_chats: int = 5000, idle_ttl: float = 6 * 3600):
+        self.summarize       = summarize
+        self.window_tokens   = window_tokens
+        self.max_chat_tokens = max_chat_tokens
+        self.summary_tokens  = summary_tokens
+        self.max_chats       = max_chats
+        self.idle_ttl        = idle_ttl
+        self._chats: OrderedDict[tuple[int, str], Conversation] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def history(self, chat_id: int, advisor: str) -> list[dict]:
+        """Сообщения для промпта: сводка (если есть) и свежие реплики в пределах бюджета."""
+        conv = self._chats.get((chat_id, advisor))
+        if conv is None:
+            return []
+        if time.monotonic() - conv.seen > self.idle_ttl:
+            del self._chats[(chat_id, advisor)]
+            return []
+
+        budget, recent = self.window_tokens, []
+        for question, answer, tokens in reversed(conv.turns):
+            if tokens > budget:
+                break
+            budget -= tokens
+            recent += [{'role': 'assistant', 'content': answer}, {'role': 'user', 'content': question}]
+        recent.reverse()
+        if conv.summary:
+            recent.insert(0, {'role': 'system', 'content': f'Краткое содержание предыдущего разговора:\n{conv.summary}'})
+        return recent
+
+    def append(self, chat_id: int, advisor: str, question: str, answer: str) -> None:
+        key  = (chat_id, advisor)
+        conv = self._chats.get(key)
+        if conv is None:
+            conv = self._chats[key] = Conversation()
+        conv.seen = time.monotonic()
+        self._chats.move_to_end(key)
+
+        tokens = count_tokens(question) + count_tokens(answer)
+        conv.turns.append((question, answer, tokens))
+        conv.tokens += tokens
+
+        # всё, что не влезает в окно, — на сводку
+        while conv.tokens > self.window_tokens and conv.turns:
+            turn = conv.turns.popleft()
+            conv.tokens -= turn[2]
+            conv.pending.append(turn)
+            conv.pending_tokens += turn[2]
+
+        # жёсткий потолок: сводка не успевает — старое просто отбрасываем
+        while conv.pending and conv.tokens + conv.pending_tokens > self.max_chat_tokens:
+            conv.pending_tokens -= conv.pending.pop(0)[2]
+
+        if conv.pending and not conv.summarizing and self.summarize:
+            conv.summarizing = True
+            task = asyncio.create_task(self._summarize(conv))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif conv.pending and not self.summarize:
+            conv.pending.clear()
+            conv.pending_tokens = 0
+
+        self._evict()
+
+    def forget(self, chat_id: int, advisor: str | None = None) -> None:
+        for key in [k for k in self._chats if k[0] == chat_id and advisor in (None, k[1])]:
+            del self._chats[key]
+
+    async def _summarize(self, conv: Conversation) -> None:
+        try:
+            while conv.pending:
+                turns = conv.pending
+                conv.pending, conv.pending_tokens = [], 0
+                summary = await self.summarize(conv.summary, [(q, a) for q, a, _ in turns])
+                # сводка тоже ограничена по размеру
+                while summary and count_tokens(summary) > self.summary_tokens:
+                    summary = summary[:len(summary) * 3 // 4]
+                conv.summary = summary
+        except Exception:
+            logging.exception('Не удалось сжать историю диалога')
+        finally:
+            conv.summarizing = False
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._chats:
+            key, conv = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and now - conv.seen <= self.idle_ttl:
+                break
+            del self._chats[key]
+
+
+def make_conversation_memory(summarize) -> ConversationMemory | None:
+    """Память по MEMORY_ENABLED (1 — включена) и лимитам из окружения."""
+    if os.environ.get('MEMORY_ENABLED', '1') != '1':
+        return None
+    return ConversationMemory(
+        summarize=summarize,
+        window_tokens=int(os.environ.get('MEMORY_WINDOW_TOKENS', 1500)),
+        max_chat_tokens=int(os.environ.get('MEMORY_CHAT_MAX_TOKENS', 4000)),
+        summary_tokens=int(os.environ.get('MEMORY_SUMMARY_TOKENS', 400)),
+        max_chats=int(os.environ.get('MEMORY_MAX_CHATS', 5000)),
+        idle_ttl=float(os.environ.get('MEMORY_IDLE', 6 * 3600)),
+    )
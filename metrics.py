@@ -0,0 +1,154 @@
+# metrics.py
+
+import bisect
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Границы гистограмм задержек, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Писать ли в лог разбивку времени по этапам каждого сообщения
+LOG_SPANS = os.environ.get('METRICS_LOG_SPANS', '0') == '1'
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    )
+    return '{' + body + '}'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+
+class Registry:
+    """Счётчики, гистограммы и вычисляемые значения в текстовом формате Prometheus.
+
+    Метрики заводятся при первом обращении; gauge(name, fn) вызывает fn
+    только при отдаче /metrics, так что горячий путь их не касается.
+    """
+
+    def __init__(self, prefix: str = 'djanis'):
+        self.prefix      = prefix
+        self._help: dict[str, tuple[str, str]] = {}
+        self._counters:   dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._gauges:     dict[str, list] = {}
+
+    def _name(self, name: str, kind: str, help: str) -> str:
+        full = f'{self.prefix}_{name}'
+        if full not in self._help:
+            self._help[full] = (kind, help)
+        return full
+
+    def inc(self, name: str, value: float = 1, help: str = '', **labels) -> None:
+        series = self._counters.setdefault(self._name(name, 'counter', help), {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, help: str = '', **labels) -> None:
+        series = self._histograms.setdefault(self._name(name, 'histogram', help), {})
+        key  = tuple(sorted(labels.items()))
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram()
+        hist.observe(value)
+
+    def gauge(self, name: str, fn, help: str = '', kind: str = 'gauge') -> None:
+        """fn() -> число или {кортеж меток: число}; kind='counter' — для накопленных значений."""
+        self._gauges.setdefault(self._name(name, kind, help), []).append(fn)
+
+    def counter(self, name: str) -> dict[tuple, float]:
+        """Значения счётчика name по меткам (копия)."""
+        return dict(self._counters.get(f'{self.prefix}_{name}', {}))
+
+    def snapshot(self, name: str) -> dict[tuple, tuple[int, float, list[int]]]:
+        """Гистограммы name по меткам: (count, sum, counts) — разница двух снимков даёт окно."""
+        series = self._histograms.get(f'{self.prefix}_{name}', {})
+        return {key: (h.count, h.sum, list(h.counts)) for key, h in series.items()}
+
+    def render(self) -> str:
+        lines = []
+        for full, (kind, help) in self._help.items():
+            if help:
+                lines.append(f'# HELP {full} {help}')
+            lines.append(f'# TYPE {full} {kind}')
+            for key, value in self._counters.get(full, {}).items():
+                lines.append(f'{full}{_labels(dict(key))} {value:g}')
+            for key, hist in self._histograms.get(full, {}).items():
+                labels, total = dict(key), 0
+                for bound, n in zip(BUCKETS + (float('inf'),), hist.counts):
+                    total += n
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{full}_bucket{_labels({**labels, "le": le})} {total}')
+                lines.append(f'{full}_sum{_labels(labels)} {hist.sum:.6f}')
+                lines.append(f'{full}_count{_labels(labels)} {hist.count}')
+            for fn in self._gauges.get(full, []):
+                try:
+                    value = fn()
+                except Exception:
+                    logging.exception('Метрика %s не вычислилась', full)
+                    continue
+                if isinstance(value, dict):
+                    for key, v in value.items():
+                        lines.append(f'{full}{_labels(dict(key))} {v:g}')
+                else:
+                    lines.append(f'{full} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Trace:
+    """Разбивка обработки одного сообщения по этапам.
+
+    Каждый span пишется в гистограмму stage_seconds{stage=…}; при
+    METRICS_LOG_SPANS=1 итог уходит в лог одной JSON-строкой.
+    """
+    __slots__ = ('started', 'spans', 'fields')
+
+    def __init__(self, **fields):
+        self.started = time.perf_counter()
+        self.spans: dict[str, float] = {}
+        self.fields  = fields
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        registry.observe('stage_seconds', seconds, 'Время этапа обработки сообщения', stage=stage)
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def finish(self, outcome: str = 'ok') -> None:
+        total = time.perf_counter() - self.started
+        registry.observe('message_seconds', total, 'Полное время обработки сообщения', outcome=outcome)
+        if LOG_SPANS:
+            logging.info('timing %s', json.dumps({
+                **self.fields,
+                'outcome': outcome,
+                'total_ms': round(total * 1000, 1),
+                **{k + '_ms': round(v * 1000, 1) for k, v in self.spans.items()},
+            }, ensure_ascii=False))
@@ -2,21 +2,65 @@
 
 import os
 from datetime import datetime
-from sqlalchemy import create_engine, Column, BigInteger, Integer, Boolean, DateTime, String, JSON, text   
+from sqlalchemy import create_engine, Column, BigInteger, Integer, Boolean, Date, DateTime, String, Text, JSON, Index, text   
+from sqlalchemy import and_, case, func, or_
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from dateutil.relativedelta import relativedelta
 
 
 DATABASE_URL = os.environ['DATABASE_URL']
-engine = create_engine(DATABASE_URL, echo=True)
+# SQL_ECHO=1 — печать каждого запроса (только для отладки)
+SQL_ECHO = os.environ.get('SQL_ECHO', '0') == '1'
+engine = create_engine(DATABASE_URL, echo=SQL_ECHO)
 
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def async_url(url: str) -> str:
+    """URL базы для асинхронного драйвера (asyncpg / aiosqlite)."""
+    for prefix, driver in (
+        ('postgres://',   'postgresql+asyncpg://'),
+        ('postgresql://', 'postgresql+asyncpg://'),
+        ('sqlite://',     'sqlite+aiosqlite://'),
+    ):
+        if url.startswith(prefix):
+            return driver + url[len(prefix):]
+    return url
+
+
+# Асинхронный движок для горячего пути бота (алембик и init_db — на синхронном)
+_async_pool = {} if DATABASE_URL.startswith('sqlite') else dict(
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    pool_pre_ping=True,
+)
+async_engine = create_async_engine(async_url(DATABASE_URL), echo=SQL_ECHO, **_async_pool)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+def dialect_insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущей базы (Postgres или SQLite)."""
+    if async_engine.dialect.name == 'sqlite':
+        return sqlite_insert(model)
+    return pg_insert(model)
 Base = declarative_base()
 
+# Длительность тарифов; срок записывается в users.tariff_expires_at при активации
+TARIFF_DURATIONS = {
+    'БМ': relativedelta(months=+1),
+    'БГ': relativedelta(years=+1),
+    'РМ': relativedelta(months=+1),
+    'РГ': relativedelta(years=+1),
+}
+
 class User(Base):
     __tablename__ = 'users'
     id           = Column(
-        BigInteger,
+        # в SQLite автоинкремент есть только у INTEGER PRIMARY KEY (локальные прогоны, bench/)
+        BigInteger().with_variant(Integer, 'sqlite'),
         primary_key=True,
         autoincrement=True
         )
@@ -68,15 +112,185 @@ class User(Base):
         server_default=text("'[]'"),
         nullable=False
         )  
+    # срок действия оплаченного тарифа; по нему работает фоновая проверка
+    tariff_expires_at = Column(
+        DateTime,
+        nullable=True,
+        index=True
+        )
+    # предупреждение о скором окончании уже отправлено
+    expiry_notified   = Column(
+        Boolean,
+        default=False,
+        server_default=text('false'),
+        nullable=False
+        )
+    # израсходованные токены OpenAI за тестовый доступ или текущий срок тарифа
+    tokens_used       = Column(
+        BigInteger,
+        default=0,
+        server_default=text('0'),
+        nullable=False
+        )
 
     def tariff_expires(self) -> datetime:
-        """Дата начала тарифа берётся из first_request, длительность — по типу."""
-        dur = {
-          'БМ': relativedelta(months=+1),
-          'БГ': relativedelta(years=+1),
-          'РМ': relativedelta(months=+1),
-          'РГ': relativedelta(years=+1),
-        }.get(self.tariff, None)
-        if not self.tariff_paid or not dur:
+        """Срок оплаченного тарифа (None — тестовый доступ или тариф не оплачен)."""
+        if not self.tariff_paid or not self.tariff:
             return None
-        return self.first_request + dur
+        if self.tariff_expires_at is None and self.first_request and self.tariff in TARIFF_DURATIONS:
+            # тариф выставлен прямо в базе, без /activate — срок от first_request, как раньше
+            return self.first_request + TARIFF_DURATIONS[self.tariff]
+        return self.tariff_expires_at
+
+
+def tariff_expires_expr():
+    """SQL-выражение срока тарифа — то же, что User.tariff_expires() для оплаченного тарифа."""
+    months = case(
+        {code: dur.years * 12 + dur.months for code, dur in TARIFF_DURATIONS.items()},
+        value=User.tariff,
+    )
+    if async_engine.dialect.name == 'sqlite':
+        derived = func.datetime(User.first_request, func.printf('+%d months', months), type_=DateTime)
+    else:
+        derived = User.first_request + func.make_interval(0, months)
+    # у тестового доступа и неизвестных кодов срока нет
+    derived = case((User.tariff.in_(list(TARIFF_DURATIONS)), derived))
+    return func.coalesce(User.tariff_expires_at, derived, type_=DateTime)
+
+
+def tariff_expires_within(until: datetime, since: datetime | None = None):
+    """Срок тарифа в [since, until): по индексу tariff_expires_at, у тарифов без него — от first_request."""
+    def within(expires):
+        return and_(expires < until, expires >= since) if since else expires < until
+    return or_(
+        within(User.tariff_expires_at),
+        and_(User.tariff_expires_at.is_(None), within(tariff_expires_expr())),
+    )
+
+
+class ChatState(Base):
+    """Выбранный советник чата — общий для всех процессов бота."""
+    __tablename__ = 'chat_states'
+    chat_id      = Column(
+        BigInteger,
+        primary_key=True,
+        autoincrement=False
+        )
+    advisor      = Column(
+        String,
+        nullable=False
+        )
+    updated_at   = Column(
+        DateTime,
+        default=datetime.utcnow,
+        server_default=text('CURRENT_TIMESTAMP'),
+        nullable=False
+        )
+
+
+class CachedAnswer(Base):
+    """Постоянный уровень кэша ответов: советник + нормализованный вопрос."""
+    __tablename__ = 'answer_cache'
+    key          = Column(
+        String(64),
+        primary_key=True
+        )
+    advisor      = Column(
+        String,
+        nullable=False
+        )
+    answer       = Column(
+        Text,
+        nullable=False
+        )
+    created_at   = Column(
+        DateTime,
+        default=datetime.utcnow,
+        server_default=text('CURRENT_TIMESTAMP'),
+        nullable=False,
+        index=True
+        )
+
+
+class UsageEvent(Base):
+    """Журнал расходов: одна строка на ответ советника (только добавление)."""
+    __tablename__ = 'usage_ledger'
+    __table_args__ = (
+        # BRIN в Postgres: строки пишутся по времени, индекс крошечный,
+        # а выборки за период не читают всю таблицу
+        Index('ix_usage_ledger_created_at', 'created_at', postgresql_using='brin'),
+    )
+    id                = Column(
+        BigInteger().with_variant(Integer, 'sqlite'),
+        primary_key=True,
+        autoincrement=True
+        )
+    created_at        = Column(
+        DateTime,
+        default=datetime.utcnow,
+        nullable=False
+        )
+    user_id           = Column(
+        BigInteger,
+        nullable=True
+        )
+    advisor           = Column(
+        String,
+        nullable=False
+        )
+    model             = Column(
+        String,
+        nullable=False
+        )
+    prompt_tokens     = Column(
+        Integer,
+        default=0,
+        nullable=False
+        )
+    completion_tokens = Column(
+        Integer,
+        default=0,
+        nullable=False
+        )
+    latency_ms        = Column(
+        Integer,
+        default=0,
+        nullable=False
+        )
+    cached            = Column(
+        Boolean,
+        default=False,
+        nullable=False
+        )
+
+
+class UsageDaily(Base):
+    """Суточные итоги журнала расходов по пользователю, советнику и модели."""
+    __tablename__ = 'usage_daily'
+    day               = Column(Date, primary_key=True)
+    user_id           = Column(BigInteger, primary_key=True, autoincrement=False)
+    advisor           = Column(String, primary_key=True)
+    model             = Column(String, primary_key=True)
+    requests          = Column(Integer, nullable=False)
+    cached            = Column(Integer, nullable=False)
+    prompt_tokens     = Column(BigInteger, nullable=False)
+    completion_tokens = Column(BigInteger, nullable=False)
+    latency_ms        = Column(BigInteger, nullable=False)
+
+
+class JournaledUpdate(Base):
+    """Журнал входящих апдейтов: вебхук пишет сюда и сразу отвечает Telegram."""
+    __tablename__ = 'update_journal'
+    __table_args__ = (
+        # необработанные — малая часть таблицы; частичный индекс только по ним
+        Index(
+            'ix_update_journal_pending', 'update_id',
+            postgresql_where=text('done_at IS NULL'),
+            sqlite_where=text('done_at IS NULL'),
+        ),
+    )
+    update_id   = Column(BigInteger, primary_key=True, autoincrement=False)
+    payload     = Column(Text, nullable=False)
+    received_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    attempts    = Column(Integer, default=0, nullable=False)
+    done_at     = Column(DateTime, nullable=True, index=True)
@@ -0,0 +1,186 @@
+# outbound.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import registry
+from ratelimit import TokenBucket
+
+# Классы исходящих запросов (rate_limit_args)
+INTERACTIVE = 'interactive'   # ответы пользователю — по умолчанию
+BULK        = 'bulk'          # рассылки и уведомления — пропускают ответы вперёд
+DROPPABLE   = 'droppable'     # промежуточные правки потокового ответа — без ожидания
+
+_PRIORITY = {INTERACTIVE: 0, BULK: 1, DROPPABLE: 0}
+
+# Методы, которые Telegram ограничивает по чату
+_CHAT_METHODS = {
+    'sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument', 'sendChatAction',
+    'editMessageReplyMarkup', 'copyMessage', 'forwardMessage',
+}
+
+
+def rate_limit_kwargs(bot, kind: str) -> dict:
+    """rate_limit_args для вызова — только если у бота есть ограничитель (иначе PTB падает)."""
+    return {'rate_limit_args': kind} if getattr(bot, 'rate_limiter', None) else {}
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Очередь исходящих запросов к Bot API под лимиты Telegram.
+
+    Общее ведро (global_rate в секунду) и ведро на чат: личные чаты —
+    chat_rate в секунду, группы — group_rate в минуту. Сначала запрос
+    ждёт своей очереди в чате (FIFO), затем общего токена; общие токены
+    раздаются по приоритету — ответы пользователям раньше рассылок.
+    На 429 все отправки приостанавливаются на retry_after, запрос
+    повторяется до max_retries раз. Запросы DROPPABLE не ждут: если
+    токена нет сразу, сразу получают RetryAfter, и вызывающий их пропускает.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20, max_retries: int = 3, max_chats: int = 10000):
+        self.global_rate = global_rate
+        self.chat_limit  = (chat_rate, chat_burst)
+        self.group_limit = (group_rate / 60, max(1.0, group_rate / 4))
+        self.max_retries = max_retries
+        self.max_chats   = max_chats
+        self._global     = TokenBucket(global_rate, global_rate)
+        self._chats: OrderedDict[int, tuple[TokenBucket, asyncio.Lock]] = OrderedDict()
+        self._waiters: list[list] = []
+        self._seq        = itertools.count()
+        self._cond: asyncio.Condition | None = None
+        self._paused_until = 0.0
+        self.chat_waiting  = 0
+
+    async def initialize(self) -> None:
+        self._cond = asyncio.Condition()
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters) + self.chat_waiting
+
+    def _chat(self, chat_id: int) -> tuple[TokenBucket, asyncio.Lock]:
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            rate, burst = self.group_limit if chat_id < 0 else self.chat_limit
+            entry = self._chats[chat_id] = (TokenBucket(rate, burst), asyncio.Lock())
+            # вытесняем старые чаты, кроме тех, где кто-то ждёт
+            for key in list(self._chats)[:max(0, len(self._chats) - self.max_chats)]:
+                if not self._chats[key][1].locked():
+                    del self._chats[key]
+        self._chats.move_to_end(chat_id)
+        return entry
+
+    @staticmethod
+    def _wait(bucket: TokenBucket, now: float) -> float:
+        tokens = bucket.refill(now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / bucket.rate
+
+    def _busy(self, chat_id: int | None) -> float:
+        """Сколько ждать запросу без очереди; 0 — можно сейчас."""
+        now  = time.monotonic()
+        wait = max(self._paused_until - now, self._wait(self._global, now))
+        if self._waiters:
+            wait = max(wait, 1.0)
+        if chat_id is not None:
+            bucket, lock = self._chat(chat_id)
+            wait = max(wait, self._wait(bucket, now), 1.0 if lock.locked() else 0.0)
+        return wait
+
+    async def _acquire_chat(self, chat_id: int) -> None:
+        bucket, lock = self._chat(chat_id)
+        self.chat_waiting += 1
+        try:
+            async with lock:
+                while (wait := self._wait(bucket, time.monotonic())) > 0:
+                    await asyncio.sleep(wait)
+                bucket.take(time.monotonic())
+        finally:
+            self.chat_waiting -= 1
+
+    async def _acquire_global(self, priority: int) -> None:
+        entry = [priority, next(self._seq)]
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._cond.notify_all()
+            try:
+                while True:
+                    if self._waiters[0] is entry:
+                        now  = time.monotonic()
+                        wait = max(self._paused_until - now, self._wait(self._global, now))
+                        if wait <= 0:
+                            self._global.take(now)
+                            return
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), wait)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._cond.wait()
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    async def process_request(self, callback, args: Any, kwargs: dict[str, Any], endpoint: str,
+                              data: dict[str, Any], rate_limit_args: str | None):
+        kind    = rate_limit_args or INTERACTIVE
+        chat_id = data.get('chat_id') if endpoint in _CHAT_METHODS else None
+        if isinstance(chat_id, str):
+            # @username каналов — лимит по чату не считаем
+            chat_id = int(chat_id) if chat_id.lstrip('-').isdigit() else None
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if kind == DROPPABLE:
+                wait = self._busy(chat_id)
+                if wait > 0:
+                    registry.inc('telegram_dropped_total', help='Пропущенные промежуточные правки')
+                    raise RetryAfter(max(1, round(wait)))
+                if chat_id is not None:
+                    self._chat(chat_id)[0].take(started)
+                self._global.take(started)
+            else:
+                if chat_id is not None:
+                    await self._acquire_chat(chat_id)
+                await self._acquire_global(_PRIORITY.get(kind, 0))
+            registry.observe('telegram_send_delay_seconds', time.monotonic() - started,
+                             'Ожидание в очереди исходящих запросов', kind=kind)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+                # 429 — общий сигнал: притормаживаем все отправки
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                registry.inc('telegram_retry_after_total', help='Ответы 429 от Telegram', method=endpoint)
+                if kind == DROPPABLE or attempt >= self.max_retries:
+                    raise
+                logging.warning('Telegram 429 на %s, пауза %.1f с', endpoint, delay)
+
+
+def make_outbound_limiter() -> OutboundRateLimiter | None:
+    """Ограничитель исходящих по TELEGRAM_GLOBAL_RATE (0 — выключен) и лимитам на чат."""
+    global_rate = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+    if not global_rate:
+        return None
+    return OutboundRateLimiter(
+        global_rate=global_rate,
+        chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', 1)),
+        chat_burst=float(os.environ.get('TELEGRAM_CHAT_BURST', 3)),
+        group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE_PER_MIN', 20)),
+        max_retries=int(os.environ.get('TELEGRAM_MAX_RETRIES', 3)),
+    )
@@ -0,0 +1,362 @@
+# profiling.py
+
+import asyncio
+import contextvars
+import cProfile
+import html
+import logging
+import marshal
+import os
+import pstats
+import random
+import re
+import time
+from collections import defaultdict
+from contextlib import suppress
+
+from sqlalchemy import event
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.ext import Application
+
+from metrics import BUCKETS, registry
+from models import async_engine
+from tg_html import TELEGRAM_LIMIT
+
+PROFILE_USAGE = (
+    'Использование: /profile [N | Ns | Nm] [sample=0.5] [top=15] [nocpu]\n'
+    '/profile status — ход профилирования, /profile stop — остановить и прислать отчёт'
+)
+
+# Хэндлер, из которого идёт запрос к базе, — чтобы разнести время SQL по хэндлерам
+_handler = contextvars.ContextVar('profiled_handler', default=None)
+
+_SPACES = re.compile(r'\s+')
+# IN (?, ?, ?) разной длины — один и тот же запрос
+_PARAMS = re.compile(r'\((?:\?|%s|\$\d+|:\w+)(?:,\s*(?:\?|%s|\$\d+|:\w+))+\)')
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _bucket_quantile(counts: list[int], q: float) -> float:
+    """Верхняя граница корзины гистограммы, в которую попадает квантиль q."""
+    need, total = q * sum(counts), 0
+    for bound, n in zip(BUCKETS + (float('inf'),), counts):
+        total += n
+        if total >= need:
+            return bound
+    return float('inf')
+
+
+def normalize_sql(statement: str) -> str:
+    return _PARAMS.sub('(…)', _SPACES.sub(' ', statement).strip())
+
+
+class ProfileSession:
+    """Данные одного окна профилирования: всё, что попадёт в отчёт."""
+
+    def __init__(self, chat_id: int, max_updates: int | None, seconds: float, sample: float,
+                 top: int, cpu: bool):
+        self.chat_id     = chat_id
+        self.max_updates = max_updates
+        self.seconds     = seconds
+        self.sample      = sample
+        self.top         = top
+        self.started     = time.perf_counter()
+        self.finished: float | None = None
+        # update_id -> попал ли апдейт в выборку
+        self.updates: dict[int, bool] = {}
+        self.handlers: dict[str, list[float]] = defaultdict(list)
+        # запрос -> [число, сумма, максимум]
+        self.sql: dict[str, list] = {}
+        self.sql_by_handler: dict[str, float] = defaultdict(float)
+        self.lag: list[float] = []
+        self.stages: dict[str, tuple[int, float, list[int]]] = {}
+        self.cpu = cProfile.Profile() if cpu else None
+        # выбранные апдейты, которые ещё в хэндлерах: отчёт ждёт их завершения
+        self.running = 0
+        self.idle    = asyncio.Event()
+        self.idle.set()
+        self._stages_before = registry.snapshot('stage_seconds')
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def sampled(self) -> int:
+        return sum(self.updates.values())
+
+    def add_sql(self, statement: str, seconds: float) -> None:
+        stat = self.sql.setdefault(normalize_sql(statement), [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2]  = max(stat[2], seconds)
+        handler = _handler.get()
+        if handler:
+            self.sql_by_handler[handler] += seconds
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+        # этапы сообщений берём из гистограмм stage_seconds: разница снимков в начале и в конце окна
+        for key, (count, total, counts) in registry.snapshot('stage_seconds').items():
+            before = self._stages_before.get(key, (0, 0.0, [0] * len(counts)))
+            if count > before[0]:
+                self.stages[dict(key).get('stage', '?')] = (
+                    count - before[0], total - before[1], [a - b for a, b in zip(counts, before[2])]
+                )
+
+    def status(self) -> str:
+        limit = f'/{self.max_updates}' if self.max_updates else ''
+        return (f'Профилирование: {len(self.updates)}{limit} апдейтов, в выборке {self.sampled}, '
+                f'{self.duration:.0f} из {self.seconds:.0f} с')
+
+    # ————— отчёт —————
+    def report(self, top: int, sql_width: int = 70) -> str:
+        lines = [
+            f'Профиль: {len(self.updates)} апдейтов за {self.duration:.1f} с, '
+            f'в выборке {self.sampled} ({self.sample:.0%})',
+        ]
+        if self.handlers:
+            lines += ['', f'{"Хэндлеры, мс":<18} {"n":>5} {"p50":>8} {"p95":>8} {"max":>8} {"SQL/n":>7}']
+            for name, times in sorted(self.handlers.items(), key=lambda kv: -sum(kv[1]))[:top]:
+                lines.append(
+                    f'{name[:18]:<18} {len(times):>5} {_percentile(times, 0.5) * 1000:>8.1f} '
+                    f'{_percentile(times, 0.95) * 1000:>8.1f} {max(times) * 1000:>8.1f} '
+                    f'{self.sql_by_handler.get(name, 0.0) / len(times) * 1000:>7.1f}'
+                )
+        if self.stages:
+            lines += ['', f'{"Этапы, мс":<18} {"n":>5} {"avg":>8} {"p95 ≤":>8}']
+            for stage, (count, total, counts) in sorted(self.stages.items(), key=lambda kv: -kv[1][1])[:top]:
+                lines.append(f'{stage[:18]:<18} {count:>5} {total / count * 1000:>8.1f} '
+                             f'{_bucket_quantile(counts, 0.95) * 1000:>8g}')
+        if self.sql:
+            lines += ['', f'{"SQL, мс всего":>13} {"n":>5} {"max":>7}  запрос']
+            for statement, (count, total, worst) in sorted(self.sql.items(), key=lambda kv: -kv[1][1])[:top]:
+                short = statement if len(statement) <= sql_width else statement[:sql_width - 1] + '…'
+                lines.append(f'{total * 1000:>13.1f} {count:>5} {worst * 1000:>7.1f}  {short}')
+        if self.lag:
+            slow = sum(1 for lag in self.lag if lag > 0.1)
+            lines += ['', f'Цикл событий: задержка p95 {_percentile(self.lag, 0.95) * 1000:.1f} мс, '
+                          f'max {max(self.lag) * 1000:.1f} мс, больше 100 мс — {slow} из {len(self.lag)}']
+        if self.cpu:
+            lines += ['', *self._cpu_top(top)]
+        return '\n'.join(lines)
+
+    def _cpu_top(self, top: int) -> list[str]:
+        stats = pstats.Stats(self.cpu)
+        rows  = sorted(stats.stats.items(), key=lambda kv: -kv[1][2])[:top]
+        lines = [f'CPU {stats.total_tt * 1000:.0f} мс; {"своё":>8} {"всего":>8} {"вызовы":>8}  функция']
+        for (path, line, func), (_, calls, own, cumulative, _) in rows:
+            where = f' {os.path.basename(path)}:{line}' if line else ''
+            lines.append(f'{"":>13}{own * 1000:>8.1f} {cumulative * 1000:>8.1f} {calls:>8}  {func}{where}')
+        return lines
+
+    def cpu_dump(self) -> bytes | None:
+        """Профиль в формате pstats: открывается pstats.Stats(файл), snakeviz и т. п."""
+        if not self.cpu:
+            return None
+        self.cpu.create_stats()
+        return marshal.dumps(self.cpu.stats)
+
+
+class Profiler:
+    """Профилирование по команде администратора на работающем боте.
+
+    start() открывает окно на max_updates апдейтов или seconds секунд (не
+    дольше max_seconds): колбэки хэндлеров приложения подменяются
+    обёртками с замером времени, к движку базы цепляются слушатели
+    before/after_cursor_execute, включается cProfile и замер задержки
+    цикла событий. В выборку хэндлеров апдейт попадает с вероятностью
+    sample; SQL, этапы и CPU считаются по всему процессу за окно. По
+    окончании окна всё возвращается как было, а отчёт уходит в чат
+    администратора. Вне окна профилировщик ничего не делает: хэндлеры —
+    исходные функции, слушателей SQL нет. Профилируется только процесс,
+    в котором выполнена команда.
+    """
+
+    def __init__(self, max_seconds: float = 600, lag_interval: float = 0.1, drain_timeout: float = 60):
+        self.max_seconds   = max_seconds
+        self.lag_interval  = lag_interval
+        self.drain_timeout = drain_timeout
+        self.session: ProfileSession | None = None
+        # окно, в которое пишут слушатели SQL: живёт, пока stop() дожидается начатых хэндлеров
+        self._recording: ProfileSession | None = None
+        self._app: Application | None = None
+        self._wrapped: list[tuple[object, object]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._lag_task: asyncio.Task | None = None
+        self._stopping: set[asyncio.Task] = set()
+
+    @property
+    def active(self) -> bool:
+        return self.session is not None
+
+    def status(self) -> str:
+        return self.session.status() if self.session else 'Профилирование не запущено.'
+
+    def start(self, app: Application, chat_id: int, updates: int | None = None,
+              seconds: float | None = None, sample: float = 1.0, top: int = 15, cpu: bool = True,
+              exclude: tuple = ()) -> bool:
+        """False — окно уже открыто. exclude — колбэки, которые не трогаем (сама команда)."""
+        if self.session:
+            return False
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        session = self.session = ProfileSession(chat_id, updates, seconds, sample, top, cpu)
+        self._app = app
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                if handler.callback in exclude:
+                    continue
+                self._wrapped.append((handler, handler.callback))
+                handler.callback = self._wrap(session, handler.callback)
+        self._recording = session
+        event.listen(async_engine.sync_engine, 'before_cursor_execute', self._before_sql)
+        event.listen(async_engine.sync_engine, 'after_cursor_execute', self._after_sql)
+        if session.cpu:
+            try:
+                session.cpu.enable()
+            except ValueError:
+                # профилировщик уже включён кем-то ещё — обходимся без cProfile
+                logging.warning('cProfile занят, профиль CPU не собирается')
+                session.cpu = None
+        loop = asyncio.get_running_loop()
+        self._lag_task = loop.create_task(self._watch_lag(session))
+        self._timer    = loop.call_later(seconds, self._finish, session)
+        logging.info('Профилирование запущено: %s', session.status())
+        return True
+
+    async def stop(self) -> ProfileSession | None:
+        """Закрывает окно и отправляет отчёт; None — окно не было открыто."""
+        session, self.session = self.session, None
+        if session is None:
+            return None
+        for handler, callback in self._wrapped:
+            handler.callback = callback
+        self._wrapped = []
+        # новые апдейты идут мимо обёрток, начатые дописывают замеры
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(session.idle.wait(), self.drain_timeout)
+        if session.cpu:
+            session.cpu.disable()
+        event.remove(async_engine.sync_engine, 'before_cursor_execute', self._before_sql)
+        event.remove(async_engine.sync_engine, 'after_cursor_execute', self._after_sql)
+        self._recording = None
+        self._timer.cancel()
+        self._lag_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._lag_task
+        session.finish()
+        logging.info('Профилирование завершено: %s', session.status())
+        try:
+            await send_report(self._app.bot, session)
+        except Exception:
+            logging.exception('Не удалось отправить отчёт профилирования')
+        return session
+
+    def _finish(self, session: ProfileSession) -> None:
+        # окно закрывается из хэндлера или таймера — останавливаем отдельной задачей
+        if self.session is not session:
+            return
+        task = asyncio.get_running_loop().create_task(self.stop())
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+
+    def _wrap(self, session: ProfileSession, callback):
+        name = getattr(callback, '__name__', type(callback).__name__)
+
+        async def profiled(update, context):
+            update_id = getattr(update, 'update_id', None)
+            if update_id not in session.updates:
+                if session.max_updates and len(session.updates) >= session.max_updates:
+                    self._finish(session)
+                    return await callback(update, context)
+                session.updates[update_id] = random.random() < session.sample
+            if not session.updates[update_id]:
+                return await callback(update, context)
+            token   = _handler.set(name)
+            started = time.perf_counter()
+            session.running += 1
+            session.idle.clear()
+            try:
+                return await callback(update, context)
+            finally:
+                session.handlers[name].append(time.perf_counter() - started)
+                _handler.reset(token)
+                session.running -= 1
+                if not session.running:
+                    session.idle.set()
+                if session.max_updates and len(session.updates) >= session.max_updates:
+                    self._finish(session)
+
+        profiled.__name__ = name
+        return profiled
+
+    # ————— SQL и цикл событий —————
+    def _before_sql(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('profile_started', []).append((self._recording, time.perf_counter()))
+
+    def _after_sql(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        stack = conn.info.get('profile_started')
+        if not stack:
+            return
+        session, started = stack.pop()
+        # запрос, начатый в прошлом окне, не считаем
+        if session is not None and session is self._recording:
+            session.add_sql(statement, time.perf_counter() - started)
+
+    async def _watch_lag(self, session: ProfileSession) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            session.lag.append(max(0.0, loop.time() - started - self.lag_interval))
+
+
+def parse_profile_args(args: list[str]) -> dict:
+    """Аргументы /profile: число апдейтов или длительность (30s, 5m), sample=, top=, nocpu."""
+    options = {'updates': 50}
+    for arg in args:
+        key, _, value = arg.lower().partition('=')
+        if key == 'nocpu':
+            options['cpu'] = False
+        elif key == 'sample' and value:
+            options['sample'] = float(value)
+            if not 0 < options['sample'] <= 1:
+                raise ValueError(arg)
+        elif key == 'top' and value:
+            options['top'] = max(1, int(value))
+        elif key[-1:] in ('s', 'm') and key[:-1].isdigit():
+            options['seconds'] = int(key[:-1]) * (60 if key[-1] == 'm' else 1)
+            options.pop('updates', None)
+        elif key.isdigit() and int(key) > 0:
+            options['updates'] = int(key)
+        else:
+            raise ValueError(arg)
+    return options
+
+
+async def send_report(bot: Bot, session: ProfileSession) -> None:
+    """Сводка top-N — сообщением, полный отчёт и дамп cProfile — файлами."""
+    lines, size = [], len('<pre></pre>')
+    for line in session.report(session.top).split('\n'):
+        line = html.escape(line, quote=False) + '\n'
+        if size + len(line) > TELEGRAM_LIMIT:
+            break
+        lines.append(line)
+        size += len(line)
+    await bot.send_message(session.chat_id, f'<pre>{"".join(lines).rstrip()}</pre>', parse_mode=ParseMode.HTML)
+    full = session.report(top=100, sql_width=400)
+    await bot.send_document(session.chat_id, full.encode(), filename='profile.txt')
+    dump = session.cpu_dump()
+    if dump:
+        await bot.send_document(session.chat_id, dump, filename='profile.prof',
+                                caption='python -m pstats profile.prof')
+
+
+def make_profiler() -> Profiler:
+    """PROFILE_MAX_SECONDS — предел окна профилирования, даже если просили больше."""
+    return Profiler(max_seconds=float(os.environ.get('PROFILE_MAX_SECONDS', 600)))
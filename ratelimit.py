@@ -0,0 +1,104 @@
+# ratelimit.py
+
+import time
+from collections import OrderedDict
+
+from cache import TTLCache
+
+# Причины отказа
+USER_LIMIT   = 'user'
+CHAT_LIMIT   = 'chat'
+GLOBAL_LIMIT = 'global'
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.updated  = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def reconfigure(self, rate: float, capacity: float, now: float) -> None:
+        """Новые темп и запас; накопленное до полного не доливается."""
+        self.refill(now)
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = min(self.tokens, capacity)
+
+    def take(self, now: float, n: float = 1) -> bool:
+        if self.refill(now) < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class RateLimiter:
+    """Ограничение частоты сообщений: на пользователя (по тарифу), на чат и общее.
+
+    limits — {код тарифа: (сообщений в минуту, запас)}, '' — тестовый доступ.
+    Ведро пользователя одно на user_id: при смене тарифа меняются его темп
+    и запас, а не заводится новое полное. Общее ведро считает только
+    сообщения, уходящие в OpenAI.
+    """
+
+    def __init__(self, limits: dict[str, tuple[float, float]], chat_limit: tuple[float, float],
+                 global_limit: tuple[float, float], max_buckets: int = 100000,
+                 notice_interval: float = 30):
+        self.limits       = limits
+        self.chat_limit   = chat_limit
+        self.max_buckets  = max_buckets
+        self._global      = TokenBucket(global_limit[0] / 60, global_limit[1])
+        self._users: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._noticed     = TTLCache(max_buckets, notice_interval)
+        self.rejected     = {USER_LIMIT: 0, CHAT_LIMIT: 0, GLOBAL_LIMIT: 0}
+
+    def _bucket(self, buckets: OrderedDict, key: int, limit: tuple[float, float] | None,
+                now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            limit  = limit or self.limits['']
+            bucket = buckets[key] = TokenBucket(limit[0] / 60, limit[1])
+            # вытесняем давно не использованные вёдра
+            while len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        elif limit and (bucket.rate, bucket.capacity) != (limit[0] / 60, limit[1]):
+            bucket.reconfigure(limit[0] / 60, limit[1], now)
+        buckets.move_to_end(key)
+        return bucket
+
+    def check(self, user_id: int, chat_id: int, tariff: str | None = '', costly: bool = True) -> str | None:
+        """None — можно; иначе причина отказа. Токены списываются, только если можно везде.
+
+        tariff=None — тариф сейчас неизвестен: ведро пользователя остаётся с прежним лимитом.
+        """
+        now     = time.monotonic()
+        limit   = None if tariff is None else self.limits.get(tariff, self.limits[''])
+        buckets = [
+            (USER_LIMIT, self._bucket(self._users, user_id, limit, now)),
+            (CHAT_LIMIT, self._bucket(self._chats, chat_id, self.chat_limit, now)),
+        ]
+        if costly:
+            buckets.append((GLOBAL_LIMIT, self._global))
+        for reason, bucket in buckets:
+            if bucket.refill(now) < 1:
+                self.rejected[reason] += 1
+                return reason
+        for _, bucket in buckets:
+            bucket.take(now)
+        return None
+
+    def should_notify(self, user_id: int) -> bool:
+        """Сообщать об ограничении не чаще раза в notice_interval — флуд не порождает ответный флуд."""
+        if self._noticed.get(user_id):
+            return False
+        self._noticed.put(user_id, True)
+        return True
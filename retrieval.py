@@ -0,0 +1,138 @@
+# retrieval.py
+
+import logging
+import os
+import re
+
+import numpy as np
+
+from advisors import Advisor, FORMAT_INSTR
+
+# Разделитель разделов в system_prompt советников: строка из подчёркиваний
+SECTION_SEP = re.compile(r'\n\s*_{5,}\s*\n')
+# …или нумерованные заголовки: «1) …», «2. …», «[3] …»
+HEADING     = re.compile(r'\n(?=[ \t]*(?:\[\d+\]|\d+[.)])\s)')
+WORD        = re.compile(r'\w+', re.UNICODE)
+
+# Служебные слова, которые только шумят в поиске
+STOPWORDS = frozenset(
+    'и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне '
+    'было вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас '
+    'нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их '
+    'чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой '
+    'совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при '
+    'наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три '
+    'эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно '
+    'всю между это как мне нужно'.split()
+)
+
+
+def terms(text: str, stem: int = 6) -> list[str]:
+    """Слова в нижнем регистре, обрезанные до stem букв — грубый, но дешёвый стемминг для русского."""
+    return [w[:stem] for w in WORD.findall(text.lower()) if w not in STOPWORDS and len(w) > 1]
+
+
+def split_sections(prompt: str) -> list[str]:
+    parts = SECTION_SEP.split(prompt)
+    if len(parts) < 3:
+        parts = HEADING.split(prompt)
+    return [s.strip() for s in parts if s.strip()]
+
+
+class BM25Index:
+    """BM25 по небольшому набору разделов: матрица частот терминов в NumPy."""
+
+    def __init__(self, docs: list[str], k1: float = 1.5, b: float = 0.75):
+        tokenized  = [terms(d) for d in docs]
+        self.vocab = {t: i for i, t in enumerate(sorted({t for doc in tokenized for t in doc}))}
+        tf = np.zeros((len(docs), len(self.vocab)), dtype=np.float32)
+        for row, doc in enumerate(tokenized):
+            for t in doc:
+                tf[row, self.vocab[t]] += 1
+        lengths = tf.sum(axis=1)
+        avg     = lengths.mean() if len(docs) else 0.0
+        df      = (tf > 0).sum(axis=0)
+        self.idf = np.log1p((len(docs) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # вес термина в разделе считается один раз; запрос — сумма по его столбцам
+        norm = k1 * (1 - b + b * lengths / avg) if avg else np.ones_like(lengths)
+        self.weights = (tf * (k1 + 1) / (tf + norm[:, None])) * self.idf
+
+    def search(self, query: str, k: int) -> list[int]:
+        cols = [self.vocab[t] for t in set(terms(query)) if t in self.vocab]
+        if not cols or not len(self.weights):
+            return []
+        scores = self.weights[:, cols].sum(axis=1)
+        top    = np.argsort(-scores, kind='stable')[:k]
+        return [int(i) for i in top if scores[i] > 0]
+
+
+class KnowledgeIndex:
+    """Индекс разделов советника: ядро (персона) всегда, остальное — по вопросу."""
+
+    def __init__(self, advisor: Advisor, core_sections: int = 1):
+        sections      = split_sections(advisor.get('system_prompt', ''))
+        self.mtime    = advisor.mtime
+        self.core     = '\n\n'.join(sections[:core_sections])
+        self.sections = sections[core_sections:]
+        self.index    = BM25Index(self.sections)
+
+    def prompt(self, question: str, k: int) -> str | None:
+        """Системный промпт с k подходящими разделами; None — ничего не нашлось."""
+        hits = self.index.search(question, k)
+        if not hits:
+            return None
+        # разделы — в исходном порядке, как в полном промпте
+        picked = [self.sections[i] for i in sorted(hits)]
+        return '\n________________________________________\n'.join([self.core, *picked]) + FORMAT_INSTR
+
+
+class RetrievalPrompts:
+    """Выбор системного промпта по режиму советника (ключ prompt_mode в JSON).
+
+    full — весь system_prompt, как раньше; retrieval — ядро плюс top_k
+    разделов по BM25. Индекс советника пересобирается, только когда
+    изменился его файл (mtime), остальные не трогаются.
+    """
+
+    def __init__(self, default_mode: str = 'full', top_k: int = 4):
+        self.default_mode = default_mode
+        self.top_k        = top_k
+        self._indexes: dict[str, KnowledgeIndex] = {}
+
+    def _index(self, advisor: Advisor) -> KnowledgeIndex:
+        index = self._indexes.get(advisor.name)
+        if index is None or index.mtime != advisor.mtime:
+            index = self._indexes[advisor.name] = KnowledgeIndex(
+                advisor, core_sections=int(advisor.get('core_sections', 1))
+            )
+            logging.info('Индекс советника %s: %s разделов', advisor.name, len(index.sections))
+        return index
+
+    def build(self, advisors) -> None:
+        """Индексы для всех советников в режиме retrieval — при старте, вне пути запроса."""
+        names = set()
+        for advisor in advisors:
+            names.add(advisor.name)
+            if self.mode(advisor) == 'retrieval':
+                self._index(advisor)
+        for name in set(self._indexes) - names:
+            del self._indexes[name]
+
+    def mode(self, advisor: Advisor) -> str:
+        return advisor.get('prompt_mode', self.default_mode)
+
+    def system_prompt(self, advisor: Advisor, question: str) -> str:
+        if self.mode(advisor) != 'retrieval':
+            return advisor.system_prompt
+        prompt = self._index(advisor).prompt(question, int(advisor.get('retrieval_k', self.top_k)))
+        # вопрос не совпал ни с одним разделом — отдаём полный промпт
+        return prompt or advisor.system_prompt
+
+
+def make_retrieval_prompts() -> RetrievalPrompts:
+    """PROMPT_MODE — режим по умолчанию (full/retrieval), RETRIEVAL_TOP_K — число разделов."""
+    return RetrievalPrompts(
+        default_mode=os.environ.get('PROMPT_MODE', 'full'),
+        top_k=int(os.environ.get('RETRIEVAL_TOP_K', 4)),
+    )
+
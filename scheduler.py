@@ -0,0 +1,90 @@
+# scheduler.py
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+
+# Приоритеты очереди к OpenAI (меньше — раньше)
+PRIORITY_ADMIN      = 0
+PRIORITY_EXTENDED   = 1
+PRIORITY_BASIC      = 2
+PRIORITY_TRIAL      = 3
+# фоновые задачи (сжатие диалогов): слот — после всех ждущих вопросов пользователей
+PRIORITY_BACKGROUND = 4
+
+
+class SchedulerBusy(Exception):
+    """Очередь к OpenAI переполнена или ожидание слота истекло."""
+
+
+class RequestScheduler:
+    """Ограничивает число одновременных запросов к OpenAI.
+
+    Запросы сверх лимита ждут в ограниченной очереди с приоритетами:
+    слот освобождается — его получает самый приоритетный ожидающий.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue       = max_queue
+        self.queue_timeout   = queue_timeout
+        self._active  = 0
+        self._queued  = 0
+        self._waiters: list = []
+        self._seq     = itertools.count()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    async def acquire(self, priority: int = PRIORITY_TRIAL) -> None:
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            return
+        if self._queued >= self.max_queue:
+            raise SchedulerBusy('очередь переполнена')
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._queued += 1
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # слот уже передан нам — возвращаем его следующему
+                self.release()
+            else:
+                self._queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                raise SchedulerBusy('истекло время ожидания') from None
+            raise
+
+    def try_acquire(self) -> bool:
+        """Слот без ожидания — для дополнительных (хеджирующих) запросов."""
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            return True
+        return False
+
+    def release(self) -> None:
+        # передаём слот первому живому ожидающему, не уменьшая счётчик
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self._queued -= 1
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_TRIAL):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
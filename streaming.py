@@ -0,0 +1,169 @@
+# streaming.py
+
+import asyncio
+import html
+import logging
+import time
+from datetime import timedelta
+
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from outbound import DROPPABLE, rate_limit_kwargs
+from tg_html import TELEGRAM_LIMIT, MarkdownHTML, cut_html, is_parse_error, split_html, to_plain, utf16_len
+
+# Что видит пользователь, пока модель не прислала первые токены
+PLACEHOLDER = '⌛'
+
+
+def retry_delay(e: RetryAfter) -> float:
+    """Секунды ожидания из RetryAfter (int или timedelta в разных версиях PTB)."""
+    delay = e.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+async def reply_html(message: Message, text: str) -> None:
+    """Ответ в HTML по частям; если Telegram не принял разметку — та же часть без неё."""
+    for part in split_html(text):
+        try:
+            await message.reply_text(part, parse_mode=ParseMode.HTML)
+        except BadRequest as e:
+            if not is_parse_error(e):
+                raise
+            logging.warning('Telegram не принял HTML, отправляем без разметки: %s', e)
+            await message.reply_text(to_plain(part))
+
+
+class StreamingReply:
+    """Показывает ответ модели по мере генерации.
+
+    Сначала отправляется заглушка, затем она редактируется пачками
+    не чаще edit_interval секунд. Markdown модели переводится в HTML
+    по мере поступления (MarkdownHTML), каждая правка — корректный
+    HTML с закрытыми тегами. Текст длиннее лимита Telegram переносится
+    в новое сообщение, открытые теги в нём открываются заново.
+    """
+
+    def __init__(self, message: Message, edit_interval: float = 1.0, min_delta: int = 20):
+        self._message       = message
+        self._edit_interval = edit_interval
+        self._min_delta     = min_delta
+        self._sent: Message | None = None
+        self._html      = MarkdownHTML()
+        # текущее сообщение: с какого места HTML ответа и какие теги открыть в начале
+        self._start     = 0
+        self._prefix    = ''
+        self._shown     = ''
+        self._last_edit = 0.0
+        # суммарное время вызовов Telegram — для метрик
+        self.send_seconds = 0.0
+
+    @property
+    def _text(self) -> str:
+        return self._prefix + self._html.render()[self._start:]
+
+    async def start(self) -> None:
+        started = time.monotonic()
+        self._sent = await self._message.reply_text(PLACEHOLDER)
+        self._last_edit = time.monotonic()
+        self.send_seconds += self._last_edit - started
+
+    async def _next_message(self) -> None:
+        started = time.monotonic()
+        self._sent  = await self._message.reply_text(PLACEHOLDER)
+        self._shown = ''
+        self._last_edit = time.monotonic()
+        self.send_seconds += self._last_edit - started
+
+    async def feed(self, delta: str) -> None:
+        self._html.feed(delta)
+        while utf16_len(text := self._text) > TELEGRAM_LIMIT:
+            head, pos, reopen = cut_html(text)
+            await self._edit(head, final=True)
+            self._start += pos - len(self._prefix)
+            self._prefix = reopen
+            await self._next_message()
+
+        if (time.monotonic() - self._last_edit >= self._edit_interval
+                and len(self._text) - len(self._shown) >= self._min_delta):
+            await self._edit(self._text)
+
+    async def finish(self, footer: str = '') -> None:
+        """Ответ целиком: закрываем разметку, footer — уже готовый HTML."""
+        self._html.close()
+        parts = split_html(self._text + footer)
+        for i, part in enumerate(parts):
+            if i:
+                await self._next_message()
+            await self._edit(part, final=True)
+
+    async def fail(self, text: str) -> None:
+        """Ответ не получен: заглушку заменяем сообщением об ошибке."""
+        if self._sent is None:
+            await self._message.reply_text(text)
+        elif self._html.html[self._start:].strip():
+            await self.finish()
+            await self._message.reply_text(text)
+        else:
+            await self._edit(text, final=True)
+
+    async def _edit(self, text: str, final: bool = False) -> None:
+        text = text if to_plain(text).strip() else PLACEHOLDER
+        if text == self._shown and not final:
+            return
+        started = time.monotonic()
+        try:
+            if final:
+                await self._sent.edit_text(text, parse_mode=ParseMode.HTML)
+            else:
+                # промежуточную правку очередь исходящих не держит: нет токена — пропускаем
+                bot = self._sent.get_bot()
+                await bot.edit_message_text(
+                    text,
+                    chat_id=self._sent.chat_id,
+                    message_id=self._sent.message_id,
+                    parse_mode=ParseMode.HTML,
+                    **rate_limit_kwargs(bot, DROPPABLE),
+                )
+        except RetryAfter as e:
+            # промежуточные правки просто пропускаем, финальную — дожидаемся
+            if not final:
+                self._last_edit = time.monotonic() + retry_delay(e)
+                return
+            await asyncio.sleep(retry_delay(e))
+            return await self._edit(text, final)
+        except BadRequest as e:
+            if final and is_parse_error(e):
+                # оплаченный ответ не теряем: тот же текст без разметки
+                logging.warning('Telegram не принял HTML, отправляем без разметки: %s', e)
+                return await self._edit_plain(to_plain(text))
+            if 'not modified' not in str(e).lower():
+                if final:
+                    # итоговую правку не приняли — ответ уходит новым сообщением
+                    logging.warning('Не удалось обновить сообщение, отправляем новым: %s', e)
+                    return await self._resend(text)
+                logging.warning('Не удалось обновить сообщение: %s', e)
+        self._shown     = text
+        self._last_edit = time.monotonic()
+        self.send_seconds += self._last_edit - started
+
+    async def _edit_plain(self, text: str) -> None:
+        try:
+            await self._sent.edit_text(text)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logging.warning('Не удалось обновить сообщение, отправляем новым: %s', e)
+                for part in split_html(html.escape(text, quote=False)):
+                    await self._message.reply_text(to_plain(part))
+        self._shown     = text
+        self._last_edit = time.monotonic()
+
+    async def _resend(self, text: str) -> None:
+        started = time.monotonic()
+        await reply_html(self._message, text)
+        self._shown     = text
+        self._last_edit = time.monotonic()
+        self.send_seconds += self._last_edit - started
@@ -0,0 +1,11 @@
+# tests/conftest.py
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# модули читают настройки при импорте; база — временный SQLite
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='djanis-tests-'), 'test.db'))
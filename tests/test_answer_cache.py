@@ -0,0 +1,29 @@
+# tests/test_answer_cache.py
+
+import asyncio
+
+from answer_cache import AnswerCache, cache_key
+
+
+def test_key_depends_on_model_and_prompt_version():
+    base = cache_key('СУД', 'Как подать иск?', 'gpt-4o\0100.0\0full')
+    assert base == cache_key('СУД', 'как подать иск', 'gpt-4o\0100.0\0full')
+    assert base != cache_key('СУД', 'Как подать иск?', 'gpt-4o-mini\0100.0\0full')
+    assert base != cache_key('СУД', 'Как подать иск?', 'gpt-4o\0200.0\0full')
+    assert base != cache_key('СУД', 'Как подать иск?', 'gpt-4o\0100.0\0retrieval')
+
+
+def test_answers_of_different_models_do_not_mix():
+    cache = AnswerCache(maxsize=10, ttl=60)
+
+    async def run():
+        async def cheap():
+            return 'дешёвый ответ'
+
+        async def full():
+            return 'полный ответ'
+
+        await cache.get_or_compute('СУД', 'вопрос', cheap, 'mini')
+        return await cache.get_or_compute('СУД', 'вопрос', full, 'full')
+
+    assert asyncio.run(run()) == ('полный ответ', False)
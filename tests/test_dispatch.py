@@ -0,0 +1,65 @@
+# tests/test_dispatch.py
+
+import asyncio
+import gc
+import warnings
+from types import SimpleNamespace
+
+from telegram import Update
+
+from dispatch import ChatOrderedUpdateProcessor
+
+
+def message(chat_id: int, text: str) -> Update:
+    update = Update.__new__(Update)
+    object.__setattr__(update, '_effective_chat', SimpleNamespace(id=chat_id))
+    object.__setattr__(update, 'callback_query', None)
+    object.__setattr__(update, 'message', SimpleNamespace(text=text))
+    return update
+
+
+def test_chat_order_and_flood_does_not_block_other_chats():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(2, fast_lane=1)
+        log, gate = [], asyncio.Event()
+
+        async def handle(name, wait=False):
+            if wait:
+                await gate.wait()
+            log.append(name)
+
+        tasks = [asyncio.create_task(processor.process_update(message(1, str(i)), handle(f'a{i}', i == 0)))
+                 for i in range(5)]
+        tasks.append(asyncio.create_task(processor.process_update(message(2, 'b'), handle('b'))))
+        await asyncio.sleep(0.05)
+        # первый вопрос чата 1 ещё идёт — остальные ждут его, чат 2 уже обслужен
+        assert log == ['b']
+        assert processor.running == 1
+        gate.set()
+        await asyncio.gather(*tasks)
+        return log
+
+    assert asyncio.run(run()) == ['b', 'a0', 'a1', 'a2', 'a3', 'a4']
+
+
+def test_cancel_while_waiting_for_slot_closes_coroutine():
+    async def run():
+        processor = ChatOrderedUpdateProcessor(1, fast_lane=1)
+        gate = asyncio.Event()
+
+        async def handle():
+            await gate.wait()
+
+        busy    = asyncio.create_task(processor.process_update(message(1, 'q'), handle()))
+        waiting = asyncio.create_task(processor.process_update(message(2, 'q'), handle()))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        gate.set()
+        await busy
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        asyncio.run(run())
+        gc.collect()
+    assert not [w for w in caught if 'never awaited' in str(w.message)]
@@ -0,0 +1,149 @@
+# tests/test_entitlements.py
+
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy import delete, insert, select
+
+import entitlements
+import usage_writer
+from models import Base, User, async_engine, engine
+from usage_writer import UsageWriteBehind
+
+UID = 7000
+
+
+@pytest.fixture(autouse=True)
+def user():
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(delete(User))
+        conn.execute(insert(User), [{'user_id': UID, 'tariff': 'БМ', 'tariff_paid': True, 'tokens_used': 500,
+                                     'first_request': datetime.utcnow(), 'last_request': datetime.utcnow()}])
+    entitlements.entitlement_cache.invalidate(UID)
+    entitlements._carry.clear()
+    yield
+    asyncio.run(async_engine.dispose())
+
+
+def tokens_used() -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(User.tokens_used).filter_by(user_id=UID)).scalar()
+
+
+def test_activation_waits_for_batch_in_flight(monkeypatch):
+    real   = usage_writer.async_engine
+    writer = UsageWriteBehind(flush_interval=3600, max_pending=10 ** 6)
+    monkeypatch.setattr(entitlements, 'usage_writer', writer)
+
+    class SlowEngine:
+        @asynccontextmanager
+        async def begin(self):
+            await asyncio.sleep(0.05)
+            async with real.begin() as conn:
+                yield conn
+
+    monkeypatch.setattr(usage_writer, 'async_engine', SlowEngine())
+
+    async def run():
+        writer.add(UID, datetime.utcnow(), tokens=300)
+        flush = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0)
+        # пачка прошлого срока уже пишется — квота нового срока всё равно с нуля
+        await entitlements.activate_tariff(UID, 'РМ')
+        await flush
+
+    asyncio.run(run())
+    assert tokens_used() == 0
+
+
+def set_tokens(used: int) -> None:
+    with engine.begin() as conn:
+        conn.execute(User.__table__.update().where(User.user_id == UID).values(tokens_used=used))
+
+
+def test_concurrent_checks_count_every_message(monkeypatch):
+    monkeypatch.setattr(entitlements, 'usage_writer', None)
+
+    async def run():
+        return await asyncio.gather(*(entitlements.check_entitlement(UID, tokens=10) for _ in range(50)))
+
+    results = asyncio.run(run())
+    assert all(ent.allowed for ent in results)
+    with engine.connect() as conn:
+        count, used = conn.execute(select(User.usage_count, User.tokens_used).filter_by(user_id=UID)).one()
+    assert (count, used) == (50, 500 + 50 * 10)
+
+
+def test_concurrent_checks_do_not_overrun_quota(monkeypatch):
+    monkeypatch.setattr(entitlements, 'usage_writer', None)
+    quota = entitlements.token_quota('БМ')
+    set_tokens(quota - 95)
+
+    async def run():
+        return await asyncio.gather(*(entitlements.check_entitlement(UID, tokens=10) for _ in range(20)))
+
+    results = asyncio.run(run())
+    # резерв проходит, пока израсходовано меньше квоты: ровно 10 из 20
+    assert sum(ent.allowed for ent in results) == 10
+    assert {ent.status for ent in results if not ent.allowed} == {entitlements.QUOTA_EXHAUSTED}
+    assert tokens_used() == quota - 95 + 10 * 10
+
+
+def test_small_reconcile_rides_next_reservation(monkeypatch):
+    monkeypatch.setattr(entitlements, 'usage_writer', None)
+    monkeypatch.setattr(entitlements, 'RECONCILE_SLACK', 100)
+
+    async def run():
+        await entitlements.check_entitlement(UID, tokens=300)
+        # ответ вышел короче резерва: поправка мала — отдельного UPDATE нет
+        await entitlements.reconcile_tokens(UID, -60)
+        assert tokens_used() == 800
+        await entitlements.check_entitlement(UID, tokens=300)
+        assert tokens_used() == 800 - 60 + 300
+        # большая поправка пишется сразу и не уводит счётчик ниже нуля
+        await entitlements.reconcile_tokens(UID, -5000)
+        assert tokens_used() == 0
+
+    asyncio.run(run())
+    assert not entitlements._carry
+
+
+def test_activation_forgets_old_reservations(monkeypatch):
+    monkeypatch.setattr(entitlements, 'usage_writer', None)
+
+    async def run():
+        await entitlements.check_entitlement(UID, tokens=300)
+        await entitlements.reconcile_tokens(UID, -40)
+        await entitlements.activate_tariff(UID, 'РМ')
+        await entitlements.check_entitlement(UID, tokens=100)
+
+    asyncio.run(run())
+    # возврат по прошлому сроку к новой квоте не применяется
+    assert tokens_used() == 100
+
+
+def test_write_behind_reserve_reconcile_and_discard(monkeypatch):
+    writer = UsageWriteBehind(flush_interval=3600, max_pending=10 ** 6)
+    monkeypatch.setattr(entitlements, 'usage_writer', writer)
+
+    async def run():
+        ent = await entitlements.check_entitlement(UID, tokens=300)
+        assert ent.allowed and ent.tokens_used == 800
+        await entitlements.reconcile_tokens(UID, -100)
+        assert writer.pending(UID)[2] == 200
+        await writer.flush()
+        assert tokens_used() == 700
+
+        await entitlements.check_entitlement(UID, tokens=300)
+        # оплата нового срока: незаписанный расход прошлого забывается, счётчик запросов — нет
+        await entitlements.activate_tariff(UID, 'РМ')
+        assert writer.pending(UID)[:3:2] == (1, 0)
+        await writer.flush()
+
+    asyncio.run(run())
+    assert tokens_used() == 0
+    with engine.connect() as conn:
+        assert conn.execute(select(User.usage_count).filter_by(user_id=UID)).scalar() == 2
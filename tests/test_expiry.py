@@ -0,0 +1,74 @@
+# tests/test_expiry.py
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, insert, select
+
+from expiry import EXPIRED_TEXT, ExpirySweeper
+from models import Base, User, async_engine, engine
+
+NOW = datetime(2026, 10, 18, 12, 0)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def user(uid, tariff='БМ', expires=None, first=NOW - timedelta(days=1), paid=True, notified=False):
+    return {'user_id': uid, 'tariff': tariff, 'tariff_paid': paid, 'tariff_expires_at': expires,
+            'expiry_notified': notified, 'first_request': first, 'last_request': first}
+
+
+@pytest.fixture(autouse=True)
+def users():
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(delete(User))
+        conn.execute(insert(User), [
+            user(1, expires=NOW - timedelta(hours=1)),               # срок вышел
+            user(2, expires=NOW + timedelta(days=1)),                # скоро выйдет
+            user(3, expires=NOW + timedelta(days=20)),               # ещё долго
+            user(4, expires=None, first=NOW - timedelta(days=40)),   # выставлен в базе, месяц прошёл
+            user(5, expires=None, first=NOW - timedelta(days=29)),   # выставлен в базе, кончается завтра
+            user(6, expires=None, first=NOW - timedelta(days=3)),    # выставлен в базе, ещё действует
+            user(7, tariff='', expires=None, first=NOW - timedelta(days=400)),  # тестовый доступ
+        ])
+    yield
+    asyncio.run(async_engine.dispose())
+
+
+def paid() -> dict[int, bool]:
+    with engine.connect() as conn:
+        return dict(conn.execute(select(User.user_id, User.tariff_paid)).all())
+
+
+def test_sweep_expires_and_warns_once():
+    bot     = FakeBot()
+    sweeper = ExpirySweeper(batch_size=2, notice_before=timedelta(days=3))
+
+    async def run():
+        first  = await sweeper.sweep(bot, NOW)
+        second = await sweeper.sweep(bot, NOW)
+        await async_engine.dispose()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == (2, 2)
+    # повторная проверка никого не трогает и не шлёт уведомления заново
+    assert second == (0, 0)
+    assert paid() == {1: False, 2: True, 3: True, 4: False, 5: True, 6: True, 7: True}
+    assert sorted(uid for uid, text in bot.sent if text == EXPIRED_TEXT) == [1, 4]
+    assert sorted(uid for uid, text in bot.sent if text != EXPIRED_TEXT) == [2, 5]
+
+
+def test_tariff_set_in_database_expires_from_first_request():
+    legacy = User(tariff='РГ', tariff_paid=True, first_request=NOW, tariff_expires_at=None)
+    assert legacy.tariff_expires() == datetime(2027, 10, 18, 12, 0)
+    trial = User(tariff='', tariff_paid=True, first_request=NOW, tariff_expires_at=None)
+    assert trial.tariff_expires() is None
@@ -0,0 +1,119 @@
+# tests/test_gateway.py
+
+import asyncio
+from types import SimpleNamespace
+
+import gateway
+from gateway import CircuitBreaker, CompletionGateway
+from scheduler import RequestScheduler
+
+
+def test_late_success_does_not_close_open_breaker():
+    breaker = CircuitBreaker(failures=1, cooldown=0.05)
+    started = gateway.time.monotonic()
+    breaker.failure()
+    assert breaker.state == 'open'
+    # запрос, ушедший до срабатывания, вернулся успешно
+    breaker.success(0.01, started)
+    assert breaker.state == 'open'
+
+    gateway.time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success(0.01, started)
+    assert breaker.state == 'half_open'
+    breaker.success(0.01, gateway.time.monotonic())
+    assert breaker.state == 'closed'
+
+
+class FlakyStreams:
+    """Первый запрос падает по таймауту, второй отдаёт один фрагмент."""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat  = SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            raise asyncio.TimeoutError
+
+        return FakeStream([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content='ok'))], usage=None)])
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+
+def test_stream_backoff_does_not_hold_slot():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1, max_queue=10, queue_timeout=5)
+        gw = CompletionGateway(FlakyStreams(), scheduler, retries=1, backoff=0.2, backoff_max=0.2)
+        gw._delay = lambda attempt: 0.2
+        seen = []
+
+        async def watch():
+            await asyncio.sleep(0.1)
+            # первая попытка упала, идёт пауза — слот свободен
+            seen.append(scheduler.try_acquire())
+            scheduler.release()
+
+        watcher = asyncio.create_task(watch())
+        parts = [part async for part in gw.stream([], 'gpt-4o')]
+        await watcher
+        return parts, seen, scheduler.try_acquire()
+
+    parts, seen, free_after = asyncio.run(run())
+    assert parts == ['ok']
+    assert seen == [True]
+    assert free_after
+
+
+class TricklingStreams:
+    """Поток, который шлёт по фрагменту раз в 50 мс и не кончается."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        return TricklingStream()
+
+
+class TricklingStream(FakeStream):
+    def __init__(self):
+        pass
+
+    async def __anext__(self):
+        await asyncio.sleep(0.05)
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content='.'))], usage=None)
+
+
+def test_stream_deadline_covers_whole_call():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1, max_queue=10, queue_timeout=5)
+        gw = CompletionGateway(TricklingStreams(), scheduler, deadline=0.3, retries=0,
+                               breaker={'failures': 1})
+        parts = []
+        try:
+            async for part in gw.stream([], 'gpt-4o'):
+                parts.append(part)
+        except asyncio.TimeoutError:
+            pass
+        return parts, gw.breaker('gpt-4o').state
+
+    parts, state = asyncio.run(run())
+    # каждый фрагмент приходит быстрее дедлайна, но весь вызов — нет
+    assert 2 <= len(parts) <= 8
+    assert state == 'open'
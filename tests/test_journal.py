@@ -0,0 +1,123 @@
+# tests/test_journal.py
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, select
+
+from journal import UpdateJournal
+from models import Base, JournaledUpdate, async_engine, engine
+
+
+@pytest.fixture(autouse=True)
+def table():
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(delete(JournaledUpdate))
+    yield
+    asyncio.run(async_engine.dispose())
+
+
+class Processor:
+    async def process_update(self, update, coroutine):
+        await coroutine
+
+
+def make_app(handle):
+    """Приложение-заглушка: journal берёт у него только bot, процессор и process_update."""
+    return SimpleNamespace(bot=None, update_processor=Processor(), process_update=handle)
+
+
+def payload(update_id: int) -> str:
+    return json.dumps({'update_id': update_id})
+
+
+def rows() -> dict[int, tuple]:
+    with engine.connect() as conn:
+        return {r.update_id: (r.attempts, r.done_at is not None)
+                for r in conn.execute(select(JournaledUpdate))}
+
+
+async def until(condition, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    end  = loop.time() + timeout
+    while not condition():
+        assert loop.time() < end, 'не дождались'
+        await asyncio.sleep(0.01)
+
+
+def test_duplicates_dropped_by_update_id():
+    async def run():
+        journal = UpdateJournal()
+        # повтор внутри одной пачки и повтор после записи
+        first = await asyncio.gather(*(journal.append(uid, payload(uid)) for uid in (1, 2, 1)))
+        again = await journal.append(2, payload(2))
+        await async_engine.dispose()
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert first == [True, True, False]
+    assert again is False
+    assert set(rows()) == {1, 2}
+
+
+def test_unfinished_updates_replayed_after_restart():
+    seen = []
+
+    async def crash():
+        journal = UpdateJournal(poll_interval=0.01, stop_timeout=0.05)
+        stuck   = asyncio.Event()
+
+        async def hang(update):
+            await stuck.wait()
+
+        await journal.start(make_app(hang))
+        for uid in (10, 11, 12):
+            await journal.append(uid, payload(uid))
+        await until(lambda: journal.in_flight == 3)
+        # процесс остановился, не дождавшись обработки
+        await journal.stop()
+        await async_engine.dispose()
+
+    async def restart():
+        journal = UpdateJournal(poll_interval=0.01)
+
+        async def handle(update):
+            seen.append(update.update_id)
+
+        await journal.start(make_app(handle))
+        await until(lambda: len(seen) == 3 and not journal.in_flight)
+        await journal.stop()
+        await async_engine.dispose()
+
+    asyncio.run(crash())
+    assert rows() == {10: (1, False), 11: (1, False), 12: (1, False)}
+    asyncio.run(restart())
+    # порядок update_id сохраняется, вторая попытка засчитана
+    assert seen == [10, 11, 12]
+    assert rows() == {10: (2, True), 11: (2, True), 12: (2, True)}
+
+
+def test_retry_hands_update_back_until_max_attempts():
+    calls = []
+
+    async def run():
+        journal = UpdateJournal(poll_interval=0.01, max_attempts=3)
+
+        async def lost(update):
+            # воркер не подтвердил обработку
+            calls.append(update.update_id)
+            journal.retry(update.update_id)
+
+        await journal.start(make_app(lost))
+        await journal.append(20, payload(20))
+        await until(lambda: len(calls) == 3 and not journal.in_flight)
+        await asyncio.sleep(0.05)
+        await journal.stop()
+        await async_engine.dispose()
+
+    asyncio.run(run())
+    assert calls == [20, 20, 20]
+    assert rows() == {20: (3, False)}
@@ -0,0 +1,31 @@
+# tests/test_ledger.py
+
+import asyncio
+
+from sqlalchemy import delete, func, select
+
+from ledger import UsageLedger
+from models import Base, UsageEvent, async_engine, engine
+
+
+def test_stop_during_flush_writes_each_row_once():
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(delete(UsageEvent))
+
+    async def run():
+        ledger = UsageLedger(flush_interval=0.001, max_buffer=5)
+        await ledger.start()
+        for i in range(300):
+            ledger.record(i, 'СУД', 'gpt-4o', 10, 20)
+            if i % 7 == 0:
+                await asyncio.sleep(0)
+        # останавливаем, пока фоновая запись занята очередной пачкой
+        await ledger.stop()
+        await async_engine.dispose()
+        return ledger
+
+    ledger = asyncio.run(run())
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(UsageEvent)).scalar() == 300
+    assert ledger.written == 300
@@ -0,0 +1,28 @@
+# tests/test_ratelimit.py
+
+from ratelimit import RateLimiter, USER_LIMIT
+
+
+def make_limiter():
+    # пробный: 1 в минуту, запас 2; платный: 60 в минуту, запас 5
+    return RateLimiter({'': (1, 2), 'pro': (60, 5)}, chat_limit=(600, 100), global_limit=(6000, 1000))
+
+
+def test_unknown_tariff_keeps_paid_bucket():
+    limiter = make_limiter()
+    assert limiter.check(1, 1, 'pro') is None
+    # снимок тарифа выпал из кэша — лимит остаётся платным, а не пробным
+    for _ in range(3):
+        assert limiter.check(1, 1, None) is None
+    assert limiter._users[1].capacity == 5
+
+
+def test_tariff_switch_does_not_refill_bucket():
+    limiter = make_limiter()
+    for _ in range(2):
+        assert limiter.check(1, 1, '') is None
+    assert limiter.check(1, 1, '') == USER_LIMIT
+    # смена тарифа меняет темп и запас, но не выдаёт полное ведро
+    assert limiter.check(1, 1, 'pro') == USER_LIMIT
+    assert limiter._users[1].capacity == 5
+    assert limiter.check(1, 1, '') == USER_LIMIT
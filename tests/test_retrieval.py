@@ -0,0 +1,64 @@
+# tests/test_retrieval.py
+
+from advisors import Advisor, FORMAT_INSTR
+from retrieval import BM25Index, RetrievalPrompts, split_sections
+
+SEP = '\n________________________________________\n'
+SECTIONS = [
+    'Ты — юрист-советник. Отвечай по делу.',
+    'Исковое заявление подаётся в суд по месту жительства ответчика. Госпошлина зависит от цены иска.',
+    'Банковский вклад застрахован до 1,4 млн рублей. Проценты по вкладу облагаются налогом.',
+    'Наследство принимается в течение шести месяцев. Завещание удостоверяет нотариус.',
+]
+
+
+def advisor(mode: str = 'retrieval', mtime: float = 1.0, sections=SECTIONS) -> Advisor:
+    prompt = SEP.join(sections)
+    return Advisor(name='СУД', path='', mtime=mtime, data={'prompt_mode': mode, 'system_prompt': prompt,
+                                                          'retrieval_k': 1},
+                   system_prompt=prompt + FORMAT_INSTR, prompt_tokens=0)
+
+
+def test_split_sections_by_separator():
+    assert split_sections(SEP.join(SECTIONS)) == SECTIONS
+
+
+def test_bm25_ranks_matching_section_first():
+    index = BM25Index(SECTIONS[1:])
+    assert index.search('Какая госпошлина за исковое заявление?', 2)[0] == 0
+    assert index.search('облагаются ли проценты по вкладу', 1) == [1]
+    assert index.search('нотариус и завещание', 3)[0] == 2
+    # ни одного общего слова — пусто
+    assert index.search('погода завтра', 3) == []
+
+
+def test_bm25_rare_terms_outweigh_common_ones():
+    docs  = ['налог налог вклад', 'налог штраф', 'налог пеня']
+    index = BM25Index(docs)
+    assert index.search('налог вклад', 3)[0] == 0
+    assert index.search('пеня', 3) == [2]
+
+
+def test_retrieval_prompt_is_core_plus_relevant_section():
+    prompts = RetrievalPrompts()
+    prompt  = prompts.system_prompt(advisor(), 'Сколько ждать принятия наследства?')
+    assert prompt == SECTIONS[0] + SEP + SECTIONS[3] + FORMAT_INSTR
+
+
+def test_falls_back_to_full_prompt():
+    prompts = RetrievalPrompts()
+    # вопрос мимо всех разделов и режим full — полный промпт
+    assert prompts.system_prompt(advisor(), 'погода завтра') == advisor().system_prompt
+    assert prompts.system_prompt(advisor('full'), 'наследство') == advisor('full').system_prompt
+
+
+def test_index_rebuilt_when_advisor_file_changes():
+    prompts = RetrievalPrompts()
+    prompts.build([advisor()])
+    first = prompts._indexes['СУД']
+    prompts.build([advisor()])
+    assert prompts._indexes['СУД'] is first
+    changed = advisor(mtime=2.0, sections=SECTIONS[:2] + ['Алименты взыскиваются по решению суда.'])
+    assert 'Алименты' in prompts.system_prompt(changed, 'как взыскать алименты')
+    prompts.build([])
+    assert not prompts._indexes
@@ -0,0 +1,28 @@
+# tests/test_scheduler.py
+
+import asyncio
+
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_TRIAL, RequestScheduler
+
+
+def test_background_waits_behind_trial_questions():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1, max_queue=10, queue_timeout=5)
+        order = []
+
+        async def call(name, priority):
+            async with scheduler.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        await scheduler.acquire()
+        # сводка встала в очередь раньше вопроса, но слот получит после него
+        tasks = [asyncio.create_task(call('summary', PRIORITY_BACKGROUND))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call('question', PRIORITY_TRIAL)))
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ['question', 'summary']
@@ -0,0 +1,50 @@
+# tests/test_streaming.py
+
+import asyncio
+
+from telegram.error import BadRequest
+
+from streaming import StreamingReply
+from tg_html import to_plain
+
+
+class FakeMessage:
+    """Сообщение Telegram без сети: помнит отправленное и правки."""
+
+    def __init__(self, chat, fail_edit=None):
+        self.chat      = chat
+        self.fail_edit = fail_edit
+        self.text      = ''
+        self.chat_id, self.message_id = 1, len(chat)
+
+    async def reply_text(self, text, **kwargs):
+        message = FakeMessage(self.chat, self.fail_edit)
+        message.text = text
+        self.chat.append(message)
+        return message
+
+    async def edit_text(self, text, **kwargs):
+        if self.fail_edit:
+            raise BadRequest(self.fail_edit)
+        self.text = text
+
+    def get_bot(self):
+        return self
+
+    async def edit_message_text(self, text, **kwargs):
+        self.chat[kwargs['message_id']].text = text
+
+
+def test_failed_final_edit_is_sent_as_new_message():
+    chat   = []
+    origin = FakeMessage(chat, fail_edit='Message is too long')
+
+    async def run():
+        reply = StreamingReply(origin, edit_interval=0)
+        await reply.start()
+        await reply.feed('Ответ **целиком**, ')
+        await reply.feed('до последнего слова.')
+        await reply.finish('\n— 100 токенов')
+
+    asyncio.run(run())
+    assert to_plain(chat[-1].text) == 'Ответ целиком, до последнего слова.\n— 100 токенов'
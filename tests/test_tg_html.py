@@ -0,0 +1,54 @@
+# tests/test_tg_html.py
+
+import random
+
+from tg_html import TELEGRAM_LIMIT, MarkdownHTML, markdown_to_html, split_html, to_plain, utf16_len
+
+
+def stream(text: str, rnd: random.Random) -> str:
+    converter = MarkdownHTML()
+    i = 0
+    while i < len(text):
+        step = rnd.randint(1, 6)
+        converter.feed(text[i:i + step])
+        converter.render()
+        i += step
+    return converter.close()
+
+
+def test_fence_closes_only_on_bare_marker():
+    # текст после «```» на той же строке — не закрытие блока, и он не теряется
+    html = markdown_to_html('```\nx = 1\n``` — вот и весь код.\nДальше.')
+    assert 'вот и весь код.' in html and 'Дальше.' in html
+    assert html.startswith('<pre>x = 1\n``` — вот')
+
+
+def test_fence_with_language_inside_fence_is_content():
+    html = markdown_to_html('```\nx = 1\n```python\ny\n```\nДальше.')
+    assert html == '<pre>x = 1\n```python\ny\n</pre>\nДальше.'
+
+
+def test_fence_closing_marker_split_across_chunks():
+    text = '```\nx = 1\n``` — вот и весь код.\nДальше.'
+    converter = MarkdownHTML()
+    for chunk in ('```\nx = 1\n```', ' — вот и весь код.\nДальше.'):
+        converter.feed(chunk)
+    assert converter.close() == markdown_to_html(text)
+
+
+def test_stream_matches_single_feed():
+    atoms = ['```', '```py', '`', '``', '*', '**', '_', '__', '~~', '[', ']', '(', ')',
+             'https://a.b', '\n', '\n\n', ' ', 'ab', 'слово', '# ', '#', '- ', '\\', '<', '&']
+    rnd = random.Random(1)
+    for _ in range(3000):
+        text = ''.join(rnd.choice(atoms) for _ in range(rnd.randint(1, 25)))
+        assert stream(text, rnd) == markdown_to_html(text), text
+
+
+def test_split_counts_utf16_units():
+    # эмодзи — две единицы UTF-16: по символам часть влезает, по меркам Telegram — нет
+    text  = markdown_to_html(('Пункт 🙂 **важно** 👍\n' * 400))
+    parts = split_html(text)
+    assert len(parts) > 1
+    assert all(utf16_len(part) <= TELEGRAM_LIMIT for part in parts)
+    assert to_plain(''.join(parts)).replace('\n', '') == to_plain(text).replace('\n', '')
@@ -0,0 +1,118 @@
+# tests/test_usage_writer.py
+
+import asyncio
+import random
+from datetime import datetime
+
+import pytest
+from sqlalchemy import delete, insert, select
+
+import usage_writer
+from models import Base, User, async_engine, engine
+from usage_writer import UsageWriteBehind
+
+USERS = list(range(5000, 5050))
+
+
+@pytest.fixture(autouse=True)
+def users():
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(delete(User))
+        conn.execute(insert(User), [{'user_id': uid} for uid in USERS])
+    yield
+    asyncio.run(async_engine.dispose())
+
+
+def counts() -> dict[int, int]:
+    with engine.connect() as conn:
+        return dict(conn.execute(select(User.user_id, User.usage_count)).all())
+
+
+async def load(writer: UsageWriteBehind, tasks: int = 40, per_task: int = 50) -> dict[int, int]:
+    """Много корутин одновременно считают запросы, пока фоновая запись сбрасывает пачки."""
+    expected = dict.fromkeys(USERS, 0)
+    rnd = random.Random(7)
+
+    async def client():
+        for _ in range(per_task):
+            uid = rnd.choice(USERS)
+            writer.add(uid, datetime.utcnow())
+            expected[uid] += 1
+            await asyncio.sleep(rnd.random() * 0.002)
+
+    await asyncio.gather(*(client() for _ in range(tasks)))
+    return expected
+
+
+def test_no_increments_lost_under_concurrent_load():
+    async def run():
+        writer = UsageWriteBehind(flush_interval=0.005, max_pending=10)
+        await writer.start()
+        expected = await load(writer)
+        await writer.stop()
+        return expected, writer
+
+    expected, writer = asyncio.run(run())
+    assert counts() == expected
+    assert writer.epoch > 1
+
+
+def test_failed_flushes_are_retried(tmp_path, monkeypatch):
+    real  = usage_writer.async_engine
+    calls = 0
+
+    class FlakyEngine:
+        # каждая третья пачка не записывается — дельты должны вернуться в очередь
+        def begin(self):
+            nonlocal calls
+            calls += 1
+            if calls % 3 == 0:
+                raise ConnectionError('база недоступна')
+            return real.begin()
+
+    monkeypatch.setattr(usage_writer, 'async_engine', FlakyEngine())
+
+    path = str(tmp_path / 'usage.log')
+
+    async def run():
+        writer = UsageWriteBehind(flush_interval=0.005, max_pending=10, journal_path=path)
+        await writer.start()
+        expected = await load(writer)
+        await writer.stop()
+        return expected
+
+    async def restart():
+        # если не записалась и последняя пачка при остановке, она осталась в журнале
+        monkeypatch.setattr(usage_writer, 'async_engine', real)
+        writer = UsageWriteBehind(journal_path=path)
+        await writer.start()
+        await writer.stop()
+
+    expected = asyncio.run(run())
+    asyncio.run(restart())
+    assert counts() == expected
+    assert calls >= 3
+
+
+def test_journal_replayed_after_crash(tmp_path):
+    path = str(tmp_path / 'usage.log')
+
+    async def crash():
+        writer = UsageWriteBehind(flush_interval=3600, max_pending=10 ** 6, journal_path=path)
+        await writer.start()
+        expected = await load(writer, tasks=10, per_task=20)
+        # процесс «упал»: пачка в базу не ушла, остался только журнал
+        writer._task.cancel()
+        writer._journal.close()
+        return expected
+
+    async def restart():
+        writer = UsageWriteBehind(journal_path=path)
+        await writer.start()
+        await writer.stop()
+
+    expected = asyncio.run(crash())
+    assert set(counts().values()) == {0}
+    asyncio.run(restart())
+    assert counts() == expected
@@ -0,0 +1,374 @@
+# tg_html.py
+
+import html
+import re
+
+from telegram.error import BadRequest
+
+# Максимальная длина одного сообщения Telegram — в единицах UTF-16, как считает Telegram
+TELEGRAM_LIMIT = 4096
+
+_LINK     = re.compile(r'\[([^\]\n]{1,300})\]\(([^)\s]{1,2000})\)')
+_SAFE_URL = re.compile(r'(https?://|tg://|mailto:)', re.I)
+_HEADING  = re.compile(r'#{1,6}[ \t]+')
+_BULLET   = re.compile(r'([ \t]*)[-*+][ \t]+')
+_LANG     = re.compile(r'[\w+#.-]{1,30}')
+_PLAIN    = re.compile(r'[^*_~`\[\n\\<>&]+')
+_TOKEN    = re.compile(r'<[^>]*>|&#?\w+;|[^<&]+')
+_TAG      = re.compile(r'<(/?)([\w-]+)')
+
+# Сколько символов ждать «](…)» после «[», прежде чем считать скобку обычным символом
+_LINK_WAIT = 300
+
+
+def _escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def utf16_len(text: str) -> int:
+    """Длина в единицах UTF-16: эмодзи и другие символы вне BMP — по две."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _fit(text: str, room: int) -> int:
+    """Сколько первых символов text укладывается в room единиц UTF-16."""
+    if utf16_len(text) == len(text):
+        return min(room, len(text))
+    units = 0
+    for i, ch in enumerate(text):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > room:
+            return i
+    return len(text)
+
+
+class MarkdownHTML:
+    """Потоковый перевод Markdown модели в HTML, который принимает Telegram.
+
+    feed() принимает куски ответа в том виде, как их отдаёт модель; текст
+    проходится один раз. Маркер, который ещё нельзя распознать (одна «*»
+    в конце куска может оказаться «**», «[» — началом ссылки), ждёт
+    следующего куска. render() в любой момент отдаёт корректный HTML:
+    всё разобранное плюс закрывающие теги для открытых. Поддерживаются
+    **жирный**, *курсив*, ~~зачёркнутый~~, `код`, блоки ```, заголовки #,
+    списки «-»/«*» и [ссылки](https://…); «<», «>» и «&» экранируются.
+    """
+
+    def __init__(self):
+        self._html    = ''
+        self._pending = ''
+        # (markdown-маркер, открывающий тег, закрывающий тег, приостановленные теги)
+        self._stack: list[tuple[str, str, str, list]] = []
+        self._line_start = True
+        self._prev       = '\n'
+
+    @property
+    def html(self) -> str:
+        """Уже разобранная часть: только дописывается, поэтому в ней можно хранить смещения."""
+        return self._html
+
+    def feed(self, text: str) -> None:
+        self._pending += text
+        self._consume(final=False)
+
+    def close(self) -> str:
+        """Конец ответа: недоразобранные маркеры становятся обычным текстом."""
+        self._consume(final=True)
+        return self.render()
+
+    def render(self) -> str:
+        return self._html + ''.join(entry[2] for entry in reversed(self._stack))
+
+    # ————— теги —————
+    def _open(self, marker: str, open_tag: str, close_tag: str, suspended: list | None = None) -> None:
+        self._stack.append((marker, open_tag, close_tag, suspended or []))
+        self._html += open_tag
+
+    def _close(self, marker: str) -> None:
+        # закрываем до маркера и заново открываем то, что было внутри
+        above = []
+        while self._stack:
+            entry = self._stack.pop()
+            self._html += entry[2]
+            if entry[0] == marker:
+                for reopened in reversed(above):
+                    self._open(*reopened)
+                for resumed in entry[3]:
+                    self._open(*resumed)
+                return
+            above.append(entry)
+
+    def _suspend(self) -> list:
+        # в code и pre Telegram не допускает вложенных тегов — временно закрываем
+        suspended = []
+        while self._stack:
+            entry = self._stack.pop()
+            self._html += entry[2]
+            suspended.insert(0, entry)
+        return suspended
+
+    def _opened(self, marker: str) -> bool:
+        return any(entry[0] == marker for entry in self._stack)
+
+    # ————— разбор —————
+    def _consume(self, final: bool) -> None:
+        s, i = self._pending, 0
+        while i < len(s):
+            top = self._stack[-1][0] if self._stack else None
+            if top == '```':
+                step = self._in_fence(s, i, final)
+            elif top in ('`', '``'):
+                step = self._in_code(s, i, top, final)
+            elif self._line_start:
+                step = self._block(s, i, final)
+            else:
+                step = self._inline(s, i, final)
+            if step is None:
+                break
+            if step > i:
+                self._prev = s[step - 1]
+            i = step
+        self._pending = s[i:]
+
+    def _in_fence(self, s: str, i: int, final: bool) -> int | None:
+        end = s.find('\n', i)
+        if self._line_start:
+            line = (s[i:] if end < 0 else s[i:end]).lstrip(' \t')
+            # блок закрывает строка из одних «```»; «```python» или «``` — текст» — содержимое блока
+            closing = line.startswith('```') and not line[3:].strip()
+            if not final and end < 0 and (closing or '```'.startswith(line)):
+                return None
+            if closing:
+                self._close('```')
+                self._line_start = False
+                return len(s) if end < 0 else end
+        end = len(s) if end < 0 else end + 1
+        self._html += _escape(s[i:end])
+        self._line_start = s[end - 1] == '\n'
+        return end
+
+    def _in_code(self, s: str, i: int, marker: str, final: bool) -> int | None:
+        end = s.find(marker, i)
+        newline = s.find('\n', i)
+        if 0 <= newline and (end < 0 or newline < end):
+            # незакрытый `код` не тянем на следующие строки
+            self._html += _escape(s[i:newline])
+            self._close(marker)
+            return newline
+        if end < 0:
+            stop = len(s) - (0 if final else len(marker) - 1)
+            self._html += _escape(s[i:stop])
+            return stop if stop > i else None
+        self._html += _escape(s[i:end])
+        self._close(marker)
+        return end + len(marker)
+
+    def _block(self, s: str, i: int, final: bool) -> int | None:
+        newline = s.find('\n', i)
+        line    = s[i:] if newline < 0 else s[i:newline]
+        stripped = line.lstrip(' \t')
+        if not final and newline < 0 and (not stripped.strip('#-*+` \t') or stripped.startswith('```')):
+            # начало строки ещё может оказаться блоком кода, заголовком или пунктом списка
+            return None
+        self._line_start = False
+        if stripped.startswith('```'):
+            lang = stripped[3:].strip()
+            # блок кода — отдельный абзац, выделение вокруг него не продолжаем
+            self._suspend()
+            if _LANG.fullmatch(lang):
+                self._open('```', f'<pre><code class="language-{lang}">', '</code></pre>')
+            else:
+                self._open('```', '<pre>', '</pre>')
+            self._line_start = True
+            return len(s) if newline < 0 else newline + 1
+        m = _HEADING.match(stripped)
+        if m:
+            self._open('\n', '<b>', '</b>')
+            return i + len(line) - len(stripped) + m.end()
+        m = _BULLET.match(line)
+        if m:
+            self._html += m.group(1) + '• '
+            return i + m.end()
+        return i
+
+    def _inline(self, s: str, i: int, final: bool) -> int | None:
+        c = s[i]
+        if c == '\n':
+            if self._opened('\n'):
+                self._close('\n')
+            if self._prev == '\n':
+                # пустая строка — конец абзаца: незакрытое выделение дальше не тянем
+                while self._stack:
+                    self._close(self._stack[-1][0])
+            self._html += '\n'
+            self._line_start = True
+            return i + 1
+        if c == '\\':
+            if i + 1 >= len(s):
+                if not final:
+                    return None
+                self._html += '\\'
+                return i + 1
+            self._html += _escape(s[i + 1])
+            return i + 2
+        if c in '<>&':
+            self._html += _escape(c)
+            return i + 1
+        if c == '[':
+            return self._link(s, i, final)
+        if c in '*_~`':
+            run = len(s) - i - len(s[i:].lstrip(c))
+            if i + run >= len(s) and not final:
+                return None
+            return self._marker(s, i, c, run, final)
+        m = _PLAIN.match(s, i)
+        self._html += _escape(m.group())
+        return m.end()
+
+    def _marker(self, s: str, i: int, c: str, run: int, final: bool) -> int:
+        after = s[i + run] if i + run < len(s) else ' '
+        if c == '`':
+            if run > 2:
+                self._html += _escape(c * run)
+            else:
+                self._open(c * run, '<code>', '</code>', self._suspend())
+            return i + run
+        if c == '~':
+            if run != 2:
+                self._html += _escape(c * run)
+            elif self._opened('~~') and not self._prev.isspace():
+                self._close('~~')
+            elif not after.isspace():
+                self._open('~~', '<s>', '</s>')
+            else:
+                self._html += '~~'
+            return i + run
+
+        pos = i
+        while run > 0:
+            marker = c * min(run, 2)
+            if run >= 2 and self._stack and self._stack[-1][0] == c and self._opened(c * 2):
+                # «***» закрывает сначала внутренний курсив, потом жирный
+                marker = c
+            before = s[pos - 1] if pos > i else self._prev
+            if self._opened(marker):
+                if not before.isspace() and not (c == '_' and after.isalnum()):
+                    self._close(marker)
+                else:
+                    self._html += marker
+            elif not after.isspace() and not before.isalnum():
+                # внутри слова (a*b, snake_case) маркер не открывает выделение
+                tag = 'b' if len(marker) == 2 else 'i'
+                self._open(marker, f'<{tag}>', f'</{tag}>')
+            else:
+                self._html += marker
+            pos += len(marker)
+            run -= len(marker)
+        return pos
+
+    def _link(self, s: str, i: int, final: bool) -> int | None:
+        m = _LINK.match(s, i)
+        if m and _SAFE_URL.match(m.group(2)):
+            href = html.escape(m.group(2), quote=True)
+            self._html += f'<a href="{href}">{_escape(m.group(1))}</a>'
+            return m.end()
+        rest = s[i:]
+        if not m and not final and '\n' not in rest and len(rest) < _LINK_WAIT:
+            return None
+        self._html += '['
+        return i + 1
+
+
+def markdown_to_html(text: str) -> str:
+    converter = MarkdownHTML()
+    converter.feed(text)
+    return converter.close()
+
+
+# ————— разрез на сообщения —————
+def _tag_name(tag: str) -> tuple[bool, str]:
+    m = _TAG.match(tag)
+    return (m.group(1) == '/', m.group(2).lower()) if m else (False, '')
+
+
+def _closers(stack: list[tuple[str, str]]) -> str:
+    return ''.join(f'</{name}>' for name, _ in reversed(stack))
+
+
+def cut_html(text: str, limit: int = TELEGRAM_LIMIT) -> tuple[str, int, str]:
+    """Первая часть HTML не длиннее limit единиц UTF-16 (вместе с разметкой).
+
+    Возвращает (часть с закрытыми тегами, позицию продолжения в text,
+    теги, которые надо открыть заново в начале следующей части). Режет
+    по переводу строки во второй половине, иначе по пробелу, иначе по
+    лимиту; теги и сущности (&amp;) не разрываются.
+    """
+    stack: list[tuple[str, str]] = []
+    best = None
+    # длина до текущего токена в единицах UTF-16; индексы в text — в символах
+    used = 0
+    for m in _TOKEN.finditer(text):
+        start, token = m.start(), m.group()
+        size = utf16_len(token)
+        if token[0] == '<':
+            closing, name = _tag_name(token)
+            if closing:
+                # закрывающий тег снимает последний открытый с тем же именем
+                k = max((k for k, entry in enumerate(stack) if entry[0] == name), default=None)
+                after = stack if k is None else stack[:k] + stack[k + 1:]
+            else:
+                after = stack + [(name, token)]
+            if used + size + len(_closers(after)) > limit:
+                cut = (start, start, list(stack))
+                break
+            stack = after
+            used += size
+            continue
+        room = limit - used - len(_closers(stack))
+        if size <= room:
+            newline = token.rfind('\n')
+            if newline >= 0:
+                best = (start + newline, start + newline + 1, list(stack))
+            used += size
+            continue
+        if token[0] == '&':
+            cut = (start, start, list(stack))
+            break
+        room    = _fit(token, room)
+        newline = token.rfind('\n', 0, room)
+        space   = token.rfind(' ', 0, room)
+        if newline >= 0 and start + newline >= limit // 2:
+            cut = (start + newline, start + newline + 1, list(stack))
+        elif best and best[0] >= limit // 2:
+            cut = best
+        elif space > 0:
+            cut = (start + space, start + space + 1, list(stack))
+        else:
+            cut = (start + max(room, 1), start + max(room, 1), list(stack))
+        break
+    else:
+        return text, len(text), ''
+    end, resume, open_tags = cut
+    return text[:end] + _closers(open_tags), resume, ''.join(tag for _, tag in open_tags)
+
+
+def split_html(text: str, limit: int = TELEGRAM_LIMIT) -> list[str]:
+    """HTML по сообщениям: в каждой части теги закрыты, в следующей — открыты снова."""
+    parts = []
+    while utf16_len(text) > limit:
+        head, pos, reopen = cut_html(text, limit)
+        if pos <= 0:
+            break
+        parts.append(head)
+        text = reopen + text[pos:]
+    parts.append(text)
+    return parts
+
+
+def to_plain(text: str) -> str:
+    """HTML без разметки — на случай, если Telegram его всё же не принял."""
+    return html.unescape(re.sub(r'<[^>]*>', '', text))
+
+
+def is_parse_error(e: BadRequest) -> bool:
+    return "can't parse entities" in str(e).lower()
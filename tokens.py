@@ -0,0 +1,49 @@
+# tokens.py
+
+import logging
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем приблизительно
+    tiktoken = None
+
+DEFAULT_MODEL = 'gpt-4o'
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        # словарь энкодера скачивается при первом вызове — без сети считаем приблизительно
+        logging.warning('Токенизатор для %s недоступен: %s', model, e)
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Число токенов текста для модели (энкодер загружается один раз)."""
+    enc = _encoding(model)
+    if enc is None:
+        # ~3 символа на токен для смеси кириллицы и латиницы
+        return (len(text) + 2) // 3
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list[dict], model: str = DEFAULT_MODEL) -> int:
+    """Токены сообщений чата: текст плюс ~4 служебных токена на сообщение."""
+    return sum(count_tokens(m['content'], model) + 4 for m in messages)
+
+
+def truncate_tokens(text: str, limit: int, model: str = DEFAULT_MODEL) -> str:
+    """Начало текста не длиннее limit токенов."""
+    enc = _encoding(model)
+    if enc is None:
+        return text[:limit * 3]
+    tokens = enc.encode(text, disallowed_special=())
+    return text if len(tokens) <= limit else enc.decode(tokens[:limit])
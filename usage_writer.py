@@ -0,0 +1,235 @@
+# usage_writer.py
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from sqlalchemy import bindparam, case, update
+
+from models import User, async_engine
+
+_users = User.__table__
+
+# Пакетное обновление: usage_count += inc, tokens_used += tokens, last_request = ts,
+# сброс таймера после оплаты — как в проверке доступа
+_BULK_UPDATE = (
+    update(_users)
+    .where(_users.c.user_id == bindparam('uid'))
+    .values(
+        usage_count=_users.c.usage_count + bindparam('inc'),
+        tokens_used=case(
+            (_users.c.tokens_used + bindparam('tokens') < 0, 0),
+            else_=_users.c.tokens_used + bindparam('tokens'),
+        ),
+        first_request=case(
+            (_users.c.last_request < _users.c.first_request, bindparam('ts_first')),
+            else_=_users.c.first_request,
+        ),
+        last_request=bindparam('ts'),
+    )
+)
+
+
+class UsageWriteBehind:
+    """Отложенная запись счётчиков запросов.
+
+    Инкременты, токены и время последнего запроса копятся в памяти и пишутся в базу
+    одним пакетом раз в flush_interval секунд или при max_pending пользователях.
+    Проверка доступа учитывает ещё не записанные дельты через pending().
+    Если задан journal_path, каждый инкремент сперва дописывается в журнал
+    и после сбоя проигрывается при старте (семантика «хотя бы один раз»).
+    """
+
+    def __init__(self, flush_interval: float = 2.0, max_pending: int = 500,
+                 journal_path: str | None = None, fsync: bool = False):
+        self.flush_interval = flush_interval
+        self.max_pending    = max_pending
+        self.journal_path   = journal_path
+        self.fsync          = fsync
+        # uid -> [inc, первый ts, последний ts, токены]
+        self._pending:  dict[int, list] = {}
+        self._inflight: dict[int, list] = {}
+        self._journal   = None
+        self._lock      = asyncio.Lock()
+        self._wake      = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping  = False
+        # растёт после каждой записанной пачки — по нему проверка доступа
+        # понимает, что прочитанный из базы снимок мог уже включать дельты
+        self.epoch   = 0
+        self.flushed = 0
+        # вызывается со списком user_id сразу после записи пачки
+        self.on_flush = None
+
+    def pending(self, user_id: int) -> tuple[int, datetime | None, int]:
+        """Ещё не записанные (или пишущиеся сейчас) инкремент, время последнего запроса и токены."""
+        inc, last, tokens = 0, None, 0
+        for batch in (self._inflight, self._pending):
+            item = batch.get(user_id)
+            if item:
+                inc    += item[0]
+                last    = item[2]
+                tokens += item[3]
+        return inc, last, tokens
+
+    def discard_tokens(self, user_id: int) -> None:
+        """Забыть незаписанный расход токенов — квота начинается заново (активация тарифа).
+
+        Вызывать внутри paused(): пачка, которая уже пишется, иначе может лечь
+        в базу после сброса квоты.
+        """
+        item = self._pending.get(user_id)
+        if item:
+            item[3] = 0
+
+    @asynccontextmanager
+    async def paused(self):
+        """Пачки не пишутся; пишущаяся сейчас сперва дописывается."""
+        async with self._lock:
+            yield
+
+    def add(self, user_id: int, now: datetime, inc: int = 1, tokens: int = 0) -> None:
+        item = self._pending.get(user_id)
+        if item is None:
+            self._pending[user_id] = [inc, now, now, tokens]
+        else:
+            item[0] += inc
+            item[2]  = now
+            item[3] += tokens
+        if self._journal:
+            self._journal.write(f'{user_id} {now.isoformat()} {inc} {tokens}\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._pending:
+                return 0
+            self._inflight, self._pending = self._pending, {}
+            rotated = self._rotate_journal()
+            rows = [
+                {'uid': uid, 'inc': inc, 'tokens': tokens, 'ts_first': first, 'ts': last}
+                for uid, (inc, first, last, tokens) in self._inflight.items()
+            ]
+            try:
+                async with async_engine.begin() as conn:
+                    await conn.execute(_BULK_UPDATE, rows)
+            except BaseException as e:
+                # вернём дельты в очередь — запишутся со следующей пачкой
+                self._merge_back()
+                if not isinstance(e, Exception):
+                    raise
+                logging.exception('Не удалось записать счётчики запросов')
+                return 0
+            flushed, self._inflight = self._inflight, {}
+            self.epoch   += 1
+            self.flushed += len(rows)
+            if self.on_flush:
+                self.on_flush(list(flushed))
+            if rotated:
+                os.remove(rotated)
+            return len(flushed)
+
+    def _merge_back(self) -> None:
+        for uid, (inc, first, last, tokens) in self._inflight.items():
+            item = self._pending.get(uid)
+            if item is None:
+                self._pending[uid] = [inc, first, last, tokens]
+            else:
+                item[0] += inc
+                item[1]  = first
+                item[3] += tokens
+        self._inflight = {}
+
+    # ————— журнал на случай падения процесса —————
+    def _rotate_journal(self) -> str | None:
+        if not self._journal:
+            return None
+        self._journal.close()
+        rotated = self.journal_path + '.flushing'
+        if os.path.exists(rotated):
+            # прошлая пачка не записалась — дописываем её к текущей
+            with open(rotated, 'a', encoding='utf-8') as dst, open(self.journal_path, encoding='utf-8') as src:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, rotated)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        return rotated
+
+    def _replay(self) -> int:
+        replayed = 0
+        for path in (self.journal_path + '.flushing', self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        # строки до учёта токенов — «uid ts», это один запрос
+                        uid, ts, *rest = line.split()
+                        inc, tokens = map(int, rest) if rest else (1, 0)
+                        self.add(int(uid), datetime.fromisoformat(ts), inc, tokens)
+                        replayed += 1
+                    except ValueError:
+                        # оборванная последняя строка
+                        continue
+            os.remove(path)
+        return replayed
+
+    async def start(self) -> None:
+        if self.journal_path:
+            replayed = self._replay()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            if replayed:
+                logging.info('Из журнала восстановлено %s инкрементов', replayed)
+                for uid, (inc, first, last, tokens) in self._pending.items():
+                    self._journal.write(f'{uid} {last.isoformat()} {inc} {tokens}\n')
+                self._journal.flush()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            # цикл останавливаем флагом, а не отменой: отмена посреди flush() может
+            # прийти уже после коммита — пачка вернулась бы в очередь и записалась дважды
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                return
+            self._wake.clear()
+            # отмена задачи не обрывает запись пачки на середине
+            await asyncio.shield(self.flush())
+
+
+def make_usage_writer() -> UsageWriteBehind | None:
+    """Отложенная запись по USAGE_WRITE_BEHIND=1; иначе каждый запрос пишется сразу."""
+    if os.environ.get('USAGE_WRITE_BEHIND', '0') != '1':
+        return None
+    journal_path = os.environ.get('USAGE_JOURNAL') or None
+    if journal_path and os.environ.get('WORKER_INDEX'):
+        # у каждого воркера свой журнал: один файл нельзя проигрывать и ротировать из разных процессов
+        journal_path += '.' + os.environ['WORKER_INDEX']
+    return UsageWriteBehind(
+        flush_interval=float(os.environ.get('USAGE_FLUSH_INTERVAL', 2.0)),
+        max_pending=int(os.environ.get('USAGE_FLUSH_MAX_PENDING', 500)),
+        journal_path=journal_path,
+        fsync=os.environ.get('USAGE_JOURNAL_FSYNC', '0') == '1',
+    )
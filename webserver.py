@@ -0,0 +1,95 @@
+# webserver.py
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from contextlib import suppress
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+from journal import UpdateJournal
+from metrics import registry
+
+
+class TelegramHandler(tornado.web.RequestHandler):
+    """Приём апдейтов от Telegram: в очередь приложения или в журнал, ответ сразу."""
+
+    def initialize(self, app: Application, secret_token: str | None, journal: UpdateJournal | None):
+        self.app          = app
+        self.secret_token = secret_token
+        self.journal      = journal
+
+    async def post(self):
+        if self.secret_token:
+            header = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(header, self.secret_token):
+                raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except Exception:
+            logging.warning('Не удалось разобрать апдейт от Telegram')
+            raise tornado.web.HTTPError(400)
+        registry.inc('updates_received_total', help='Апдейтов принято вебхуком')
+        if self.journal:
+            # 200 — только после записи в базу; если база недоступна,
+            # Telegram получит 500 и пришлёт апдейт ещё раз
+            await self.journal.append(update.update_id, self.request.body.decode())
+        else:
+            await self.app.update_queue.put(update)
+        self.set_status(200)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(registry.render())
+
+
+async def serve_webhook(app: Application, listen: str, port: int, url_path: str,
+                        webhook_url: str, drop_pending_updates: bool = False,
+                        secret_token: str | None = None, metrics_path: str = '/metrics',
+                        journal: UpdateJournal | None = None) -> None:
+    """То же, что Application.run_webhook, но с маршрутом метрик рядом с вебхуком.
+
+    С journal апдейты сначала пишутся в журнал, а обрабатывает их дренаж журнала.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    routes = [(rf'/{url_path.strip("/")}/?', TelegramHandler, {'app': app, 'secret_token': secret_token, 'journal': journal})]
+    if metrics_path:
+        routes.append((metrics_path, MetricsHandler))
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    server = tornado.web.Application(routes).listen(port, listen, xheaders=True)
+    try:
+        await app.bot.set_webhook(
+            url=webhook_url,
+            drop_pending_updates=drop_pending_updates,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await app.start()
+        if journal:
+            # сначала — то, что осталось необработанным с прошлого запуска
+            await journal.start(app)
+        logging.info('Вебхук слушает %s:%s, метрики — %s', listen, port, metrics_path or 'выключены')
+        await stop.wait()
+    finally:
+        server.stop()
+        if journal:
+            await journal.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
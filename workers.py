@@ -0,0 +1,183 @@
+# workers.py
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_errors
+from contextlib import suppress
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+from journal import UpdateJournal
+from metrics import registry
+
+
+def shard_of(update: Update, workers: int) -> int:
+    """Номер воркера для апдейта: все апдейты одного чата — в один процесс."""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % workers
+
+
+def _worker_main(index: int, queue, acks) -> None:
+    # в дочернем процессе собираем полноценное приложение бота, но без вебхука;
+    # номер воркера — до импорта: по нему у процесса свой журнал счётчиков.
+    # Импортируем application, а не bot: bot.py spawn уже выполнил как __mp_main__
+    os.environ['WORKER_INDEX'] = str(index)
+    import application
+    logging.info('Воркер %s запущен', index)
+    asyncio.run(_worker_loop(application.build_application(webhook=False), queue, acks))
+
+
+def _drain(queue) -> list:
+    """Забирает всё, что осталось в очереди упавшего воркера."""
+    items = []
+    with suppress(queue_errors.Empty, OSError, EOFError):
+        while True:
+            # с небольшим ожиданием: положенное недавно ещё может идти через фоновый поток очереди
+            items.append(queue.get(timeout=0.1))
+    return items
+
+
+async def _process(app: Application, data: dict, acks) -> None:
+    update = Update.de_json(data, app.bot)
+    try:
+        await app.update_processor.process_update(update, app.process_update(update))
+    except Exception:
+        # ошибки хэндлеров ловит приложение; сюда попадает только битый апдейт
+        logging.exception('Не удалось обработать апдейт %s', update.update_id)
+    if acks is not None:
+        acks.put(update.update_id)
+
+
+async def _worker_loop(app: Application, queue, acks) -> None:
+    loop  = asyncio.get_running_loop()
+    tasks = set()
+    async with app:
+        # async with не вызывает post_init/post_shutdown — фоновые задачи запускаем сами
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            # задачи создаются в порядке прихода — процессор сохранит порядок внутри чата
+            task = asyncio.create_task(_process(app, data, acks))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        await app.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+def build_front(token: str, workers: int, post_init=None, journal: UpdateJournal | None = None,
+                ack_timeout: float = 600.0, watch_interval: float = 1.0) -> Application:
+    """Приложение-приёмник вебхука: только раздаёт апдейты воркерам по chat_id.
+
+    Раз в watch_interval секунд приёмник проверяет воркеры: упавший
+    перезапускается с новой очередью, неразобранные апдейты переходят к нему.
+
+    С журналом апдейтов хэндлер приёмника завершается, только когда воркер
+    сообщил, что апдейт обработан, — иначе журнал отметит апдейт сразу
+    после передачи, и падение воркера его потеряет. Если воркер упал или
+    не ответил за ack_timeout секунд, апдейт возвращается в журнал (retry).
+    """
+    ctx    = multiprocessing.get_context('spawn')
+    queues = [ctx.Queue() for _ in range(workers)]
+    acks   = ctx.Queue() if journal else None
+    procs: list[multiprocessing.Process] = []
+    # update_id -> (воркер, future: True — обработан, False — воркер упал)
+    waiting: dict[int, tuple[int, asyncio.Future]] = {}
+    watchers, readers = [], []
+
+    def spawn(index: int) -> multiprocessing.Process:
+        proc = ctx.Process(target=_worker_main, args=(index, queues[index], acks),
+                           name=f'bot-worker-{index}', daemon=True)
+        proc.start()
+        return proc
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        data = update.to_dict()
+        if acks is None:
+            queues[shard_of(update, workers)].put(data)
+            return
+        shard = shard_of(update, workers)
+        done  = asyncio.get_running_loop().create_future()
+        waiting[update.update_id] = shard, done
+        queues[shard].put(data)
+        try:
+            processed = await asyncio.wait_for(done, ack_timeout)
+        except asyncio.TimeoutError:
+            processed = False
+        finally:
+            waiting.pop(update.update_id, None)
+        if not processed:
+            # слот дренажа освобождается, апдейт возьмётся из журнала снова
+            logging.warning('Апдейт %s: воркер %s не подтвердил обработку, повторим из журнала',
+                            update.update_id, shard)
+            journal.retry(update.update_id)
+
+    async def read_acks() -> None:
+        loop = asyncio.get_running_loop()
+        while (update_id := await loop.run_in_executor(None, acks.get)) is not None:
+            _, done = waiting.get(update_id, (None, None))
+            if done and not done.done():
+                done.set_result(True)
+
+    async def watch_workers() -> None:
+        while True:
+            await asyncio.sleep(watch_interval)
+            for index, proc in enumerate(procs):
+                if proc.is_alive():
+                    continue
+                logging.error('Воркер %s завершился (код %s), перезапускаем', index, proc.exitcode)
+                registry.inc('worker_restarts_total', help='Перезапусков упавших воркеров')
+                # очередь, которую читал упавший процесс, могла остаться заблокированной — берём новую
+                old, queues[index] = queues[index], ctx.Queue()
+                if journal:
+                    # всё, что ждало этот воркер, вернётся из журнала; его старую очередь не переносим
+                    for shard, done in list(waiting.values()):
+                        if shard == index and not done.done():
+                            done.set_result(False)
+                else:
+                    for data in await asyncio.get_running_loop().run_in_executor(None, _drain, old):
+                        queues[index].put(data)
+                procs[index] = spawn(index)
+
+    async def start_workers(app: Application) -> None:
+        procs.extend(spawn(i) for i in range(workers))
+        watchers.append(asyncio.create_task(watch_workers()))
+        if acks is not None:
+            readers.append(asyncio.create_task(read_acks()))
+        if post_init:
+            await post_init(app)
+
+    async def stop_workers(app: Application) -> None:
+        # сначала наблюдатель — иначе он перезапустит останавливаемые воркеры
+        for task in watchers:
+            task.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join(timeout=30)
+        if acks is not None:
+            acks.put(None)
+            await asyncio.gather(*readers, return_exceptions=True)
+
+    builder = Application.builder().token(token).post_init(start_workers).post_shutdown(stop_workers)
+    if journal:
+        # приёмник ждёт воркеров — апдейты разных чатов не должны ждать друг друга
+        builder = builder.concurrent_updates(True)
+    front = builder.build()
+    front.add_handler(TypeHandler(Update, forward))
+    return front